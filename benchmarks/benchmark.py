@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+'''
+Measure the throughput of Migrator.migrate against local stand-ins for Bugzilla and GitLab.
+
+Both stand-ins run in a separate process, so that the peak RSS reported is that of the
+migration alone. The Bugzilla stand-in serves show_bug.cgi?ctype=xml for a synthetic
+corpus of bugs, generated on the fly from the bug id and gzip-compressed if the client
+accepts it; the GitLab stand-in answers the milestones, issues, notes and uploads
+endpoints of the v4 API. Both add a configurable latency to every response, count the
+connections they accept, and GitLab enforces a rate limit with RateLimit-* headers and
+HTTP 429, like gitlab.com does.
+
+Examples:
+
+    python benchmarks/benchmark.py --corpus small
+    python benchmarks/benchmark.py --corpus medium --workers 8 --gitlab-latency 20
+    python benchmarks/benchmark.py --corpus medium --http-backend asyncio --json
+'''
+import argparse
+import base64
+import contextlib
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import sys
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+from urllib.request import urlopen
+
+# bugzilla2gitlab from the checkout the benchmarks are in, unless PYTHONPATH has another
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bugzilla2gitlab import Migrator  # noqa: E402
+
+# bugs, mean number of comments per bug, mean number of attachments per bug,
+# mean attachment size in bytes
+CORPORA = {
+    "tiny": (10, 2, 1, 1024),
+    "small": (100, 5, 1, 16 * 1024),
+    "medium": (500, 10, 2, 64 * 1024),
+    "large": (1000, 25, 2, 512 * 1024),
+}
+
+MILESTONES = ["---", "1.0", "2.0", "3.0"]
+
+DEFAULTS_YML = '''\
+dry_run: false
+gitlab_base_url: "{gitlab_url}/api/v4"
+gitlab_project_id: 1
+gitlab_private_token: "benchmark"
+bugzilla_base_url: "{bugzilla_url}"
+bugzilla_user:
+bugzilla_closed_states:
+    - "RESOLVED"
+    - "VERIFIED"
+    - "CLOSED"
+default_gitlab_labels:
+    - "bugzilla"
+map_keywords: true
+keywords_to_skip:
+map_milestones: true
+milestones_to_skip:
+    - "---"
+'''
+
+
+class Corpus(object):
+    '''
+    A synthetic set of bugs 1..bugs. Everything about a bug, e.g. its number of
+    comments and the content of its attachments, is derived from its id, so that
+    all runs with the same parameters migrate the same data.
+    '''
+    def __init__(self, bugs, comments, attachments, attachment_size):
+        self.bugs = bugs
+        self.comments = comments
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+
+    def bug(self, bug_id):
+        '''
+        Returns the fields of a bug, with lists of comments and attachments.
+        '''
+        rand = random.Random(bug_id)
+        attachments = []
+        for i in range(rand.randint(0, 2 * self.attachments)):
+            attachid = bug_id * 100 + i
+            if attachid % 7 == 0:
+                # a file that is attached to many bugs, as happens in a real Bugzilla
+                attachments.append({"attachid": str(attachid), "filename": "common.bin",
+                                    "seed": 0, "size": self.attachment_size})
+            else:
+                attachments.append({"attachid": str(attachid),
+                                    "filename": "file-{}.bin".format(i), "seed": attachid,
+                                    "size": rand.randint(0, 2 * self.attachment_size)})
+        comments = ["Comment {} on bug {}.\n{}".format(i, bug_id, "Lorem ipsum. " * i)
+                    for i in range(rand.randint(1, 2 * self.comments + 1))]
+        return {
+            "bug_id": bug_id,
+            "milestone": rand.choice(MILESTONES),
+            "status": rand.choice(["NEW", "ASSIGNED", "RESOLVED"]),
+            "comments": comments,
+            "attachments": attachments,
+        }
+
+    def xml(self, bug_ids, fields=None):
+        '''
+        The response of show_bug.cgi?ctype=xml for `bug_ids`, restricted to `fields`.
+        '''
+        parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n<bugzilla>']
+        for bug_id in bug_ids:
+            if not 1 <= bug_id <= self.bugs:
+                parts.append('<bug error="NotFound"><bug_id>{}</bug_id></bug>'.format(bug_id))
+            elif fields:
+                bug = self.bug(bug_id)
+                parts.append("<bug><bug_id>{}</bug_id><target_milestone>{}</target_milestone>"
+                             "</bug>".format(bug_id, bug["milestone"]))
+            else:
+                parts.append(_bug_xml(self.bug(bug_id)))
+        parts.append("</bugzilla>")
+        return "".join(parts).encode("utf-8")
+
+    def describe(self):
+        comments = attachments = size = 0
+        for bug_id in range(1, self.bugs + 1):
+            bug = self.bug(bug_id)
+            comments += len(bug["comments"])
+            attachments += len(bug["attachments"])
+            size += sum(a["size"] for a in bug["attachments"])
+        return {"bugs": self.bugs, "comments": comments, "attachments": attachments,
+                "attachment_bytes": size}
+
+
+def _random_bytes(seed, size):
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, "little") if size else b""
+
+
+def _bug_xml(bug):
+    when = "2019-05-0{} 10:00:00 -0700"
+    xml = [
+        "<bug>",
+        "<bug_id>{}</bug_id>".format(bug["bug_id"]),
+        "<creation_ts>{}</creation_ts>".format(when.format(1)),
+        "<short_desc>Synthetic bug {}</short_desc>".format(bug["bug_id"]),
+        "<delta_ts>{}</delta_ts>".format(when.format(9)),
+        "<version>1.0</version><rep_platform>All</rep_platform><op_sys>Linux</op_sys>",
+        "<bug_status>{}</bug_status><resolution></resolution>".format(bug["status"]),
+        "<bug_file_loc></bug_file_loc><keywords>bench, synthetic</keywords>",
+        "<priority>P2</priority><bug_severity>normal</bug_severity>",
+        "<target_milestone>{}</target_milestone>".format(bug["milestone"]),
+        '<reporter name="Reporter">reporter@example.com</reporter>',
+        '<assigned_to name="Assignee">assignee@example.com</assigned_to>',
+        "<cc>cc@example.com</cc>",
+    ]
+    for i, text in enumerate(bug["comments"]):
+        xml.append('<long_desc isprivate="0"><commentid>{}</commentid>'
+                   '<who name="Reporter">reporter@example.com</who>'
+                   "<bug_when>{}</bug_when><thetext>{}</thetext></long_desc>".format(
+                       i, when.format(2), text))
+    for attachment in bug["attachments"]:
+        xml.append('<long_desc isprivate="0"><attachid>{}</attachid>'
+                   '<who name="Reporter">reporter@example.com</who>'
+                   "<bug_when>{}</bug_when><thetext>Created attachment {}\n{}</thetext>"
+                   "</long_desc>".format(attachment["attachid"], when.format(3),
+                                         attachment["attachid"], attachment["filename"]))
+    for attachment in bug["attachments"]:
+        xml.append('<attachment isobsolete="0" ispatch="0" isprivate="0">'
+                   "<attachid>{}</attachid><filename>{}</filename>"
+                   '<data encoding="base64">{}</data></attachment>'.format(
+                       attachment["attachid"], attachment["filename"],
+                       base64.encodebytes(_random_bytes(attachment["seed"], attachment["size"]))
+                       .decode("ascii")))
+    xml.append("</bug>")
+    return "".join(xml)
+
+
+class StandInServer(ThreadingHTTPServer):
+    '''
+    An HTTP server that delays every response by `latency` seconds, allows at most
+    `rate_limit` requests per second (0 for no limit) and records the time it took
+    to answer each request.
+    '''
+    daemon_threads = True
+
+    def __init__(self, handler, latency, rate_limit, corpus):
+        super().__init__(("127.0.0.1", 0), handler)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.corpus = corpus
+        self.lock = threading.Lock()
+        self.window = 0
+        self.window_requests = 0
+        self.ids = 0
+        self.stats = {"latencies": [], "requests": {}, "throttled": 0, "connections": 0,
+                      "bytes_sent": 0}
+
+    def next_id(self):
+        with self.lock:
+            self.ids += 1
+            return self.ids
+
+    def admit(self):
+        '''
+        Count a request against the rate limit of the current one-second window.
+        Returns the number of requests left in the window, or None if there are none.
+        '''
+        if not self.rate_limit:
+            return self.rate_limit
+        with self.lock:
+            window = int(time.time())
+            if window != self.window:
+                self.window = window
+                self.window_requests = 0
+            if self.window_requests >= self.rate_limit:
+                self.stats["throttled"] += 1
+                return None
+            self.window_requests += 1
+            return self.rate_limit - self.window_requests
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            self.stats["latencies"].append(seconds)
+            self.stats["requests"][endpoint] = self.stats["requests"].get(endpoint, 0) + 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, do not let them wait for each other
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        # one handler per connection
+        super().setup()
+        self.server.count("connections")
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
+
+    def handle_request(self, method):
+        start = time.monotonic()
+        url = urlsplit(self.path)
+        body = self.read_body()
+        if url.path == "/_stats":
+            self.respond(200, json.dumps(self.server.stats).encode("utf-8"))
+            return
+
+        remaining = self.server.admit()
+        if remaining is None:
+            self.respond(429, b"{}", {"Retry-After": "1"})
+            return
+        time.sleep(self.server.latency)
+        endpoint, status, content = self.route(method, url.path, parse_qs(url.query), body)
+        headers = {}
+        if self.server.rate_limit:
+            headers = {"RateLimit-Limit": str(self.server.rate_limit),
+                       "RateLimit-Remaining": str(remaining),
+                       "RateLimit-Reset": str(int(time.time()) + 1)}
+        self.respond(status, content, headers)
+        self.server.record("{} {}".format(method, endpoint), time.monotonic() - start)
+
+    def read_body(self):
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = []
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                body.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    return b"".join(body)
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def respond(self, status, content, headers={}):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+        self.server.count("bytes_sent", len(content))
+
+
+class BugzillaHandler(StandInHandler):
+    def route(self, method, path, query, body):
+        if path.endswith("/show_bug.cgi"):
+            bug_ids = [int(i) for i in query.get("id", [])]
+            return "show_bug.cgi", 200, self.server.corpus.xml(bug_ids, query.get("field"))
+        return path, 404, b""
+
+    def respond(self, status, content, headers={}):
+        # like Apache's mod_deflate in front of Bugzilla
+        if "gzip" in self.headers.get("Accept-Encoding", "") and content:
+            content = gzip.compress(content, 6)
+            headers = dict(headers, **{"Content-Encoding": "gzip"})
+        super().respond(status, content, headers)
+
+
+class GitLabHandler(StandInHandler):
+    def route(self, method, path, query, body):
+        path = re.sub(r"^/api/v4/projects/\d+", "", path)
+        endpoint = re.sub(r"/\d+", "/:id", path)
+        new_id = self.server.next_id()
+        if endpoint == "/milestones" and method == "GET":
+            result = []
+        elif endpoint == "/issues":
+            iid = int(parse_qs(body.decode("utf-8"))["iid"][0])
+            result = {"id": new_id, "iid": iid,
+                      "web_url": "http://gitlab.example.com/p/-/issues/{}".format(iid)}
+        elif endpoint == "/uploads":
+            url = "/uploads/{}/file".format(new_id)
+            result = {"url": url, "markdown": "[file]({})".format(url)}
+        elif endpoint in ["/milestones", "/issues/:id/notes", "/issues/:id"]:
+            result = {"id": new_id}
+        else:
+            return endpoint, 404, b""
+        return endpoint, 201, json.dumps(result).encode("utf-8")
+
+
+def serve(args, corpus, ports):
+    '''
+    Run both stand-ins until the process is terminated.
+    '''
+    bugzilla = StandInServer(BugzillaHandler, args.bugzilla_latency / 1000, 0, corpus)
+    gitlab = StandInServer(GitLabHandler, args.gitlab_latency / 1000, args.rate_limit, None)
+    ports.send((bugzilla.server_address[1], gitlab.server_address[1]))
+    threading.Thread(target=bugzilla.serve_forever, daemon=True).start()
+    gitlab.serve_forever()
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(round(p / 100 * (len(values) - 1)))]
+
+
+def run(args):
+    corpus = Corpus(*CORPORA[args.corpus])
+    for name in ["bugs", "comments", "attachments", "attachment_size"]:
+        if getattr(args, name) is not None:
+            setattr(corpus, name, getattr(args, name))
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    servers = multiprocessing.Process(target=serve, args=(args, corpus, sender), daemon=True)
+    servers.start()
+    bugzilla_port, gitlab_port = receiver.recv()
+    bugzilla_url = "http://127.0.0.1:{}".format(bugzilla_port)
+    gitlab_url = "http://127.0.0.1:{}".format(gitlab_port)
+
+    try:
+        with tempfile.TemporaryDirectory() as config_dir:
+            with open(os.path.join(config_dir, "defaults.yml"), "w") as f:
+                f.write(DEFAULTS_YML.format(gitlab_url=gitlab_url, bugzilla_url=bugzilla_url))
+
+            output = sys.stderr if args.verbose else open(os.devnull, "w")
+            with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                client = Migrator(config_dir, workers=args.workers,
+                                  http_backend=args.http_backend, pipeline=args.pipeline,
+                                  bugzilla_batch_size=args.batch_size,
+                                  cache_dir=None if args.cache else "")
+                start = time.monotonic()
+                client.migrate(list(range(1, corpus.bugs + 1)))
+                elapsed = time.monotonic() - start
+
+        stats = {name: json.load(urlopen(url + "/_stats"))  # nosec
+                 for name, url in [("bugzilla", bugzilla_url), ("gitlab", gitlab_url)]}
+    finally:
+        servers.terminate()
+
+    latencies = stats["bugzilla"]["latencies"] + stats["gitlab"]["latencies"]
+    requests = len(latencies)
+    return {
+        "corpus": dict(corpus.describe(), name=args.corpus),
+        "mode": {"http_backend": args.http_backend, "workers": args.workers,
+                 "pipeline": args.pipeline, "batch_size": args.batch_size,
+                 "cache": args.cache},
+        "elapsed": elapsed,
+        "bugs_per_second": corpus.bugs / elapsed,
+        "requests": requests,
+        "requests_per_bug": requests / corpus.bugs,
+        "throttled": stats["gitlab"]["throttled"],
+        "endpoints": dict(stats["bugzilla"]["requests"], **stats["gitlab"]["requests"]),
+        "connections": {name: stats[name]["connections"] for name in stats},
+        "bugzilla_bytes": stats["bugzilla"]["bytes_sent"],
+        "latency_p50": percentile(latencies, 50),
+        "latency_p99": percentile(latencies, 99),
+        # kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+
+def print_report(result):
+    corpus = result["corpus"]
+    mode = result["mode"]
+    print("corpus {}: {} bugs, {} comments, {} attachments ({:.1f} MiB)".format(
+        corpus["name"], corpus["bugs"], corpus["comments"], corpus["attachments"],
+        corpus["attachment_bytes"] / 2**20))
+    print("mode: {} backend{}, {} workers, batches of {}, cache {}".format(
+        mode["http_backend"], ", pipeline" if mode["pipeline"] else "", mode["workers"],
+        mode["batch_size"], "on" if mode["cache"] else "off"))
+    print("elapsed: {:.2f}s, {:.1f} bugs/s".format(
+        result["elapsed"], result["bugs_per_second"]))
+    print("requests: {} ({:.1f} per bug), {} throttled".format(
+        result["requests"], result["requests_per_bug"], result["throttled"]))
+    for endpoint, count in sorted(result["endpoints"].items()):
+        print("  {:<28} {}".format(endpoint, count))
+    print("connections: bugzilla {bugzilla}, gitlab {gitlab}".format(**result["connections"]))
+    print("bugzilla responses: {:.1f} MiB".format(result["bugzilla_bytes"] / 2**20))
+    print("latency: p50 {:.1f} ms, p99 {:.1f} ms".format(result["latency_p50"] * 1000,
+                                                         result["latency_p99"] * 1000))
+    print("peak RSS: {:.1f} MiB".format(result["peak_rss"] / 2**20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Migrator.migrate against local "
+                                     "stand-ins for Bugzilla and GitLab.")
+    parser.add_argument("--corpus", choices=sorted(CORPORA), default="small",
+                        help="The size of the synthetic corpus of bugs.")
+    parser.add_argument("--bugs", type=int, help="Override the number of bugs of the corpus.")
+    parser.add_argument("--comments", type=int,
+                        help="Override the mean number of comments per bug.")
+    parser.add_argument("--attachments", type=int,
+                        help="Override the mean number of attachments per bug.")
+    parser.add_argument("--attachment-size", type=int, metavar="BYTES",
+                        help="Override the mean attachment size.")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--http-backend", choices=["requests", "asyncio"], default="requests")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Migrate through the pipeline of overlapping stages.")
+    parser.add_argument("--batch-size", type=int, default=20,
+                        help="The number of bugs fetched from Bugzilla per request.")
+    parser.add_argument("--no-cache", dest="cache", action="store_false",
+                        help="Do not store fetched bugs in the bug cache.")
+    parser.add_argument("--bugzilla-latency", type=float, default=0, metavar="MS",
+                        help="Delay every Bugzilla response by MS milliseconds.")
+    parser.add_argument("--gitlab-latency", type=float, default=0, metavar="MS",
+                        help="Delay every GitLab response by MS milliseconds.")
+    parser.add_argument("--rate-limit", type=int, default=0, metavar="N",
+                        help="Allow at most N GitLab requests per second (default: no limit).")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show the output of the migration.")
+    args = parser.parse_args()
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2, sort_keys=True))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+'''
+Compare utils.format_utc, which parses the time format of Bugzilla directly, with
+utils.parse_utc, which parses any time with dateutil, on the timestamps of a synthetic
+corpus of bugs.
+
+Example:
+
+    python benchmarks/format_utc.py --count 100000
+'''
+import argparse
+import os
+import random
+import sys
+import timeit
+
+# bugzilla2gitlab from the checkout the benchmarks are in, unless PYTHONPATH has another
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bugzilla2gitlab.utils import format_utc, parse_utc  # noqa: E402
+
+OFFSETS = ["+0000", "-0700", "-0800", "+0100", "+0200", "+0530", "-0330"]
+
+
+def timestamps(count, seed=0):
+    rng = random.Random(seed)
+    return ["{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d} {}".format(
+        rng.randint(1998, 2024), rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+        rng.randint(0, 59), rng.randint(0, 59), rng.choice(OFFSETS)) for _ in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--count", type=int, default=20000,
+                        help="The number of timestamps to convert.")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    times = timestamps(args.count)
+    assert [format_utc(t) for t in times] == [parse_utc(t) for t in times]
+    for name, func in [("parse_utc (dateutil)", parse_utc), ("format_utc", format_utc)]:
+        best = min(timeit.repeat(lambda: [func(t) for t in times], number=1,
+                                 repeat=args.repeat))
+        print("{:<22} {:8.2f} us per timestamp".format(name, best / args.count * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+'''
+Measure the rendering of bugs into issues and comments, and of the payloads of their
+requests, on a corpus of large synthetic bugs (see benchmark.py): the CPU time, the peak
+memory allocated while rendering a bug and the memory the rendered bug retains.
+Nothing is fetched or sent, the bugs are parsed before they are measured.
+
+Examples:
+
+    python benchmarks/render.py --bugs 200 --comments 100
+    # the same, against another revision of bugzilla2gitlab
+    git worktree add /tmp/b2g-base HEAD~1
+    PYTHONPATH=/tmp/b2g-base python benchmarks/render.py
+'''
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# also puts bugzilla2gitlab on the path, see benchmark.py
+from benchmark import Corpus, DEFAULTS_YML
+
+from bugzilla2gitlab.config import get_config
+from bugzilla2gitlab.models import IssueThread
+from bugzilla2gitlab.records import iterparse_bugs
+
+
+def render(conf, bug):
+    '''
+    Render a bug like a migration does, with its attachments uploaded, and build the
+    payloads of its requests.
+    '''
+    issue_thread = IssueThread(conf, bug)
+    for model in [issue_thread.issue] + issue_thread.comments:
+        if model.attachment:
+            model.attachment.link = "/uploads/0123456789abcdef/{}".format(
+                model.attachment.filename)
+            model.render()
+    issue_thread.issue.save_request()
+    for comment in issue_thread.comments:
+        comment.issue_id = issue_thread.issue.iid
+        comment.save_request()
+    return issue_thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--bugs", type=int, default=100)
+    parser.add_argument("--comments", type=int, default=50,
+                        help="The mean number of comments per bug.")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    corpus = Corpus(args.bugs, args.comments, 2, 256)
+    bugs = list(iterparse_bugs(io.BytesIO(corpus.xml(range(1, args.bugs + 1))), 1 << 20))
+    comments = sum(len(bug["comments"]) for bug in bugs)
+    with tempfile.TemporaryDirectory() as config_dir:
+        with open(os.path.join(config_dir, "defaults.yml"), "w") as f:
+            f.write(DEFAULTS_YML.format(gitlab_url="http://gitlab.invalid",
+                                        bugzilla_url="http://bugzilla.invalid"))
+        conf = get_config(config_dir, map_milestones=False, journal_file="", cache_dir="",
+                          user_cache_file="")
+
+    best = None
+    for _ in range(args.repeat):
+        start = time.process_time()
+        for bug in bugs:
+            render(conf, bug)
+        elapsed = time.process_time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    peak = retained = 0
+    rendered = []
+    for bug in bugs:
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        rendered.append(render(conf, bug))
+        current, bug_peak = tracemalloc.get_traced_memory()
+        peak += bug_peak - before
+        retained += current - before
+    tracemalloc.stop()
+
+    print("{} bugs, {} comments".format(len(bugs), comments), file=sys.stderr)
+    print("CPU time:        {:8.1f} us per bug".format(best / len(bugs) * 1e6))
+    print("Peak allocation: {:8.1f} KiB per bug".format(peak / len(bugs) / 1024))
+    print("Retained:        {:8.1f} KiB per bug".format(retained / len(bugs) / 1024))
+
+
+if __name__ == "__main__":
+    main()
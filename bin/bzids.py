@@ -1,7 +1,30 @@
 #!/usr/bin/env python3
+"""
+Print the ids of Bugzilla bugs, one per line.
+
+    bzids.py < search.json
+        reads a search result of the REST API (/rest/bug?include_fields=id...)
+    bzids.py BUGZILLA_URL QUERY [API_KEY]
+        pages through the bugs matching QUERY (e.g. 'product=Packages'), printing the
+        ids of each page as soon as it arrives
+"""
 import json
 import sys
+from urllib.parse import parse_qs
+
+from bugzilla2gitlab.rest import search_bug_ids
+
+
+def main():
+    if len(sys.argv) > 2:
+        api_key = sys.argv[3] if len(sys.argv) > 3 else None
+        for bug_id in search_bug_ids(sys.argv[1], parse_qs(sys.argv[2]), api_key):
+            print(bug_id, flush=True)
+        return
+    data = json.load(sys.stdin)
+    ids = "\n".join([str(i["id"]) for i in data["bugs"]])
+    print(ids)
+
 
-data = json.load(sys.stdin)
-ids = "\n".join([str(i["id"]) for i in data["bugs"]])
-print(ids)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+'''
+Optional asyncio HTTP backend, built on aiohttp.
+Install it with `pip install bugzilla2gitlab[async]` and set `http_backend: asyncio`.
+'''
+import asyncio
+from collections import namedtuple
+import sys
+import time
+
+from .metrics import metrics
+from .records import BugParser, READ_SIZE
+from .utils import cookies, governor
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+# The parts of a non-JSON response that callers of perform_request use
+Response = namedtuple("Response", ["status_code", "reason", "headers", "content", "cookies"])
+
+
+class AsyncClient(object):
+    '''
+    An aiohttp session shared by all coroutines of a migration, with the same request
+    semantics as utils._perform_request. At most `concurrency` requests are in flight
+    at any time, over at most `concurrency` connections. Connecting, and then every read
+    of a response, time out after `connect_timeout` and `read_timeout` seconds.
+    '''
+    def __init__(self, concurrency=20, connect_timeout=None, read_timeout=None):
+        if aiohttp is None:
+            raise Exception("The asyncio backend requires aiohttp: pip install aiohttp")
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=concurrency),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout,
+                                          sock_read=read_timeout))
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.session.close()
+
+    def use_cookies(self, url):
+        '''
+        Send the cookies of the synchronous session (e.g. a Bugzilla login) to `url`.
+        '''
+        self.session.cookie_jar.update_cookies({c.name: c.value for c in cookies},
+                                               yarl.URL(url))
+
+    async def perform_request(self, url, method, data={}, params={}, headers={}, files={},
+                              json=True, dry_run=False, consume=None):
+        '''
+        Perform an HTTP request, paced and retried like utils._perform_request.
+        With `consume` (and not `json`), the body of a successful response is not read
+        into memory: consume(stream) is awaited with its aiohttp.StreamReader instead,
+        and the Response holds what it returns as its content.
+        '''
+        if dry_run and method != "get":
+            msg = "{} {} dry_run".format(url, method)
+            print(msg, file=sys.stderr)
+            return 0
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(governor.delay(url))
+            start = time.monotonic()
+            try:
+                result = await self._request(url, method, data, params, headers, files, json,
+                                             consume)
+            except aiohttp.ClientConnectionError:
+                metrics.record_request(method, url, None, time.monotonic() - start)
+                delay = governor.retry_delay(method, None, attempt)
+                if delay is None:
+                    raise
+            else:
+                if not isinstance(result, Response) or result.status_code in [200, 201]:
+                    return result
+                delay = governor.retry_delay(method, result.status_code, attempt,
+                                             result.headers)
+                if delay is None:
+                    raise Exception("{} failed requests: {}".format(result.status_code,
+                                                                    result.reason))
+            print("Retrying {} {} in {:.1f}s".format(method, url, delay), file=sys.stderr)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _request(self, url, method, data, params, headers, files, json, consume=None):
+        '''
+        Send a request once, and record it in `metrics`. Returns the decoded JSON body
+        of a successful response if `json` is true, and a Response otherwise.
+        '''
+        if files:
+            body = aiohttp.FormData()
+            for name, (filename, content) in files.items():
+                if not isinstance(content, bytes):
+                    # rewind files streamed by an earlier attempt
+                    content.seek(0)
+                body.add_field(name, content, filename=filename)
+        else:
+            body = _form_items(data)
+
+        async with self.semaphore:
+            start = time.monotonic()
+            async with self.session.request(method, url, params=_form_items(params),
+                                            data=body, headers=headers) as result:
+                streamed = consume and not json and result.status in [200, 201]
+                if streamed:
+                    # the body is yet to be received, its size is as announced
+                    received = int(result.headers.get("Content-Length") or 0)
+                else:
+                    content = await result.read()
+                    received = len(content)
+                metrics.record_request(
+                    method, url, result.status, time.monotonic() - start,
+                    int(result.request_info.headers.get("Content-Length") or 0), received)
+                governor.update(url, result.headers)
+                if streamed:
+                    content = await consume(result.content)
+                elif result.status in [200, 201] and json:
+                    return await result.json(content_type=None)
+                return Response(result.status, result.reason, result.headers, content,
+                                result.cookies)
+
+
+def _form_items(data):
+    '''
+    Encode form data or query parameters the way requests does: lists become
+    repeated keys and None values are dropped.
+    '''
+    items = data.items() if isinstance(data, dict) else data
+    encoded = []
+    for key, value in items:
+        for v in value if isinstance(value, (list, tuple)) else [value]:
+            if v is not None:
+                encoded.append((key, str(v)))
+    return encoded
+
+
+async def get_bugzilla_bug(client, bugzilla_url, bug_id, memory_limit):
+    bugs = await get_bugzilla_bugs(client, bugzilla_url, [bug_id], memory_limit)
+    return bugs.get(str(bug_id))
+
+
+async def get_bugzilla_bugs(client, bugzilla_url, bug_ids, memory_limit, on_element=None):
+    '''
+    Fetch several bugs with a single request, see utils.get_bugzilla_bugs. The response is
+    parsed as it is received, so memory does not grow with the size of the attachments
+    either.
+    '''
+    async def parse(stream):
+        parser = BugParser(memory_limit, on_element)
+        bugs = {}
+        async for chunk in stream.iter_chunked(READ_SIZE):
+            bugs.update((bug["bug_id"], bug) for bug in parser.feed(chunk))
+        bugs.update((bug["bug_id"], bug) for bug in parser.finish())
+        return bugs
+
+    url = "{}/show_bug.cgi".format(bugzilla_url)
+    params = [("ctype", "xml")] + [("id", bug_id) for bug_id in bug_ids]
+    with metrics.phase("bugzilla.fetch"):
+        response = await client.perform_request(url, "get", params=params, json=False,
+                                                consume=parse)
+    return response.content
@@ -0,0 +1,67 @@
+'''
+On-disk cache of the XML of Bugzilla bugs.
+'''
+import gzip
+import os
+import re
+import threading
+
+from .records import iterparse_bugs
+from .utils import format_utc
+
+
+class BugCache(object):
+    '''
+    Stores the XML of each bug, as fetched from Bugzilla and including attachment data,
+    gzip-compressed in `path`. Files are keyed by bug id and delta_ts (the time of the
+    last change to the bug), so a bug that changes in Bugzilla is stored again and only
+    its latest version is kept.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        # bug id => file name of its latest version
+        self.index = {}
+        for filename in sorted(os.listdir(path)):
+            match = re.match(r"(\d+)-(\d+)\.xml\.gz$", filename)
+            if match:
+                self.index[match.group(1)] = filename
+
+    def filename(self, bug):
+        delta_ts = re.sub(r"\D", "", format_utc(bug.findtext("delta_ts")))
+        return "{}-{}.xml.gz".format(bug.findtext("bug_id"), delta_ts)
+
+    def __contains__(self, bug_id):
+        return str(bug_id) in self.index
+
+    def get(self, bug_id, memory_limit):
+        '''
+        Returns the cached bug record of `bug_id` (see records.py), or None.
+        '''
+        filename = self.index.get(str(bug_id))
+        if not filename:
+            return None
+        with gzip.open(os.path.join(self.path, filename), "rb") as f:
+            return next(iterparse_bugs(f, memory_limit))
+
+    def put(self, bug, xml):
+        '''
+        Store the XML of a bug, as chunks of bytes, unless the same version of the bug is
+        already stored. `bug` is its element, see records.iterparse_bugs.
+        '''
+        bug_id = bug.findtext("bug_id")
+        filename = self.filename(bug)
+        with self.lock:
+            old_filename = self.index.get(bug_id)
+            if old_filename == filename:
+                return
+            self.index[bug_id] = filename
+
+        tmp = os.path.join(self.path, filename + ".tmp")
+        with gzip.open(tmp, "wb") as f:
+            for chunk in xml:
+                f.write(chunk)
+        os.replace(tmp, os.path.join(self.path, filename))
+        if old_filename:
+            os.remove(os.path.join(self.path, old_filename))
@@ -1,10 +1,15 @@
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
 import sys
+import time
+from urllib.parse import quote
 
 import yaml
 
-from .utils import _perform_request
+from .render import BodyFormat, COMMENT_HEADER, DESCRIPTION_HEADING, DESCRIPTION_TABLE
+from .utils import _perform_request, get_all_pages, transport
 
 Config = namedtuple('Config', ["gitlab_base_url", "gitlab_project_id",
                                "bugzilla_base_url", "bugzilla_user",
@@ -12,20 +17,128 @@ Config = namedtuple('Config', ["gitlab_base_url", "gitlab_project_id",
                                "default_gitlab_labels",
                                "map_keywords", "keywords_to_skip",
                                "map_milestones", "milestones_to_skip", "gitlab_milestones",
-                               "dry_run"])
-
-
-def get_config(path):
-    configuration = {}
+                               "dry_run", "bugzilla_batch_size", "workers",
+                               "http_backend", "async_concurrency", "journal_file", "journal",
+                               "max_retries", "cache_dir", "offline",
+                               "attachment_memory_limit", "metrics_file", "export_file",
+                               "export", "bugzilla_backend", "bugzilla_api_key", "pipeline",
+                               "pipeline_queue_size", "pipeline_workers", "bugzilla_users",
+                               "gitlab_users", "user_cache_file", "user_cache_ttl",
+                               "description_table", "description_heading", "comment_header",
+                               "body_format", "connect_timeout", "read_timeout"])
+
+# Settings that may be left out of defaults.yml, with the values used in that case
+OPTIONAL_DEFAULTS = {
+    "bugzilla_batch_size": 20,
+    "workers": 1,
+    "http_backend": "requests",
+    "async_concurrency": 20,
+    "journal_file": "journal.sqlite3",
+    # Set by Migrator to the journal.Journal opened from journal_file
+    "journal": None,
+    "max_retries": 5,
+    # The bug cache is only kept if a directory is set, see cache.BugCache
+    "cache_dir": None,
+    "offline": False,
+    "attachment_memory_limit": 10 * 1024 * 1024,
+    # Write request and phase metrics to this file (Prometheus text format if it ends
+    # with .prom, JSON otherwise) at the end of a migration
+    "metrics_file": None,
+    # Write a GitLab project export archive to this file, instead of creating issues
+    # through the API
+    "export_file": None,
+    # Set by Migrator to the export.ProjectExport writing export_file
+    "export": None,
+    # Fetch bugs from show_bug.cgi as XML ("xml"), or from the REST API ("rest")
+    "bugzilla_backend": "xml",
+    # API key for the REST API, instead of logging in as bugzilla_user
+    "bugzilla_api_key": None,
+    # Migrate bugs through a pipeline of concurrent stages, see Migrator.migrate_pipeline
+    "pipeline": False,
+    "pipeline_queue_size": 10,
+    # Threads per pipeline stage, e.g. {"upload": 4}
+    "pipeline_workers": {},
+    # GitLab user ids, relative to the config directory, and how long they are kept
+    "user_cache_file": "users.json",
+    "user_cache_ttl": 24 * 60 * 60,
+    # The format of issue descriptions and comments, see render.py
+    "description_table": DESCRIPTION_TABLE,
+    "description_heading": DESCRIPTION_HEADING,
+    "comment_header": COMMENT_HEADER,
+    # Set by get_config to the render.BodyFormat compiled from the three above
+    "body_format": None,
+    # Seconds to wait for a connection to be established, and then for each response
+    "connect_timeout": 10,
+    "read_timeout": 300,
+}
+
+
+def get_config(path, **overrides):
+    '''
+    Load the configuration from `path`. Keyword arguments that are not None
+    (e.g. command-line options) take precedence over defaults.yml.
+    '''
+    configuration = dict(OPTIONAL_DEFAULTS)
     configuration.update(_load_defaults(path))
-    if configuration["map_milestones"]:
+    configuration.update({k: v for k, v in overrides.items() if v is not None})
+    # an export does not need GitLab at all
+    if configuration["map_milestones"] and not configuration["export_file"]:
         configuration.update(
             _load_milestone_id_cache(configuration["gitlab_project_id"],
                                      configuration["gitlab_base_url"],
                                      configuration["default_headers"]))
+    configuration.setdefault("gitlab_milestones", {})
+    # issues of an export are assigned to nobody
+    if configuration["export_file"]:
+        configuration.update(bugzilla_users={}, gitlab_users={})
+    else:
+        cache_file = configuration["user_cache_file"]
+        configuration.update(
+            _load_user_id_cache(path, configuration["gitlab_base_url"],
+                                configuration["default_headers"],
+                                os.path.join(path, cache_file) if cache_file else None,
+                                configuration["user_cache_ttl"], configuration["workers"]))
+    configuration["body_format"] = BodyFormat(
+        configuration["description_table"], configuration["description_heading"],
+        configuration["comment_header"], configuration["bugzilla_base_url"])
     return Config(**configuration)
 
 
+def project_config(config, project_id):
+    '''
+    The configuration `config` for another GitLab project, with its own milestones.
+    '''
+    milestones = {}
+    if config.map_milestones and not config.export_file:
+        milestones = _load_milestone_id_cache(project_id, config.gitlab_base_url,
+                                              config.default_headers)["gitlab_milestones"]
+    return config._replace(gitlab_project_id=project_id, gitlab_milestones=milestones)
+
+
+def load_manifest(path):
+    '''
+    Load a manifest (YAML) mapping bug list files, relative to the manifest, to the
+    GitLab projects their bugs are migrated to, by id or path:
+
+        bugs_packages.txt: 174
+        bugs_image.txt: adelie/image
+
+    Returns a dictionary of GitLab project id => list of bug ids.
+    '''
+    with open(path) as f:
+        manifest = yaml.safe_load(f)
+    if not isinstance(manifest, dict):
+        raise Exception("The manifest {} does not map bug lists to projects.".format(path))
+    projects = {}
+    for bug_list, project in manifest.items():
+        # the API takes the URL-encoded path of a project in place of its id
+        project_id = project if isinstance(project, int) else quote(str(project), safe="")
+        with open(os.path.join(os.path.dirname(path), bug_list)) as f:
+            bugs = [line for line in f.read().splitlines() if line.strip()]
+        projects.setdefault(project_id, []).extend(bugs)
+    return projects
+
+
 def _load_defaults(path):
     with open(os.path.join(path, "defaults.yml")) as f:
         config = yaml.safe_load(f)
@@ -49,14 +162,73 @@ def _load_milestone_id_cache(project_id, gitlab_url, gitlab_headers):
 
     gitlab_milestones = {}
     url = "{}/projects/{}/milestones".format(gitlab_url, project_id)
-    result = _perform_request(url, "get", headers=gitlab_headers)
-    if result and isinstance(result, list):
-        for milestone in result:
-            gitlab_milestones[milestone["title"]] = milestone["id"]
+    for milestone in get_all_pages(url, gitlab_headers):
+        gitlab_milestones[milestone["title"]] = milestone["id"]
 
     return {"gitlab_milestones": gitlab_milestones}
 
 
+def _load_user_id_cache(path, gitlab_url, gitlab_headers, cache_file, ttl, workers=1):
+    '''
+    Load the mapping of Bugzilla logins to GitLab usernames (user_mappings.yml, if any)
+    and the ids of those GitLab users. Each GitLab user is looked up once, however many
+    Bugzilla users and bugs refer to it, by `workers` threads at the same time, and the
+    ids are kept in `cache_file` for `ttl` seconds, so that later runs need no lookups
+    at all.
+    '''
+    bugzilla_users = {}
+    mappings = os.path.join(path, "user_mappings.yml")
+    if os.path.exists(mappings):
+        with open(mappings) as f:
+            bugzilla_users = yaml.safe_load(f) or {}
+
+    cached = _read_user_cache(cache_file, gitlab_url, ttl)
+    usernames = sorted(set(bugzilla_users.values()))
+    missing = [username for username in usernames if username not in cached]
+    if missing:
+        print("Loading user cache...", file=sys.stderr)
+        # enough connections to GitLab for all lookups, see Migrator
+        transport.configure(workers, *transport.timeout)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            user_ids = executor.map(
+                lambda username: _get_user_id(username, gitlab_url, gitlab_headers), missing)
+            cached.update(zip(missing, user_ids))
+        _write_user_cache(cache_file, gitlab_url, {username: cached[username]
+                                                   for username in missing})
+
+    # bugzilla login => gitlab username, gitlab username => gitlab user id
+    return {"bugzilla_users": bugzilla_users,
+            "gitlab_users": {username: cached[username] for username in usernames}}
+
+
+def _read_user_cache(cache_file, gitlab_url, ttl):
+    '''
+    The GitLab user ids in `cache_file` that are not older than `ttl` seconds.
+    '''
+    if not cache_file or not os.path.exists(cache_file):
+        return {}
+    with open(cache_file) as f:
+        users = json.load(f).get(gitlab_url, {})
+    now = time.time()
+    return {username: user_id for username, (user_id, saved) in users.items()
+            if now - saved < ttl}
+
+
+def _write_user_cache(cache_file, gitlab_url, user_ids):
+    if not cache_file:
+        return
+    cache = {}
+    if os.path.exists(cache_file):
+        with open(cache_file) as f:
+            cache = json.load(f)
+    now = time.time()
+    cache.setdefault(gitlab_url, {}).update(
+        {username: [user_id, now] for username, user_id in user_ids.items()})
+    with open(cache_file + ".tmp", "w") as f:
+        json.dump(cache, f)
+    os.replace(cache_file + ".tmp", cache_file)
+
+
 def _get_user_id(username, gitlab_url, headers):
     url = "{}/users?username={}".format(gitlab_url, username)
     result = _perform_request(url, "get", headers=headers)
@@ -0,0 +1,140 @@
+'''
+GitLab project export archives, an alternative to creating issues through the API.
+'''
+import io
+import json
+import os
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import uuid
+
+# Version of the GitLab project export format written
+EXPORT_VERSION = "0.2.4"
+LABEL_COLOR = "#428BCA"
+
+
+class ProjectExport(object):
+    '''
+    Writes migrated issues, with their notes and uploaded attachments, to a GitLab
+    project export archive (.tar.gz) at `path`. Importing the archive as a new project
+    loads everything into GitLab at once, instead of with an API request per issue,
+    comment, attachment and issue closing.
+    The archive is written to a temporary file and moved to `path` by close().
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.tar = tarfile.open(path + ".tmp", "w:gz")
+        # issues are written as they come, the archive needs their total size upfront
+        self.issues = tempfile.TemporaryFile()
+        self.issue_count = 0
+        # titles, in order of first use
+        self.labels = {}
+        self.milestones = {}
+        # (sha256, file name) => link
+        self.uploads = {}
+        self.uploads_reused = 0
+        self.bytes_saved = 0
+
+    def add_upload(self, filename, content, size, sha256):
+        '''
+        Add a file to the uploads of the project, unless an identical file (same content
+        and name) is already part of it. Returns the markdown link to the file.
+        '''
+        filename = filename.replace("/", "_")
+        with self.lock:
+            link = self.uploads.get((sha256, filename))
+            if link is not None:
+                self.uploads_reused += 1
+                self.bytes_saved += size
+                return link
+            secret = uuid.uuid4().hex
+            self._add_file("uploads/{}/{}".format(secret, filename), content, size)
+            link = "/uploads/{}/{}".format(secret, filename)
+            self.uploads[(sha256, filename)] = link
+            return link
+
+    def add_issue(self, issue, comments, closed):
+        '''
+        Add an issue and its comments, as rendered for the API, to the project.
+        '''
+        _, _, kwargs = issue.save_request()
+        data = kwargs["data"]
+        labels = [label for label in (data.get("labels") or "").split(",") if label]
+        record = {
+            "iid": int(data["iid"]),
+            "title": data["title"],
+            "description": data["description"],
+            "created_at": data["created_at"],
+            "updated_at": issue.updated_at,
+            "state": "closed" if closed else "opened",
+            "closed_at": issue.updated_at if closed else None,
+            "label_links": [{"target_type": "Issue", "label": _label(label)}
+                            for label in labels],
+            "notes": [],
+        }
+        if issue.milestone:
+            record["milestone"] = {"title": issue.milestone, "state": "active"}
+
+        for comment in comments:
+            _, _, kwargs = comment.save_request()
+            record["notes"].append({
+                "note": kwargs["data"]["body"],
+                "noteable_type": "Issue",
+                "created_at": kwargs["data"]["created_at"],
+                "updated_at": kwargs["data"]["created_at"],
+                "system": False,
+            })
+
+        line = json.dumps(record).encode("utf-8") + b"\n"
+        with self.lock:
+            self.issues.write(line)
+            self.issue_count += 1
+            for label in labels:
+                self.labels[label] = True
+            if issue.milestone:
+                self.milestones[issue.milestone] = True
+
+    def close(self):
+        '''
+        Write the project metadata and move the finished archive to `path`.
+        '''
+        with self.lock:
+            self._add_bytes("VERSION", EXPORT_VERSION.encode("utf-8"))
+            self._add_bytes("tree/project.json", json.dumps({
+                "description": "Imported from Bugzilla",
+                "issues_enabled": True,
+            }).encode("utf-8"))
+            self._add_bytes("tree/project/labels.ndjson",
+                            _ndjson(_label(title) for title in self.labels))
+            self._add_bytes("tree/project/milestones.ndjson", _ndjson(
+                {"iid": i + 1, "title": title, "state": "active"}
+                for i, title in enumerate(self.milestones)))
+            self._add_file("tree/project/issues.ndjson", self.issues, self.issues.tell())
+            self.issues.close()
+            self.tar.close()
+            os.replace(self.path + ".tmp", self.path)
+        print("Exported {} issues and {} files to {} (identical files avoided: {}, {} bytes)"
+              .format(self.issue_count, len(self.uploads), self.path, self.uploads_reused,
+                      self.bytes_saved), file=sys.stderr)
+
+    def _add_file(self, name, f, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = time.time()
+        f.seek(0)
+        self.tar.addfile(info, f)
+
+    def _add_bytes(self, name, data):
+        self._add_file(name, io.BytesIO(data), len(data))
+
+
+def _label(title):
+    return {"title": title, "color": LABEL_COLOR, "type": "ProjectLabel"}
+
+
+def _ndjson(records):
+    return b"".join(json.dumps(record).encode("utf-8") + b"\n" for record in records)
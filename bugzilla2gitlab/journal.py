@@ -0,0 +1,230 @@
+'''
+Checkpoint journal of completed migration steps, so that an interrupted migration
+can be resumed without creating anything in GitLab twice.
+'''
+import sqlite3
+import threading
+
+from .utils import map_row, parse_map_row
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS issues (
+    project_id TEXT, bug_id INTEGER, iid INTEGER, web_url TEXT,
+    closed INTEGER DEFAULT 0, done INTEGER DEFAULT 0,
+    PRIMARY KEY (project_id, bug_id));
+CREATE TABLE IF NOT EXISTS notes (
+    project_id TEXT, bug_id INTEGER, num INTEGER, note_id INTEGER,
+    PRIMARY KEY (project_id, bug_id, num));
+CREATE TABLE IF NOT EXISTS attachments (
+    project_id TEXT, bug_id INTEGER, attachid INTEGER, url TEXT,
+    PRIMARY KEY (project_id, bug_id, attachid));
+CREATE TABLE IF NOT EXISTS uploads (
+    project_id TEXT, sha256 TEXT, filename TEXT, url TEXT, size INTEGER,
+    PRIMARY KEY (project_id, sha256, filename));
+CREATE TABLE IF NOT EXISTS bugs (
+    project_id TEXT, bug_id INTEGER, delta_ts TEXT, labels TEXT, milestone TEXT,
+    PRIMARY KEY (project_id, bug_id));
+CREATE TABLE IF NOT EXISTS links (
+    project_id TEXT, bug_id INTEGER, num INTEGER, sha256 TEXT,
+    PRIMARY KEY (project_id, bug_id, num));
+'''
+
+
+class Journal(object):
+    '''
+    An SQLite database recording each step of a migration: issues created (with their
+    GitLab iid), notes posted, attachments uploaded, and issues closed.
+    It also records every distinct file uploaded to a project, by SHA-256 and name,
+    so that attachments posted to several bugs are uploaded once, and the state of
+    every migrated bug (delta_ts, labels and milestone), so that later changes to the
+    bug can be synced to its issue, and the SHA-256 of the texts whose references to
+    other bugs were rewritten, so that they are only updated again if they change.
+    Issues and notes are committed as soon as they are recorded: creating either again
+    after a crash would duplicate it in GitLab. An issue whose creation was not recorded
+    because its response was lost is looked up in GitLab instead, see Issue.find_request.
+    Other writes can be repeated safely and are committed in batches of
+    `commit_every`; call flush() before exiting.
+    '''
+    def __init__(self, path, commit_every=50):
+        self.path = path
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        # uploads avoided in this run, and their total size
+        self.uploads_reused = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def _query(self, sql, *args):
+        with self.lock:
+            return self.db.execute(sql, args).fetchone()
+
+    def _write(self, sql, *args, commit=False):
+        with self.lock:
+            self.db.execute(sql, args)
+            self.uncommitted += 1
+            if commit or self.uncommitted >= self.commit_every:
+                self.db.commit()
+                self.uncommitted = 0
+
+    def flush(self):
+        with self.lock:
+            self.db.commit()
+            self.uncommitted = 0
+
+    def close(self):
+        self.flush()
+        self.db.close()
+
+    def get_issue(self, project_id, bug_id):
+        '''
+        Returns the GitLab iid of a bug's issue, or None if it was not created yet.
+        '''
+        row = self._query("SELECT iid FROM issues WHERE project_id = ? AND bug_id = ?",
+                          str(project_id), int(bug_id))
+        return row[0] if row else None
+
+    def is_closed(self, project_id, bug_id):
+        row = self._query("SELECT closed FROM issues WHERE project_id = ? AND bug_id = ?",
+                          str(project_id), int(bug_id))
+        return bool(row and row[0])
+
+    def is_done(self, project_id, bug_id):
+        row = self._query("SELECT done FROM issues WHERE project_id = ? AND bug_id = ?",
+                          str(project_id), int(bug_id))
+        return bool(row and row[0])
+
+    def get_note(self, project_id, bug_id, num):
+        row = self._query("SELECT note_id FROM notes "
+                          "WHERE project_id = ? AND bug_id = ? AND num = ?",
+                          str(project_id), int(bug_id), num)
+        return row[0] if row else None
+
+    def get_attachment(self, project_id, bug_id, attachid):
+        row = self._query("SELECT url FROM attachments "
+                          "WHERE project_id = ? AND bug_id = ? AND attachid = ?",
+                          str(project_id), int(bug_id), int(attachid))
+        return row[0] if row else None
+
+    def get_upload(self, project_id, sha256, filename):
+        '''
+        Returns the markdown URL of a file already uploaded to the project, or None.
+        '''
+        row = self._query("SELECT url, size FROM uploads "
+                          "WHERE project_id = ? AND sha256 = ? AND filename = ?",
+                          str(project_id), sha256, filename)
+        if not row:
+            return None
+        with self.lock:
+            self.uploads_reused += 1
+            self.bytes_saved += row[1]
+        return row[0]
+
+    def record_upload(self, project_id, sha256, filename, url, size):
+        self._write("INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                    str(project_id), sha256, filename, url, size)
+
+    def record_issue(self, project_id, bug_id, iid, web_url):
+        self._write("INSERT OR REPLACE INTO issues (project_id, bug_id, iid, web_url) "
+                    "VALUES (?, ?, ?, ?)", str(project_id), int(bug_id), iid, web_url,
+                    commit=True)
+
+    def record_note(self, project_id, bug_id, num, note_id):
+        self._write("INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?)",
+                    str(project_id), int(bug_id), num, note_id, commit=True)
+
+    def record_attachment(self, project_id, bug_id, attachid, url):
+        self._write("INSERT OR REPLACE INTO attachments VALUES (?, ?, ?, ?)",
+                    str(project_id), int(bug_id), int(attachid), url)
+
+    def record_close(self, project_id, bug_id):
+        self._write("UPDATE issues SET closed = 1 WHERE project_id = ? AND bug_id = ?",
+                    str(project_id), int(bug_id))
+
+    def record_done(self, project_id, bug_id):
+        self._write("UPDATE issues SET done = 1 WHERE project_id = ? AND bug_id = ?",
+                    str(project_id), int(bug_id))
+
+    def record_reopen(self, project_id, bug_id):
+        self._write("UPDATE issues SET closed = 0 WHERE project_id = ? AND bug_id = ?",
+                    str(project_id), int(bug_id))
+
+    def get_state(self, project_id, bug_id):
+        '''
+        Returns the (delta_ts, labels, milestone) of a bug when it was last migrated,
+        or None.
+        '''
+        return self._query("SELECT delta_ts, labels, milestone FROM bugs "
+                           "WHERE project_id = ? AND bug_id = ?", str(project_id), int(bug_id))
+
+    def record_state(self, project_id, bug_id, delta_ts, labels, milestone):
+        self._write("INSERT OR REPLACE INTO bugs VALUES (?, ?, ?, ?, ?)",
+                    str(project_id), int(bug_id), delta_ts, labels, milestone)
+
+    def get_link(self, project_id, bug_id, num):
+        '''
+        Returns the SHA-256 of the description (num 0) or comment `num` of a bug as its
+        references were last rewritten, or None.
+        '''
+        row = self._query("SELECT sha256 FROM links "
+                          "WHERE project_id = ? AND bug_id = ? AND num = ?",
+                          str(project_id), int(bug_id), num)
+        return row[0] if row else None
+
+    def record_link(self, project_id, bug_id, num, sha256):
+        self._write("INSERT OR REPLACE INTO links VALUES (?, ?, ?, ?)",
+                    str(project_id), int(bug_id), num, sha256)
+
+    def last_change(self, project_id):
+        '''
+        Returns the latest delta_ts (in UTC, see utils.format_utc) of all bugs migrated
+        to a project, or None.
+        '''
+        return self._query("SELECT MAX(delta_ts) FROM bugs WHERE project_id = ?",
+                           str(project_id))[0]
+
+    def migrated_bugs(self, project_id):
+        with self.lock:
+            return [row[0] for row in self.db.execute(
+                "SELECT bug_id FROM issues WHERE project_id = ? AND done = 1 ORDER BY bug_id",
+                (str(project_id),))]
+
+    def issues(self):
+        '''
+        Returns the (project_id, bug_id, iid, web_url) of every issue in the journal.
+        '''
+        with self.lock:
+            return self.db.execute("SELECT project_id, bug_id, iid, web_url FROM issues "
+                                   "ORDER BY project_id, bug_id").fetchall()
+
+    def export_map(self, f, bugzilla_url):
+        '''
+        Write the bug => issue map (map.csv) of every issue in the journal to file `f`.
+        '''
+        for _, bug_id, _, web_url in self.issues():
+            f.write(map_row(bugzilla_url, bug_id, web_url) + "\n")
+
+    def import_map(self, f, bugzilla_url, project_of):
+        '''
+        Record the issues of a bug => issue map (map.csv) read from file `f`, e.g. that of
+        an earlier migration, as migrated. `project_of(bug_id, web_url)` is the project id
+        of each issue. Issues the journal records already are left as they are.
+        Returns the number of issues recorded.
+        '''
+        imported = 0
+        with self.lock:
+            for row in f:
+                if not row.strip():
+                    continue
+                bug_id, iid, web_url = parse_map_row(bugzilla_url, row)
+                cursor = self.db.execute(
+                    "INSERT OR IGNORE INTO issues (project_id, bug_id, iid, web_url, done) "
+                    "VALUES (?, ?, ?, ?, 1)", (str(project_of(bug_id, web_url)), bug_id, iid,
+                                               web_url))
+                imported += cursor.rowcount
+            self.db.commit()
+            self.uncommitted = 0
+        return imported
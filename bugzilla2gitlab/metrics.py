@@ -0,0 +1,267 @@
+'''
+Timing and request metrics of a migration, and the progress line printed while it runs.
+'''
+import asyncio
+import contextlib
+import functools
+import json
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Upper bounds, in seconds, of the latency histogram buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf")]
+
+
+class Timings(object):
+    '''
+    The count, total and histogram of a series of durations.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.seconds += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+                break
+
+    def histogram(self):
+        '''
+        Cumulative bucket counts, keyed by upper bound as in Prometheus.
+        '''
+        histogram = {}
+        total = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            total += count
+            histogram["+Inf" if bound == float("inf") else str(bound)] = total
+        return histogram
+
+
+class RequestStats(Timings):
+    def __init__(self):
+        super().__init__()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.statuses = {}
+
+
+class Metrics(object):
+    '''
+    Collects, from all threads, the requests made per endpoint and method (count, bytes,
+    latency and status codes), the time spent in each phase of a migration, and the
+    connections opened to each host.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (endpoint, method) => RequestStats
+        self.requests = {}
+        # phase => Timings
+        self.phases = {}
+        # host => {"connections": opened, "requests": sent}, see transport.Transport.stats
+        self.connections = {}
+
+    def record_request(self, method, url, status, seconds, bytes_sent=0, bytes_received=0):
+        '''
+        Record a request. `status` is None if no response was received.
+        '''
+        key = (endpoint(url), method.upper())
+        status = str(status or "error")
+        with self.lock:
+            stats = self.requests.setdefault(key, RequestStats())
+            stats.add(seconds)
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+
+    def record_connections(self, connections):
+        with self.lock:
+            self.connections = connections
+
+    def record_phase(self, phase, seconds):
+        with self.lock:
+            self.phases.setdefault(phase, Timings()).add(seconds)
+
+    @contextlib.contextmanager
+    def phase(self, phase):
+        '''
+        Context manager recording the duration of its block as `phase`.
+        '''
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record_phase(phase, time.monotonic() - start)
+
+    def timed(self, phase):
+        '''
+        Decorator recording the duration of every call of a function, or coroutine
+        function, as `phase`.
+        '''
+        def decorator(func):
+            if asyncio.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def timed_coroutine(*args, **kwargs):
+                    start = time.monotonic()
+                    try:
+                        return await func(*args, **kwargs)
+                    finally:
+                        self.record_phase(phase, time.monotonic() - start)
+                return timed_coroutine
+
+            @functools.wraps(func)
+            def timed_function(*args, **kwargs):
+                start = time.monotonic()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record_phase(phase, time.monotonic() - start)
+            return timed_function
+        return decorator
+
+    def request_count(self):
+        with self.lock:
+            return sum(stats.count for stats in self.requests.values())
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                "requests": [{
+                    "endpoint": endpoint, "method": method, "count": stats.count,
+                    "seconds": stats.seconds, "bytes_sent": stats.bytes_sent,
+                    "bytes_received": stats.bytes_received, "statuses": dict(stats.statuses),
+                    "histogram": stats.histogram(),
+                } for (endpoint, method), stats in sorted(self.requests.items())],
+                "phases": [{
+                    "phase": phase, "count": timings.count, "seconds": timings.seconds,
+                    "histogram": timings.histogram(),
+                } for phase, timings in sorted(self.phases.items())],
+                "connections": [dict(counts, host=host)
+                                for host, counts in sorted(self.connections.items())],
+            }
+
+    def to_prometheus(self):
+        '''
+        The metrics in the Prometheus text format, e.g. for the node exporter's
+        textfile collector.
+        '''
+        metrics = self.to_dict()
+        lines = []
+
+        def metric(name, kind, description):
+            lines.append("# HELP bugzilla2gitlab_{} {}".format(name, description))
+            lines.append("# TYPE bugzilla2gitlab_{} {}".format(name, kind))
+
+        def sample(name, labels, value):
+            labels = ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+            lines.append("bugzilla2gitlab_{}{{{}}} {}".format(name, labels, value))
+
+        def histogram(name, labels, timings):
+            for bound, count in timings["histogram"].items():
+                sample(name + "_bucket", labels + [("le", bound)], count)
+            sample(name + "_sum", labels, timings["seconds"])
+            sample(name + "_count", labels, timings["count"])
+
+        metric("requests_total", "counter", "HTTP requests, by endpoint, method and status.")
+        for r in metrics["requests"]:
+            for status, count in sorted(r["statuses"].items()):
+                sample("requests_total", [("endpoint", r["endpoint"]), ("method", r["method"]),
+                                          ("status", status)], count)
+        for direction in ["sent", "received"]:
+            metric("request_bytes_{}_total".format(direction), "counter",
+                   "Bytes of HTTP request and response bodies {}.".format(direction))
+            for r in metrics["requests"]:
+                sample("request_bytes_{}_total".format(direction),
+                       [("endpoint", r["endpoint"]), ("method", r["method"])],
+                       r["bytes_" + direction])
+        metric("request_duration_seconds", "histogram", "Latency of HTTP requests.")
+        for r in metrics["requests"]:
+            histogram("request_duration_seconds",
+                      [("endpoint", r["endpoint"]), ("method", r["method"])], r)
+        metric("phase_duration_seconds", "histogram", "Duration of the phases of a migration.")
+        for p in metrics["phases"]:
+            histogram("phase_duration_seconds", [("phase", p["phase"])], p)
+        metric("connections_opened_total", "counter", "HTTP connections opened, by host.")
+        for c in metrics["connections"]:
+            sample("connections_opened_total", [("host", c["host"])], c["connections"])
+        metric("connection_requests_total", "counter",
+               "HTTP requests sent over the connections to a host, new or kept alive.")
+        for c in metrics["connections"]:
+            sample("connection_requests_total", [("host", c["host"])], c["requests"])
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path):
+        '''
+        Write the metrics to `path`, in the Prometheus text format if its name ends
+        with .prom and as JSON otherwise.
+        '''
+        with open(path, "w") as f:
+            if path.endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+
+def endpoint(url):
+    '''
+    The path of `url`, with ids and upload secrets replaced by ":id", so that requests
+    to the same API endpoint are counted together.
+    '''
+    return re.sub(r"/(\d+|[0-9a-f]{32})(?=/|$)", "/:id", urlsplit(url).path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+class Progress(object):
+    '''
+    Prints the number of migrated bugs, the throughput and the estimated time left
+    to stderr, at most every `interval` seconds. `total` is None if it is not known.
+    '''
+    def __init__(self, total, interval=5.0):
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start = self.last = time.monotonic()
+        self.requests = metrics.request_count()
+
+    def update(self, bugs=1):
+        with self.lock:
+            self.done += bugs
+            now = time.monotonic()
+            finished = self.total is not None and self.done >= self.total
+            if now - self.last < self.interval and not finished:
+                return
+            self.last = now
+        self.print()
+
+    def print(self):
+        elapsed = max(time.monotonic() - self.start, 1e-9)
+        rate = self.done / elapsed
+        requests = (metrics.request_count() - self.requests) / elapsed
+        if self.total is None:
+            print("Progress: {} bugs, {:.1f} bugs/s, {:.1f} requests/s".format(
+                self.done, rate, requests), file=sys.stderr)
+            return
+        eta = (self.total - self.done) / rate if rate else None
+        print("Progress: {}/{} bugs, {:.1f} bugs/s, {:.1f} requests/s, ETA {}".format(
+            self.done, self.total, rate, requests,
+            _duration(eta) if eta is not None else "unknown"), file=sys.stderr)
+
+
+def _duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02}:{:02}".format(hours, minutes, seconds)
+
+
+# Shared by all threads of a migration
+metrics = Metrics()
@@ -1,29 +1,601 @@
+import asyncio
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import copy
+import os
 import sys
+from urllib.parse import quote
 
-from .config import get_config
-from .models import IssueThread
-from .utils import bugzilla_login, get_bugzilla_bug, validate_list
+from . import aio, rest
+from .cache import BugCache
+from .config import get_config, project_config
+from .export import ProjectExport
+from .journal import Journal
+from .metrics import metrics, Progress
+from .models import create_milestones, IssueThread
+from .pipeline import Pipeline
+from .references import project_path, ReferenceIndex
+from .utils import (bugzilla_login, chunks, format_utc, get_bugzilla_bugs, get_bugzilla_fields,
+                    get_changed_bug_ids, governor, interleave, transport, unique,
+                    validate_list)
+from .validate import validate_bugs, write_report
+
+# The number of bugs whose target milestones are fetched with a single request
+MILESTONE_SCAN_BATCH_SIZE = 200
+# The seconds after which the bugs read so far from an iterable of bug ids are fetched,
+# rather than waiting for a whole batch of conf.bugzilla_batch_size
+STREAM_BATCH_WAIT = 1
+# The stages of Migrator.migrate_pipeline
+PIPELINE_STAGES = ["fetch", "render", "upload", "issue", "notes", "close"]
 
 
 class Migrator(object):
-    def __init__(self, config_path):
-        self.conf = get_config(config_path)
+    def __init__(self, config_path, **overrides):
+        self.conf = get_config(config_path, **overrides)
+        # Nothing is created in a dry run or an export, so there is nothing to journal either
+        if self.conf.journal_file and not self.conf.dry_run and not self.conf.export_file:
+            journal = Journal(os.path.join(config_path, self.conf.journal_file))
+            self.conf = self.conf._replace(journal=journal)
+        governor.max_retries = self.conf.max_retries
+        self.progress = None
+        self.logged_in = False
+        self.cache = None
+        if self.conf.cache_dir:
+            self.cache = BugCache(os.path.join(config_path, self.conf.cache_dir))
+        elif self.conf.offline:
+            raise Exception("Offline mode requires a bug cache, see cache_dir.")
+        if self.conf.bugzilla_backend == "rest" and self.conf.http_backend == "asyncio":
+            raise Exception("The REST Bugzilla backend is not supported with asyncio.")
+        if self.conf.pipeline and self.conf.http_backend == "asyncio":
+            raise Exception("The pipeline is not supported with asyncio.")
+        unknown = set(self.conf.pipeline_workers) - set(PIPELINE_STAGES)
+        if unknown:
+            raise Exception("Unknown pipeline stages: {}".format(", ".join(sorted(unknown))))
+        # enough connections to each host for all requests in flight at the same time
+        if self.conf.pipeline:
+            pool_size = sum(self.pipeline_workers().values())
+        else:
+            pool_size = self.conf.workers
+        transport.configure(pool_size, self.conf.connect_timeout, self.conf.read_timeout)
 
     def migrate(self, bug_list):
         '''
-        Migrate a list of bug ids from Bugzilla to GitLab.
+        Migrate a list of bug ids from Bugzilla to GitLab. Any other iterable of bug ids,
+        e.g. a generator such as rest.search_bug_ids(), is migrated as it is consumed.
+        Bugs are fetched from Bugzilla in batches of conf.bugzilla_batch_size and,
+        if conf.workers > 1, migrated by that many threads at the same time.
+        With conf.http_backend = "asyncio", all requests go through aiohttp instead,
+        and with conf.pipeline, the steps of a migration overlap, see migrate_pipeline().
+        Bugs that the journal records as migrated are skipped, and partially
+        migrated bugs resume at the first step that was not completed.
+        Missing GitLab milestones are created before any issue (or, for an iterable
+        other than a list, before the first issue that needs them).
+        Progress is printed while bugs are migrated, and metrics are written to
+        conf.metrics_file at the end.
+        With conf.export_file, the bugs are written to a GitLab project export
+        archive instead, one bug after the other.
+        '''
+        if not isinstance(bug_list, list):
+            # before the iterable is consumed, which may be waiting on a search or on
+            # standard input
+            self.login()
+        bug_list = validate_list(bug_list)
+        # a bug can only become one issue
+        if isinstance(bug_list, list):
+            bug_list = list(dict.fromkeys(bug_list))
+        else:
+            bug_list = unique(bug_list)
+        bug_list = self.skip_migrated(bug_list)
+        self.run(bug_list)
+
+    def sync(self, bug_list=None, since=None):
+        '''
+        Bring the issues of migrated bugs up to date with Bugzilla. Only the bugs changed
+        since the latest delta_ts recorded in the journal (or since `since`, a date or
+        time) are fetched, and only what changed is sent to GitLab: new comments and
+        attachments, and changes of labels, milestone and state.
+        Without `bug_list`, all bugs in the journal are synced; with it, only those in
+        `bug_list`, and those of them that were not migrated yet are migrated.
+        '''
+        journal = self.conf.journal
+        if not journal:
+            raise Exception("Syncing requires a journal, see journal_file.")
+        if self.conf.offline:
+            raise Exception("Syncing cannot be done offline.")
+        project_id = self.conf.gitlab_project_id
+        since = format_utc(since) if since else journal.last_change(project_id)
+        if not since:
+            raise Exception("The journal records no migrated bug to sync from, "
+                            "pass the time to sync from.")
+        self.login()
+        print("Searching for bugs changed since {}".format(since), file=sys.stderr)
+        if self.conf.bugzilla_backend == "rest":
+            changed = rest.get_changed_bug_ids(self.conf.bugzilla_base_url, since,
+                                               self.conf.bugzilla_api_key)
+        else:
+            changed = get_changed_bug_ids(self.conf.bugzilla_base_url, since)
+        migrated = set(journal.migrated_bugs(project_id))
+        if bug_list is None:
+            wanted = migrated
+        else:
+            wanted = set(int(bug) for bug in validate_list(bug_list))
+        # bugs that were not migrated yet are migrated, whether they changed or not
+        self.run(sorted(set(bug for bug in changed if bug in wanted) | (wanted - migrated)))
+
+    def run(self, bug_list):
+        '''
+        Migrate a deduplicated list, or iterable, of bug ids, see migrate().
+        '''
+        if not bug_list:
+            return
+        self.progress = Progress(len(bug_list) if isinstance(bug_list, list) else None)
+        if self.conf.export_file:
+            self.conf = self.conf._replace(export=ProjectExport(self.conf.export_file))
+        try:
+            self.login()
+            with metrics.phase("milestones"):
+                self.create_milestones(bug_list)
+            if self.conf.export:
+                for bug, fields in self.fetch(bug_list):
+                    self.migrate_fields(bug, fields)
+            elif self.conf.http_backend == "asyncio":
+                asyncio.run(self.migrate_async(bug_list))
+            elif self.conf.pipeline:
+                self.migrate_pipeline(bug_list)
+            elif self.conf.workers > 1:
+                self.migrate_parallel(bug_list)
+            else:
+                for bug, fields in self.fetch(bug_list):
+                    self.migrate_fields(bug, fields)
+        finally:
+            if self.conf.export:
+                self.conf.export.close()
+                self.conf = self.conf._replace(export=None)
+            self.report()
+
+    def migrate_projects(self, projects):
+        '''
+        Migrate the bugs of several GitLab projects in one run, e.g. those of a manifest
+        (see config.load_manifest). `projects` maps GitLab project ids to lists of bug
+        ids. The projects share the journal, the bug cache, the Bugzilla session and the
+        HTTP connections, and their bugs are interleaved, one bug of each project in
+        turn, so that all of them progress at the same time.
         '''
-        validate_list(bug_list)
-        if self.conf.bugzilla_user:
+        if self.conf.export_file or self.conf.http_backend == "asyncio":
+            raise Exception("Several projects can only be migrated through the API, "
+                            "with the requests backend.")
+        migrations = []
+        for project_id, bug_list in projects.items():
+            bug_list = list(dict.fromkeys(validate_list(bug_list)))
+            migrator = self.for_project(project_id)
+            bug_list = migrator.skip_migrated(bug_list)
+            if bug_list:
+                migrations.append((migrator, bug_list))
+        if not migrations:
+            return
+        self.progress = Progress(sum(len(bug_list) for _, bug_list in migrations))
+        try:
+            self.login()
+            with metrics.phase("milestones"):
+                for migrator, bug_list in migrations:
+                    migrator.create_milestones(bug_list)
+            for migrator, _ in migrations:
+                migrator.progress = self.progress
+            jobs = interleave(*[migrator.jobs(bug_list) for migrator, bug_list in migrations])
+            if self.conf.workers > 1:
+                self.migrate_jobs(jobs)
+            else:
+                for migrator, bug, fields in jobs:
+                    migrator.migrate_fields(bug, fields)
+        finally:
+            self.report()
+
+    def link_references(self, bug_list=None):
+        '''
+        Rewrite the references to other bugs in the issues and comments of migrated bugs
+        (Blocks, Depends on and See also, links to show_bug.cgi and "bug 123" mentions)
+        into references to the issues of those bugs: #iid within the project, and
+        group/project#iid across projects. Run it once the bugs are migrated, since the
+        issue of a bug may not exist yet when another bug refers to it.
+        The bugs are fetched (or read from the bug cache in offline mode) and rendered
+        again, and only the descriptions and comments whose text changes are updated, one
+        request each. Without `bug_list`, all bugs migrated to the project are linked.
+        '''
+        journal = self.conf.journal
+        if not journal:
+            raise Exception("Linking references requires a journal, see journal_file.")
+        project_id = self.conf.gitlab_project_id
+        if bug_list is None:
+            bug_list = journal.migrated_bugs(project_id)
+        else:
+            bug_list = [bug for bug in dict.fromkeys(validate_list(bug_list))
+                        if journal.is_done(project_id, bug)]
+        if not bug_list:
+            return
+        index = ReferenceIndex(journal.issues(), self.conf.bugzilla_base_url)
+        print("Linking the references of {} bugs to {} issues".format(
+            len(bug_list), len(index)), file=sys.stderr)
+        self.login()
+        updates = 0
+        try:
+            for bug, fields in self.fetch(bug_list):
+                if fields is None or fields.get("error"):
+                    print("Bug {} could not be fetched".format(bug), file=sys.stderr)
+                    continue
+                updates += IssueThread(self.conf, fields).link_references(index)
+        finally:
+            print("Updated {} descriptions and comments".format(updates), file=sys.stderr)
+            self.report()
+
+    def for_project(self, project_id):
+        '''
+        A Migrator for another GitLab project, sharing the journal, the bug cache and the
+        Bugzilla session of this one.
+        '''
+        migrator = copy.copy(self)
+        migrator.conf = project_config(self.conf, project_id)
+        migrator.progress = None
+        return migrator
+
+    def report(self):
+        '''
+        Print the statistics of a run, and write its metrics to conf.metrics_file.
+        '''
+        journal = self.conf.journal
+        if journal:
+            journal.flush()
+            print("Uploads avoided: {} ({} bytes)".format(
+                journal.uploads_reused, journal.bytes_saved), file=sys.stderr)
+        print("Requests throttled: {throttles}, retried: {retries}".format(
+            **governor.stats()), file=sys.stderr)
+        connections = transport.stats()
+        for host, counts in sorted(connections.items()):
+            print("Connections to {}: {} opened for {} requests".format(
+                host, counts["connections"], counts["requests"]), file=sys.stderr)
+        metrics.record_connections(connections)
+        if self.conf.metrics_file:
+            metrics.dump(self.conf.metrics_file)
+        self.progress = None
+
+    def login(self):
+        # the REST API authenticates with conf.bugzilla_api_key instead
+        if (self.conf.bugzilla_user and not self.conf.offline
+                and self.conf.bugzilla_backend == "xml" and not self.logged_in):
             bugzilla_login(self.conf.bugzilla_base_url, self.conf.bugzilla_user)
-        for bug in bug_list:
-            self.migrate_one(bug)
+            self.logged_in = True
+
+    def prefetch(self, bug_list):
+        '''
+        Fill the bug cache with a list of bug ids, without migrating them.
+        Bugs whose latest version is already cached are fetched again all the same,
+        since only Bugzilla knows whether they changed.
+        '''
+        if not self.cache:
+            raise Exception("Prefetching requires a bug cache, see cache_dir.")
+        if self.conf.bugzilla_backend != "xml":
+            raise Exception("Only bugs fetched as XML are cached, see bugzilla_backend.")
+        self.login()
+        bug_list = validate_list(bug_list)
+        for bug, fields in self.fetch(bug_list):
+            if fields is None or fields.get("error"):
+                print("Bug {} could not be fetched".format(bug), file=sys.stderr)
+
+    def validate(self, bug_list, report_file=None, processes=None):
+        '''
+        Render every bug of a list like a migration would, with nothing sent to GitLab,
+        and report the bugs that would fail and the requests and uploads that migrating
+        them would take. Bugs are read from the bug cache, and fetched into it first
+        unless they are cached already (or in offline mode); they are rendered by
+        `processes` processes, one per core by default.
+        With `report_file`, the result of each bug is written to it as CSV.
+        Returns the list of results, see validate.validate_bug().
+        '''
+        bug_list = list(dict.fromkeys(validate_list(bug_list)))
+        if not self.cache:
+            raise Exception("Validation requires a bug cache, see cache_dir.")
+        missing = [bug for bug in bug_list if bug not in self.cache]
+        if missing and not self.conf.offline:
+            self.prefetch(missing)
+
+        with metrics.phase("validate"):
+            results = validate_bugs(self.conf, self.cache.path, bug_list, processes)
+
+        failed = [result for result in results if result["error"]]
+        for result in failed:
+            print("Bug {bug_id} would fail: {error}".format(**result), file=sys.stderr)
+        # milestones are created, and identical files uploaded, once for all bugs
+        milestones = set(m for result in results for m in result["milestones"])
+        uploads = [upload for result in results for upload in result["uploads"]]
+        unique = {(sha256, filename): size for sha256, filename, size in uploads}
+        requests = sum(result["requests"] for result in results)
+        requests += len(milestones) - (len(uploads) - len(unique))
+        print("Validated {} bugs, {} would fail".format(len(results), len(failed)),
+              file=sys.stderr)
+        print("Requests: {} ({} uploads, {} milestones)".format(
+            requests, len(unique), len(milestones)), file=sys.stderr)
+        print("Upload bytes: {} ({} bytes of identical files avoided)".format(
+            sum(unique.values()), sum(size for _, _, size in uploads) - sum(unique.values())),
+            file=sys.stderr)
+        if report_file:
+            write_report(results, report_file)
+        return results
+
+    def create_milestones(self, bug_list):
+        '''
+        Create the GitLab milestones of all bugs in `bug_list` in one upfront phase, so
+        that creating an issue never waits for its milestone. Only the target milestones
+        are fetched from Bugzilla, for many bugs per request; in offline mode they are
+        read from the bug cache.
+        Bug ids that are streamed (not a list) are not known upfront, Issue creates the
+        milestones of those as it needs them.
+        '''
+        if not self.conf.map_milestones or self.conf.export or not isinstance(bug_list, list):
+            return
+        milestones = set()
+        for batch in chunks(bug_list, MILESTONE_SCAN_BATCH_SIZE):
+            if self.conf.offline:
+                bugs = self.load_cached(batch)
+            elif self.conf.bugzilla_backend == "rest":
+                bugs = rest.get_bugzilla_fields(self.conf.bugzilla_base_url, batch,
+                                                ["target_milestone"], self.conf.bugzilla_api_key)
+            else:
+                bugs = get_bugzilla_fields(self.conf.bugzilla_base_url, batch,
+                                           ["target_milestone"])
+            for fields in bugs.values():
+                milestone = fields.get("target_milestone")
+                if milestone and milestone not in self.conf.milestones_to_skip:
+                    milestones.add(milestone)
+
+        missing = sorted(milestones - set(self.conf.gitlab_milestones))
+        if missing:
+            print("Creating {} milestones".format(len(missing)), file=sys.stderr)
+            create_milestones(self.conf, missing)
+
+    def skip_migrated(self, bug_list):
+        journal = self.conf.journal
+        if not journal:
+            return bug_list
+        if not isinstance(bug_list, list):
+            return (bug for bug in bug_list
+                    if not journal.is_done(self.conf.gitlab_project_id, bug))
+        remaining = [bug for bug in bug_list
+                     if not journal.is_done(self.conf.gitlab_project_id, bug)]
+        if len(remaining) < len(bug_list):
+            print("Skipping {} bugs that were already migrated".format(
+                len(bug_list) - len(remaining)), file=sys.stderr)
+        return remaining
+
+    def export_map(self, path):
+        '''
+        Write the bug => issue map of every bug in the journal to `path` (e.g. map.csv).
+        '''
+        if not self.conf.journal:
+            raise Exception("Exporting the map requires a journal, see journal_file.")
+        with open(path, "w") as f:
+            self.conf.journal.export_map(f, self.conf.bugzilla_base_url)
+
+    def import_map(self, path, projects=None):
+        '''
+        Record the issues of a bug => issue map (e.g. the map.csv of an earlier migration)
+        in the journal as migrated, so that migrations skip their bugs and
+        link_references() rewrites the references to them. Their bugs are of
+        conf.gitlab_project_id or, with `projects` (GitLab project id => list of bug
+        ids, see config.load_manifest), of the project whose list they are in; bugs in no
+        list are recorded under the path of the project of their issue.
+        '''
+        if not self.conf.journal:
+            raise Exception("Importing a map requires a journal, see journal_file.")
+        project_of_bug = {}
+        for project_id, bug_list in (projects or {}).items():
+            for bug in validate_list(bug_list):
+                project_of_bug[int(bug)] = project_id
+
+        def project_of(bug_id, web_url):
+            if projects is None:
+                return self.conf.gitlab_project_id
+            if bug_id in project_of_bug:
+                return project_of_bug[bug_id]
+            return quote(project_path(web_url) or "", safe="")
+
+        with open(path) as f:
+            imported = self.conf.journal.import_map(f, self.conf.bugzilla_base_url, project_of)
+        print("Imported {} issues from {}".format(imported, path), file=sys.stderr)
+        return imported
+
+    def migrate_parallel(self, bug_list):
+        '''
+        Migrate bugs with a pool of conf.workers threads.
+        GitLab issues are created with an explicit iid, so the order in which bugs
+        complete does not matter. At most two bugs per worker are fetched ahead of
+        the workers, which keeps memory bounded for long bug lists.
+        '''
+        self.migrate_jobs(self.jobs(bug_list))
+
+    def migrate_pipeline(self, bug_list):
+        '''
+        Migrate bugs through a pipeline of stages: fetch (batches of bugs from Bugzilla),
+        render (issues and comments), upload (attachments), issue (creation), notes and
+        close. All stages run at the same time, each on other bugs, connected by queues of
+        at most conf.pipeline_queue_size bugs, so that Bugzilla requests, rendering and
+        GitLab requests overlap. conf.pipeline_workers sets the threads of each stage;
+        fetch and render have one, the GitLab stages conf.workers, by default.
+        '''
+        workers = self.pipeline_workers()
+
+        def render(job):
+            bug, fields = job
+            if not self.is_unchanged(fields):
+                yield self.load_issue_thread(bug, fields)
+            elif self.progress:
+                self.progress.update()
+
+        def upload(issue_thread):
+            issue_thread.upload_attachments()
+            yield issue_thread
+
+        def create(issue_thread):
+            issue_thread.issue.save()
+            yield issue_thread
+
+        def notes(issue_thread):
+            issue_thread.save_comments()
+            yield issue_thread
+
+        def close(issue_thread):
+            issue_thread.finish()
+            if self.progress:
+                self.progress.update()
+
+        pipeline = Pipeline(self.conf.pipeline_queue_size)
+        for stage, func in zip(PIPELINE_STAGES, [self.fetch, render, upload, create, notes,
+                                                 close]):
+            pipeline.add_stage(stage, func, workers[stage])
+        pipeline.run(chunks(bug_list, self.conf.bugzilla_batch_size, STREAM_BATCH_WAIT))
+
+    def pipeline_workers(self):
+        '''
+        The number of threads of each pipeline stage, see migrate_pipeline().
+        '''
+        workers = {stage: self.conf.workers for stage in PIPELINE_STAGES}
+        workers.update(fetch=1, render=1)
+        workers.update(self.conf.pipeline_workers)
+        return workers
+
+    def migrate_jobs(self, jobs):
+        '''
+        Migrate (migrator, bug id, bug record) triples with a pool of conf.workers threads.
+        '''
+        max_pending = 2 * self.conf.workers
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.conf.workers) as executor:
+            for migrator, bug, fields in jobs:
+                if len(pending) >= max_pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                pending.add(executor.submit(migrator.migrate_fields, bug, fields))
+            for future in pending:
+                future.result()
+
+    def jobs(self, bug_list):
+        '''
+        Fetch bugs like fetch(), yielding (this migrator, bug id, bug record) triples.
+        '''
+        for bug, fields in self.fetch(bug_list):
+            yield self, bug, fields
+
+    async def migrate_async(self, bug_list):
+        '''
+        Migrate bugs as coroutines sharing one aio.AsyncClient.
+        At most conf.async_concurrency bugs, and requests, are in flight at a time.
+        '''
+        async with aio.AsyncClient(self.conf.async_concurrency, self.conf.connect_timeout,
+                                   self.conf.read_timeout) as client:
+            client.use_cookies(self.conf.bugzilla_base_url)
+            pending = set()
+            batches = chunks(bug_list, self.conf.bugzilla_batch_size, STREAM_BATCH_WAIT)
+            loop = asyncio.get_event_loop()
+            while True:
+                # in a thread, since waiting on a stream must not hold up the requests
+                # in flight
+                batch = await loop.run_in_executor(None, next, batches, None)
+                if batch is None:
+                    break
+                if self.conf.offline:
+                    bugs = self.load_cached(batch)
+                else:
+                    print("Fetching {} bugs".format(len(batch)), file=sys.stderr)
+                    bugs = await aio.get_bugzilla_bugs(
+                        client, self.conf.bugzilla_base_url, batch,
+                        self.conf.attachment_memory_limit, self.store_cached)
+                for bug in batch:
+                    if len(pending) >= self.conf.async_concurrency:
+                        done, pending = await asyncio.wait(
+                            pending, return_when=asyncio.FIRST_COMPLETED)
+                        for task in done:
+                            task.result()
+                    pending.add(asyncio.ensure_future(
+                        self.migrate_fields_async(client, bug, bugs.pop(str(bug), None))))
+            for task in pending:
+                await task
+
+    def fetch(self, bug_list):
+        '''
+        Fetch bugs from Bugzilla in batches, yielding (bug id, bug record) pairs.
+        Bugs fetched as XML are stored in the bug cache; in offline mode they are read
+        from it.
+        '''
+        for batch in chunks(bug_list, self.conf.bugzilla_batch_size, STREAM_BATCH_WAIT):
+            if self.conf.offline:
+                bugs = self.load_cached(batch)
+            elif self.conf.bugzilla_backend == "rest":
+                print("Fetching {} bugs".format(len(batch)), file=sys.stderr)
+                with metrics.phase("bugzilla.fetch"):
+                    bugs = rest.get_bugzilla_bugs(self.conf.bugzilla_base_url, batch,
+                                                  self.conf.attachment_memory_limit,
+                                                  self.conf.bugzilla_api_key)
+            else:
+                print("Fetching {} bugs".format(len(batch)), file=sys.stderr)
+                bugs = get_bugzilla_bugs(self.conf.bugzilla_base_url, batch,
+                                         self.conf.attachment_memory_limit, self.store_cached)
+            for bug in batch:
+                # hand over the bug, so that it can be released as soon as it is migrated
+                yield bug, bugs.pop(str(bug), None)
+
+    def load_cached(self, batch):
+        bugs = {}
+        for bug in batch:
+            fields = self.cache.get(bug, self.conf.attachment_memory_limit)
+            if fields is None:
+                raise Exception("Bug {} is not in the bug cache, prefetch it first.".format(bug))
+            bugs[str(bug)] = fields
+        return bugs
+
+    def store_cached(self, bug, xml):
+        '''
+        Store the XML of a bug in the bug cache while it is being parsed.
+        '''
+        if self.cache and not bug.get("error"):
+            self.cache.put(bug, xml)
 
     def migrate_one(self, bugzilla_bug_id):
         '''
         Migrate a single bug from Bugzilla to GitLab.
         '''
+        for bug, fields in self.fetch([bugzilla_bug_id]):
+            self.migrate_fields(bug, fields)
+
+    def migrate_fields(self, bugzilla_bug_id, fields):
+        '''
+        Migrate a bug that has already been fetched from Bugzilla to GitLab.
+        '''
+        if not self.is_unchanged(fields):
+            issue_thread = self.load_issue_thread(bugzilla_bug_id, fields)
+            issue_thread.save()
+        if self.progress:
+            self.progress.update()
+
+    async def migrate_fields_async(self, client, bugzilla_bug_id, fields):
+        if not self.is_unchanged(fields):
+            issue_thread = self.load_issue_thread(bugzilla_bug_id, fields)
+            await issue_thread.save_async(client)
+        if self.progress:
+            self.progress.update()
+
+    def is_unchanged(self, fields):
+        '''
+        Whether a bug was migrated in its current version already, i.e. has nothing to sync.
+        '''
+        journal = self.conf.journal
+        if not journal or fields is None or fields.get("error"):
+            return False
+        project_id = self.conf.gitlab_project_id
+        state = journal.get_state(project_id, fields["bug_id"])
+        return (bool(state) and state[0] == format_utc(fields["delta_ts"])
+                and journal.is_done(project_id, fields["bug_id"]))
+
+    def load_issue_thread(self, bugzilla_bug_id, fields):
+        if fields is None or fields.get("error"):
+            error = "NotFound" if fields is None else fields.get("error")
+            raise Exception("Bug {} could not be fetched: {}".format(bugzilla_bug_id, error))
         print("Migrating bug {}".format(bugzilla_bug_id), file=sys.stderr)
-        fields = get_bugzilla_bug(self.conf.bugzilla_base_url, bugzilla_bug_id)
-        issue_thread = IssueThread(self.conf, fields)
-        issue_thread.save()
+        return IssueThread(self.conf, fields)
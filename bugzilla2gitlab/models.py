@@ -1,84 +1,223 @@
-import base64
-import re
+import hashlib
 import sys
+import threading
 
-from .utils import _perform_request, format_utc, markdown_table_row
+from .metrics import metrics
+from .utils import _perform_request, format_utc, map_row
 
-conf = None
+# Guards conf.gitlab_milestones, which is shared by all workers of a migration
+milestone_lock = threading.Lock()
+# Keeps the bug => issue lines printed by concurrent workers whole
+output_lock = threading.Lock()
 
 
-def name_or_text(fields, tag):
-    tag = fields.find(tag)
-    return tag.get("name") or tag.text
+def create_milestones(config, titles):
+    '''
+    Create the GitLab milestones among `titles` that do not exist yet, and add their ids
+    to conf.gitlab_milestones. Safe to call from several workers at the same time.
+    '''
+    url = "{}/projects/{}/milestones".format(config.gitlab_base_url, config.gitlab_project_id)
+    with milestone_lock:
+        for title in titles:
+            if title in config.gitlab_milestones:
+                continue
+            response = _perform_request(url, "post", headers=config.default_headers,
+                                        data={"title": title}, dry_run=config.dry_run)
+            config.gitlab_milestones[title] = response["id"] if response else None
+
+
+def needs_link(config, bug_id, num, text, linked):
+    '''
+    Whether the description (num 0) or comment `num` of a bug must be updated for its
+    references to other bugs to be rewritten: `text` is the text as it was migrated, and
+    `linked` the same with the references rewritten. Texts that were rewritten before are
+    only updated again if their references changed since.
+    '''
+    sha256 = config.journal.get_link(config.gitlab_project_id, bug_id, num)
+    if sha256 is None:
+        return linked != text
+    return hashlib.sha256(linked.encode("utf-8")).hexdigest() != sha256
+
+
+def record_link(config, bug_id, num, linked):
+    config.journal.record_link(config.gitlab_project_id, bug_id, num,
+                               hashlib.sha256(linked.encode("utf-8")).hexdigest())
 
 
 class IssueThread(object):
     '''
     Everything related to an issue in GitLab, e.g. the issue itself and subsequent comments.
     '''
-    def __init__(self, config, fields):
-        global conf
-        conf = config
-        self.load_objects(fields)
+    __slots__ = ("conf", "issue", "comments")
+
+    def __init__(self, config, bug):
+        self.conf = config
+        self.load_objects(bug)
 
-    def load_objects(self, fields):
+    def load_objects(self, bug):
         '''
-        Load the issue object and the comment objects.
-        If conf.dry_run=False, then Attachments are created in GitLab in this step.
+        Load the issue object and the comment objects from a bug record (see records.py).
+        No requests are made in this step, attachments are uploaded by save().
         '''
-        self.issue = Issue(fields)
+        self.issue = Issue(self.conf, bug)
         self.comments = []
         '''
-        fields["long_desc"] gets peared down in Issue creation (above). This is because bugzilla
+        The first comment may be harvested in Issue creation (above). This is because bugzilla
         lacks the concept of an issue description, so the first comment is harvested for
         the issue description, as well as any subsequent comments that are simply attachments
         from the original reporter. What remains below should be a list of genuine comments.
         '''
+        comments = bug["comments"][1:] if self.issue.text else bug["comments"]
+        for i, comment in enumerate(comments):
+            self.comments.append(Comment(self.conf, i + 1, bug, comment))
+
+    def upload_attachments(self):
+        '''
+        Upload the attachments referenced by the issue and the comments,
+        and render the links to them.
+        '''
+        for model in [self.issue] + self.comments:
+            if model.attachment:
+                model.attachment.save()
+                model.render()
 
-        for i, comment in enumerate(fields.findall("long_desc")):
-            self.comments.append(Comment(i + 1, fields, comment))
+    async def upload_attachments_async(self, client):
+        for model in [self.issue] + self.comments:
+            if model.attachment:
+                await model.attachment.save_async(client)
+                model.render()
 
     def save(self):
         '''
-        Save the issue and all of the comments to GitLab.
+        Save the issue and all of the comments to GitLab, or to conf.export.
         If conf.dry_run=True, then only the HTTP request that would be made is printed.
         '''
+        self.upload_attachments()
+        if self.conf.export:
+            for comment in self.comments:
+                comment.issue_id = self.issue.iid
+            self.conf.export.add_issue(self.issue, self.comments, self.is_resolved())
+            return
+
         self.issue.save()
+        self.save_comments()
+        self.finish()
 
+    def save_comments(self):
         for comment in self.comments:
             comment.issue_id = self.issue.id
             comment.save()
 
+    def finish(self):
+        '''
+        The last step of save(), after the issue and the comments were saved.
+        '''
         # close the issue in GitLab, if it is resolved in Bugzilla
-        if self.issue.status in conf.bugzilla_closed_states:
+        if self.is_resolved():
             self.issue.close()
+        # apply the changes of a bug that was migrated before, see Migrator.sync
+        self.issue.update(reopen=not self.is_resolved())
+
+        self.done()
+
+    async def save_async(self, client):
+        '''
+        Same as save(), with requests made through an aio.AsyncClient.
+        '''
+        await self.upload_attachments_async(client)
+        await self.issue.save_async(client)
+
+        for comment in self.comments:
+            comment.issue_id = self.issue.id
+            await comment.save_async(client)
+
+        if self.is_resolved():
+            await self.issue.close_async(client)
+        await self.issue.update_async(client, reopen=not self.is_resolved())
+
+        self.done()
+
+    def link_references(self, index):
+        '''
+        Rewrite the references to other bugs in the description of the issue and in the
+        comments, that were migrated already, into references to the issues of those bugs
+        (see references.ReferenceIndex). Only the texts that change are updated.
+        Returns the number of updates.
+        '''
+        issue = self.issue
+        if not issue.resume():
+            return 0
+        unlinked = set()
+        for model in [issue] + self.comments:
+            # the links of the uploads, as they were migrated
+            if model.attachment:
+                if model.attachment.resume():
+                    model.render()
+                else:
+                    # the link of the upload is not known, so the text is left as it is
+                    model.attachment.close()
+                    unlinked.add(model)
+        updates = 0
+        if issue not in unlinked:
+            updates += issue.link(index)
+        for comment in self.comments:
+            comment.issue_id = issue.id
+            if comment not in unlinked and comment.resume():
+                updates += comment.link(index)
+        return updates
+
+    def is_resolved(self):
+        '''
+        Whether the bug is resolved in Bugzilla.
+        '''
+        return self.issue.status in self.conf.bugzilla_closed_states
+
+    def done(self):
+        journal = self.conf.journal
+        if journal:
+            issue = self.issue
+            journal.record_done(self.conf.gitlab_project_id, issue.iid)
+            journal.record_state(self.conf.gitlab_project_id, issue.iid, issue.updated_at,
+                                 issue.labels, issue.milestone or "")
 
 
 class Issue(object):
     '''
     The issue model
     '''
+    __slots__ = ("conf", "headers", "iid", "id", "title", "created_at", "updated_at", "status",
+                 "labels", "assignee_ids", "milestone", "milestone_id", "table", "text",
+                 "attachment", "description")
     required_fields = ["title", "description"]
-    data_fields = ["created_at", "title", "description", "assignee_ids", "milestone_id",
-                   "labels", "iid"]
-
-    def __init__(self, bugzilla_fields):
-        self.headers = conf.default_headers
-        self.load_fields(bugzilla_fields)
-
-    def load_fields(self, fields):
-        self.iid = fields.findtext("bug_id")
-        self.title = fields.findtext("short_desc")
-        self.created_at = format_utc(fields.findtext("creation_ts"))
-        self.updated_at = format_utc(fields.findtext("delta_ts"))
-        self.status = fields.findtext("bug_status")
-        self.create_labels(fields.findtext("keywords"))
-        milestone = fields.findtext("target_milestone")
-        if conf.map_milestones and milestone not in conf.milestones_to_skip:
-            self.create_milestone(milestone)
-        self.create_description(fields)
+
+    def __init__(self, config, bug):
+        self.conf = config
+        self.headers = config.default_headers
+        self.load_fields(bug)
+
+    @metrics.timed("issue.load_fields")
+    def load_fields(self, bug):
+        self.iid = bug["bug_id"]
+        self.id = None
+        self.title = bug.get("short_desc")
+        self.created_at = format_utc(bug["creation_ts"])
+        self.updated_at = format_utc(bug["delta_ts"])
+        self.status = bug.get("bug_status")
+        self.create_labels(bug.get("keywords"))
+        assignee = self.conf.bugzilla_users.get(bug.get("assigned_to_login"))
+        self.assignee_ids = [self.conf.gitlab_users[assignee]] if assignee else None
+        milestone = bug.get("target_milestone")
+        self.milestone = None
+        self.milestone_id = None
+        if self.conf.map_milestones and milestone not in self.conf.milestones_to_skip:
+            self.milestone = milestone
+            # an export refers to milestones by title
+            if not self.conf.export:
+                self.create_milestone(milestone)
+        self.create_description(bug)
 
     def create_labels(self, keywords):
+        conf = self.conf
         labels = []
         if conf.default_gitlab_labels:
             labels.extend(conf.default_gitlab_labels)
@@ -95,79 +234,35 @@ class Issue(object):
     def create_milestone(self, milestone):
         '''
         Looks up milestone id given its title or creates a new one.
+        Migrator.create_milestones creates them upfront, so this is normally only a lookup.
         '''
-        if milestone not in conf.gitlab_milestones:
-            url = "{}/projects/{}/milestones".format(conf.gitlab_base_url, conf.gitlab_project_id)
-            response = _perform_request(
-                url, "post", headers=self.headers, data={"title": milestone})
-            conf.gitlab_milestones[milestone] = response["id"]
-
-        self.milestone_id = conf.gitlab_milestones[milestone]
-
-    def create_description(self, fields):
-        '''
-        An opinionated description body creator.
-        '''
-        ext_description = ""
-
-        # markdown table header
-        self.description = markdown_table_row("", "")
-        self.description += markdown_table_row("---", "---")
-
-        self.description += markdown_table_row("Bugzilla ID", self.iid)
-        aliases = [i.text for i in fields.findall("alias")]
-        if any(aliases):
-            self.description += markdown_table_row("Alias(es)", ", ".join(aliases))
-
-        reporter = name_or_text(fields, "reporter")
-        self.description += markdown_table_row("Reporter", reporter)
-        assignee = name_or_text(fields, "assigned_to")
-        if assignee:
-            self.description += markdown_table_row("Assignee", assignee)
-        self.description += markdown_table_row("Reported", fields.findtext("creation_ts"))
-        self.description += markdown_table_row("Modified", fields.findtext("delta_ts"))
-        self.description += markdown_table_row(
-            "Status",
-            fields.findtext("bug_status") + " " + fields.findtext("resolution"),
-        )
-
-        self.description += markdown_table_row("Version", fields.findtext("version"))
-        self.description += markdown_table_row(
-            "Hardware",
-            fields.findtext("op_sys") + " / " + fields.findtext("rep_platform"),
-        )
-        self.description += markdown_table_row(
-            "Importance",
-            fields.findtext("priority") + " / " + fields.findtext("bug_severity"),
-        )
-        package = fields.findtext("cf_package")
-        if package:
-            self.description += markdown_table_row("Package(s)", package)
-        url = fields.findtext("bug_file_loc")
-        if url:
-            self.description += markdown_table_row("URL", url)
-        blocks = [f"https://bts.adelielinux.org/show_bug.cgi?id={i.text}" for i in fields.findall("blocked")]
-        if any(blocks):
-            self.description += markdown_table_row("Blocks", "<br>".join(blocks))
-        depends = [f"https://bts.adelielinux.org/show_bug.cgi?id={i.text}" for i in fields.findall("dependson")]
-        if any(depends):
-            self.description += markdown_table_row("Depends on", "<br>".join(depends))
-        see_also = [i.text for i in fields.findall("see_also")]
-        if any(see_also):
-            self.description += markdown_table_row("See also", "<br>".join(see_also))
-
-        comment0 = fields.find("long_desc")
-        if (reporter == name_or_text(comment0, "who") and comment0.findtext("thetext")):
-            ext_description += "\n## Description\n\n"
-            text = comment0.findtext("thetext").split("\n")
-            attachid = comment0.findtext("attachid")
-            if text and text[0].startswith("Created attachment") and attachid:
-                text[0] = Attachment.from_bug(fields, attachid)
-            ext_description += "  \n".join(text)
-            fields.remove(comment0)
-
-        if ext_description:
-            self.description += ext_description
+        if milestone not in self.conf.gitlab_milestones:
+            create_milestones(self.conf, [milestone])
+        self.milestone_id = self.conf.gitlab_milestones[milestone]
+
+    def create_description(self, bug):
+        '''
+        The description of the issue: a table of the fields of the bug (see
+        conf.description_table), followed by the first comment if the reporter wrote it.
+        '''
+        self.table = self.conf.body_format.table(bug)
+        self.text = None
+        self.attachment = None
+        comment0 = bug["comments"][0] if bug["comments"] else {}
+        if bug.get("reporter") == comment0.get("who") and comment0.get("thetext"):
+            self.text = comment0["thetext"]
+            attachid = comment0.get("attachid")
+            if self.text.startswith("Created attachment") and attachid:
+                self.attachment = Attachment.from_bug(self.conf, bug, attachid)
+
+        self.render()
+
+    def render(self):
+        '''
+        Append the first comment, if harvested, to the description table.
+        '''
+        link = self.attachment.markdown() if self.attachment else None
+        self.description = self.conf.body_format.description(self.table, self.text, link)
 
     def validate(self):
         for field in self.required_fields:
@@ -176,32 +271,202 @@ class Issue(object):
                 raise Exception("Missing value for required field: {}".format(field))
         return True
 
-    def save(self):
+    def save_request(self):
+        conf = self.conf
         self.validate()
         url = "{}/projects/{}/issues".format(conf.gitlab_base_url, conf.gitlab_project_id)
-        data = {k: v for k, v in self.__dict__.items() if k in self.data_fields}
+        return url, "post", dict(headers=self.headers, data=self.payload(), json=True,
+                                 dry_run=conf.dry_run)
+
+    def payload(self):
+        '''
+        The fields of the issue created in GitLab.
+        '''
+        data = {"iid": self.iid, "title": self.title, "description": self.description,
+                "created_at": self.created_at, "labels": self.labels}
+        if self.assignee_ids is not None:
+            data["assignee_ids"] = self.assignee_ids
+        if self.milestone_id is not None:
+            data["milestone_id"] = self.milestone_id
+        return data
+
+    @metrics.timed("issue.save")
+    def save(self):
+        if self.resume():
+            return
+        request = self.find_request()
+        if request:
+            url, method, kwargs = request
+            if self.found(_perform_request(url, method, **kwargs)):
+                return
+        url, method, kwargs = self.save_request()
+        self.saved(_perform_request(url, method, **kwargs))
+
+    @metrics.timed("issue.save")
+    async def save_async(self, client):
+        if self.resume():
+            return
+        request = self.find_request()
+        if request:
+            url, method, kwargs = request
+            if self.found(await client.perform_request(url, method, **kwargs)):
+                return
+        url, method, kwargs = self.save_request()
+        self.saved(await client.perform_request(url, method, **kwargs))
+
+    def resume(self):
+        '''
+        Pick up the issue from the journal, if an earlier run already created it.
+        '''
+        journal = self.conf.journal
+        iid = journal.get_issue(self.conf.gitlab_project_id, self.iid) if journal else None
+        if iid:
+            self.id = iid
+        return bool(iid)
+
+    def find_request(self):
+        '''
+        The request looking for the issue in GitLab, or None without a journal (i.e. when
+        the migration cannot be resumed anyway). An earlier run may have created the
+        issue without recording it, if the response to its creation was lost.
+        '''
+        conf = self.conf
+        if not conf.journal:
+            return None
+        url = "{}/projects/{}/issues".format(conf.gitlab_base_url, conf.gitlab_project_id)
+        return url, "get", dict(headers=self.headers, params={"iids[]": [self.iid]})
 
-        response = _perform_request(url, "post", headers=self.headers, data=data, json=True,
-                                    dry_run=conf.dry_run)
+    def found(self, issues):
+        '''
+        Pick up the issue found by find_request(), if any. It must have been migrated from
+        this bug, i.e. have its title and a description starting with its table.
+        '''
+        if not issues:
+            return False
+        issue = issues[0]
+        if (issue.get("title") != self.title
+                or not (issue.get("description") or "").startswith(self.table)):
+            raise Exception("Issue {} of project {} exists and was not migrated from bug {}"
+                            .format(self.iid, self.conf.gitlab_project_id, self.iid))
+        self.saved(issue)
+        return True
 
+    def saved(self, response):
+        conf = self.conf
         if conf.dry_run:
             # assign a random number so that program can continue
             self.id = 5
             return
 
         self.id = response["iid"]
-        print(f"https://bts.adelielinux.org/show_bug.cgi?id={self.iid},https://git.adelielinux.org/adelie-infra/infra-docs/-/issues/{self.id}")
-        sys.stdout.flush()
-
-    def close(self):
+        if conf.journal:
+            conf.journal.record_issue(conf.gitlab_project_id, self.iid, self.id,
+                                      response["web_url"])
+        with output_lock:
+            print(map_row(conf.bugzilla_base_url, self.iid, response["web_url"]))
+            sys.stdout.flush()
+
+    def close_request(self):
+        conf = self.conf
         url = "{}/projects/{}/issues/{}".format(conf.gitlab_base_url, conf.gitlab_project_id,
                                                 self.id)
         data = {
             "state_event": "close",
             "updated_at": self.updated_at,
         }
+        return url, "put", dict(headers=self.headers, data=data, dry_run=conf.dry_run)
 
-        _perform_request(url, "put", headers=self.headers, data=data, dry_run=conf.dry_run)
+    @metrics.timed("issue.close")
+    def close(self):
+        if self.is_closed():
+            return
+        url, method, kwargs = self.close_request()
+        _perform_request(url, method, **kwargs)
+        self.closed()
+
+    @metrics.timed("issue.close")
+    async def close_async(self, client):
+        if self.is_closed():
+            return
+        url, method, kwargs = self.close_request()
+        await client.perform_request(url, method, **kwargs)
+        self.closed()
+
+    def is_closed(self):
+        journal = self.conf.journal
+        return bool(journal) and journal.is_closed(self.conf.gitlab_project_id, self.iid)
+
+    def closed(self):
+        if self.conf.journal:
+            self.conf.journal.record_close(self.conf.gitlab_project_id, self.iid)
+
+    def update_request(self, reopen):
+        '''
+        The request applying the changes of labels and milestone since the bug was last
+        migrated, and reopening its issue if `reopen`, or None if there are none.
+        '''
+        conf = self.conf
+        state = conf.journal.get_state(conf.gitlab_project_id, self.iid) if conf.journal else None
+        data = {}
+        if state:
+            _, labels, milestone = state
+            if labels != self.labels:
+                data["labels"] = self.labels
+            if milestone != (self.milestone or ""):
+                # 0 removes the milestone
+                data["milestone_id"] = self.milestone_id if self.milestone else 0
+        if reopen and self.is_closed():
+            data["state_event"] = "reopen"
+        if not data:
+            return None
+        data["updated_at"] = self.updated_at
+        url = "{}/projects/{}/issues/{}".format(conf.gitlab_base_url, conf.gitlab_project_id,
+                                                self.id)
+        return url, "put", dict(headers=self.headers, data=data, dry_run=conf.dry_run)
+
+    @metrics.timed("issue.update")
+    def update(self, reopen):
+        request = self.update_request(reopen)
+        if request:
+            url, method, kwargs = request
+            _perform_request(url, method, **kwargs)
+            self.updated(kwargs["data"])
+
+    @metrics.timed("issue.update")
+    async def update_async(self, client, reopen):
+        request = self.update_request(reopen)
+        if request:
+            url, method, kwargs = request
+            await client.perform_request(url, method, **kwargs)
+            self.updated(kwargs["data"])
+
+    def updated(self, data):
+        if self.conf.journal and "state_event" in data:
+            self.conf.journal.record_reopen(self.conf.gitlab_project_id, self.iid)
+
+    def link_request(self, index):
+        '''
+        The request replacing the references to other bugs in the description with
+        references to their issues, or None if there is nothing to update.
+        '''
+        conf = self.conf
+        description = index.rewrite(self.description, conf.gitlab_project_id)
+        if not needs_link(conf, self.iid, 0, self.description, description):
+            return None
+        self.description = description
+        url = "{}/projects/{}/issues/{}".format(conf.gitlab_base_url, conf.gitlab_project_id,
+                                                self.id)
+        data = {"description": description, "updated_at": self.updated_at}
+        return url, "put", dict(headers=self.headers, data=data, dry_run=conf.dry_run)
+
+    @metrics.timed("issue.link")
+    def link(self, index):
+        request = self.link_request(index)
+        if request:
+            url, method, kwargs = request
+            _perform_request(url, method, **kwargs)
+            record_link(self.conf, self.iid, 0, self.description)
+        return bool(request)
 
 
 class Comment(object):
@@ -209,25 +474,35 @@ class Comment(object):
     The comment model
     '''
 
+    __slots__ = ("conf", "num", "headers", "bug_id", "issue_id", "id", "created_at", "header",
+                 "text", "attachment", "body")
     required_fields = ["body", "issue_id"]
-    data_fields = ["created_at", "body"]
 
-    def __init__(self, num, bug, comment):
+    def __init__(self, config, num, bug, comment):
+        self.conf = config
         self.num = num
-        self.headers = conf.default_headers
+        self.headers = config.default_headers
         self.load_fields(bug, comment)
 
-    def load_fields(self, bug, fields):
-        self.created_at = format_utc(fields.findtext("bug_when"))
-        who = name_or_text(fields, "who")
-        when = fields.findtext("bug_when")
-        self.body = f"**Comment {self.num} by \"{who}\" on {when}**\n\n"
-
-        text = fields.findtext("thetext").split("\n")
-        attachid = fields.findtext("attachid")
-        if text and text[0].startswith("Created attachment") and attachid:
-            text[0] = Attachment.from_bug(bug, attachid)
-        self.body += "  \n".join(text)
+    @metrics.timed("comment.load_fields")
+    def load_fields(self, bug, comment):
+        self.bug_id = bug["bug_id"]
+        self.issue_id = None
+        self.id = None
+        self.created_at = format_utc(comment["bug_when"])
+        self.header = self.conf.body_format.comment_header.format(
+            num=self.num, who=comment.get("who"), bug_when=comment["bug_when"])
+
+        self.text = comment.get("thetext", "")
+        self.attachment = None
+        attachid = comment.get("attachid")
+        if self.text.startswith("Created attachment") and attachid:
+            self.attachment = Attachment.from_bug(self.conf, bug, attachid)
+        self.render()
+
+    def render(self):
+        link = self.attachment.markdown() if self.attachment else None
+        self.body = self.conf.body_format.comment(self.header, self.text, link)
 
     def validate(self):
         for field in self.required_fields:
@@ -235,43 +510,180 @@ class Comment(object):
             if not value:
                 raise Exception("Missing value for required field: {}".format(field))
 
-    def save(self):
+    def save_request(self):
+        conf = self.conf
         self.validate()
         url = "{}/projects/{}/issues/{}/notes".format(conf.gitlab_base_url, conf.gitlab_project_id,
                                                       self.issue_id)
-        data = {k: v for k, v in self.__dict__.items() if k in self.data_fields}
+        return url, "post", dict(headers=self.headers, data=self.payload(), json=True,
+                                 dry_run=conf.dry_run)
 
-        _perform_request(url, "post", headers=self.headers, data=data, json=True,
-                         dry_run=conf.dry_run)
+    def payload(self):
+        '''
+        The fields of the note posted to GitLab.
+        '''
+        return {"created_at": self.created_at, "body": self.body}
+
+    @metrics.timed("comment.save")
+    def save(self):
+        if self.resume():
+            return
+        url, method, kwargs = self.save_request()
+        self.saved(_perform_request(url, method, **kwargs))
+
+    @metrics.timed("comment.save")
+    async def save_async(self, client):
+        if self.resume():
+            return
+        url, method, kwargs = self.save_request()
+        self.saved(await client.perform_request(url, method, **kwargs))
+
+    def resume(self):
+        '''
+        Skip the comment if an earlier run already posted it.
+        '''
+        journal = self.conf.journal
+        self.id = journal.get_note(self.conf.gitlab_project_id, self.bug_id,
+                                   self.num) if journal else None
+        return bool(self.id)
+
+    def saved(self, response):
+        if self.conf.dry_run:
+            return
+        self.id = response["id"]
+        if self.conf.journal:
+            self.conf.journal.record_note(self.conf.gitlab_project_id, self.bug_id, self.num,
+                                          self.id)
+
+    def link_request(self, index):
+        '''
+        The request replacing the references to other bugs in the body of the comment,
+        or None if there is nothing to update.
+        '''
+        conf = self.conf
+        body = index.rewrite(self.body, conf.gitlab_project_id)
+        if not needs_link(conf, self.bug_id, self.num, self.body, body):
+            return None
+        self.body = body
+        url = "{}/projects/{}/issues/{}/notes/{}".format(
+            conf.gitlab_base_url, conf.gitlab_project_id, self.issue_id, self.id)
+        return url, "put", dict(headers=self.headers, data={"body": body},
+                                dry_run=conf.dry_run)
+
+    @metrics.timed("comment.link")
+    def link(self, index):
+        request = self.link_request(index)
+        if request:
+            url, method, kwargs = request
+            _perform_request(url, method, **kwargs)
+            record_link(self.conf, self.bug_id, self.num, self.body)
+        return bool(request)
 
 
 class Attachment(object):
     '''
     The attachment model
     '''
-    def __init__(self, attachment):
-        self.id = attachment.findtext("attachid")
-        self.filename = attachment.findtext("filename")
-        self.obsolete = attachment.get("isobsolete") == "1"
-        data = attachment.find("data")
-        encoding = data.get("encoding")
+    __slots__ = ("conf", "bug_id", "id", "filename", "obsolete", "record", "content", "size",
+                 "sha256", "link", "headers")
+
+    def __init__(self, config, bug_id, attachment):
+        self.conf = config
+        self.bug_id = bug_id
+        self.id = attachment["attachid"]
+        self.filename = attachment.get("filename")
+        self.obsolete = attachment["isobsolete"]
+        encoding = attachment["encoding"]
         if encoding != "base64":
-            raise ValueError(encoding + " encoding is not supported")
-        self.content = base64.standard_b64decode(data.text)
-        self.headers = conf.default_headers
+            raise ValueError("{} encoding is not supported".format(encoding))
+        self.record = attachment
+        self.content = None
+        self.link = None
+        self.headers = config.default_headers
 
-    def save(self):
+    def load(self):
+        '''
+        Get the decoded data of the attachment, with its size and SHA-256. Records parsed
+        from XML hold it already (in a temporary file if it is larger than
+        conf.attachment_memory_limit); with the REST backend, it is downloaded now.
+        '''
+        if self.content is None:
+            self.content = self.record["content"]()
+            self.size = self.record["size"]
+            self.sha256 = self.record["sha256"]
+        return self.content
+
+    def close(self):
+        if self.content is not None:
+            self.content.close()
+
+    def save_request(self):
+        conf = self.conf
         url = "{}/projects/{}/uploads".format(conf.gitlab_base_url, conf.gitlab_project_id)
-        f = {"file": (self.filename, self.content)}
-        attachment = _perform_request(url, "post", headers=self.headers, files=f, json=True,
-                                      dry_run=conf.dry_run)
+        f = {"file": (self.filename, self.load())}
+        return url, "post", dict(headers=self.headers, files=f, json=True, dry_run=conf.dry_run)
+
+    @metrics.timed("attachment.save")
+    def save(self):
+        if self.conf.export:
+            self.load()
+            self.link = self.conf.export.add_upload(self.filename, self.content, self.size,
+                                                    self.sha256)
+            self.close()
+            return self.link
+        if self.resume():
+            return self.link
+        url, method, kwargs = self.save_request()
+        return self.saved(_perform_request(url, method, **kwargs))
+
+    @metrics.timed("attachment.save")
+    async def save_async(self, client):
+        if self.resume():
+            return self.link
+        url, method, kwargs = self.save_request()
+        return self.saved(await client.perform_request(url, method, **kwargs))
+
+    def resume(self):
+        '''
+        Reuse the upload of this attachment by an earlier run, or the upload of an
+        identical file (same content and name) to the same project, if any.
+        '''
+        conf = self.conf
+        if not conf.journal:
+            return False
+        self.link = conf.journal.get_attachment(conf.gitlab_project_id, self.bug_id, self.id)
+        if self.link is None:
+            self.load()
+            self.link = conf.journal.get_upload(conf.gitlab_project_id, self.sha256,
+                                                self.filename)
+            if self.link is not None:
+                conf.journal.record_attachment(conf.gitlab_project_id, self.bug_id, self.id,
+                                               self.link)
+        if self.link is not None:
+            self.close()
+        return self.link is not None
+
+    def saved(self, attachment):
+        conf = self.conf
         # For dry run, nothing is uploaded, so upload link is faked just to let the process continue
-        return "" if conf.dry_run else attachment["url"]
+        self.link = "" if conf.dry_run else attachment["url"]
+        if conf.journal and not conf.dry_run:
+            conf.journal.record_upload(conf.gitlab_project_id, self.sha256, self.filename,
+                                       self.link, self.size)
+            conf.journal.record_attachment(conf.gitlab_project_id, self.bug_id, self.id,
+                                           self.link)
+        self.close()
+        return self.link
+
+    def markdown(self):
+        if self.obsolete:
+            return f"**Created ~~[attachment {self.id}]({self.link})~~**"
+        return f"**Created [attachment {self.id}]({self.link})**"
 
     @classmethod
-    def from_bug(cls, bug, attachid):
-        attachment = cls(bug.find(f"attachment[attachid='{attachid}']"))
-        attachlink = attachment.save()
-        if attachment.obsolete:
-            return f"**Created ~~[attachment {attachid}]({attachlink})~~**"
-        return f"**Created [attachment {attachid}]({attachlink})**"
+    def from_bug(cls, config, bug, attachid):
+        attachment = bug["attachments"].get(attachid)
+        if attachment is None:
+            raise Exception("Attachment {} is not part of bug {}".format(
+                attachid, bug["bug_id"]))
+        return cls(config, bug["bug_id"], attachment)
@@ -0,0 +1,104 @@
+'''
+Stages of worker threads connected by bounded queues, so that the Bugzilla requests,
+the rendering and the GitLab requests of different bugs overlap.
+'''
+import queue
+import threading
+
+# Passed down a queue once per worker of the next stage when a stage is finished
+_DONE = object()
+# How often, in seconds, a blocked worker checks whether the pipeline was stopped
+_POLL_INTERVAL = 0.1
+
+
+class Pipeline(object):
+    '''
+    A pipeline of stages, each run by its own threads. A stage is a function taking an
+    item from the queue of the stage and returning the items for the next stage (an
+    iterable, e.g. from a generator function, or None). The queue in front of each stage
+    holds at most `queue_size` items, so a fast stage blocks instead of running ahead of
+    a slower one, and the total time approaches that of the slowest stage.
+    If a stage raises, the pipeline stops and run() raises the exception.
+    '''
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.stages = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.error = None
+
+    def add_stage(self, name, func, workers=1):
+        self.stages.append((name, func, max(1, workers)))
+
+    def run(self, items):
+        '''
+        Pass every item of `items` through all stages, and wait for the last one.
+        '''
+        inboxes = [queue.Queue(self.queue_size) for _ in self.stages]
+        live = [workers for _, _, workers in self.stages]
+        threads = []
+        for i, (name, func, workers) in enumerate(self.stages):
+            for n in range(workers):
+                thread = threading.Thread(target=self._work, name="{}-{}".format(name, n),
+                                          args=(i, func, inboxes, live), daemon=True)
+                thread.start()
+                threads.append(thread)
+        try:
+            for item in items:
+                if not self._put(inboxes[0], item):
+                    break
+        except BaseException as e:
+            self._fail(e)
+        for _ in range(self.stages[0][2]):
+            self._put(inboxes[0], _DONE)
+        for thread in threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _work(self, i, func, inboxes, live):
+        outbox = inboxes[i + 1] if i + 1 < len(inboxes) else None
+        while True:
+            item = self._get(inboxes[i])
+            if item is _DONE:
+                break
+            try:
+                for result in func(item) or ():
+                    if outbox is not None and not self._put(outbox, result):
+                        break
+            except BaseException as e:
+                self._fail(e)
+                break
+        with self.lock:
+            live[i] -= 1
+            last = live[i] == 0
+        if last and outbox is not None:
+            for _ in range(self.stages[i + 1][2]):
+                self._put(outbox, _DONE)
+
+    def _get(self, inbox):
+        while not self.stopped.is_set():
+            try:
+                return inbox.get(timeout=_POLL_INTERVAL)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _put(self, outbox, item):
+        '''
+        Put an item into a queue, waiting while it is full. Returns False if the
+        pipeline was stopped instead.
+        '''
+        while not self.stopped.is_set():
+            try:
+                outbox.put(item, timeout=_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _fail(self, error):
+        with self.lock:
+            if self.error is None:
+                self.error = error
+        self.stopped.set()
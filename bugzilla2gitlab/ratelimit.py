@@ -0,0 +1,122 @@
+'''
+Pacing and retrying of HTTP requests according to the rate limits announced by GitLab.
+'''
+from email.utils import parsedate_to_datetime
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+
+class RateGovernor(object):
+    '''
+    Spreads requests to a host evenly over its remaining rate limit budget
+    (RateLimit-Remaining / RateLimit-Reset), holds a host back for as long as it
+    asks (Retry-After), and decides which failed requests may be retried.
+    Shared by all threads; the counters report how often requests were throttled
+    (HTTP 429) and retried.
+    '''
+    # Statuses of requests that were not processed, or that may succeed if repeated
+    retry_statuses = [429, 500, 502, 503, 504]
+    # Methods that are safe to repeat even if the failed request reached the server
+    idempotent_methods = ["get", "head", "put", "delete", "options"]
+
+    def __init__(self, max_retries=5, backoff=1.0, max_backoff=60.0):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        # host => (earliest start of the next request, seconds between requests)
+        self.hosts = {}
+        self.throttles = 0
+        self.retries = 0
+
+    def delay(self, url):
+        '''
+        Reserve the next request slot for the host of `url`.
+        Returns the number of seconds the caller has to wait before sending it.
+        '''
+        host = urlsplit(url).netloc
+        now = time.monotonic()
+        with self.lock:
+            start, interval = self.hosts.get(host, (now, 0))
+            start = max(start, now)
+            self.hosts[host] = (start + interval, interval)
+        return start - now
+
+    def update(self, url, headers):
+        '''
+        Adjust the pace of requests to the host of `url` to its rate limit headers.
+        '''
+        host = urlsplit(url).netloc
+        now = time.monotonic()
+        hold = None
+        interval = 0
+
+        remaining = headers.get("RateLimit-Remaining")
+        reset = headers.get("RateLimit-Reset")
+        if remaining is not None and reset is not None:
+            try:
+                window = max(0.0, float(reset) - time.time())
+                remaining = int(remaining)
+            except ValueError:
+                pass
+            else:
+                if remaining <= 0:
+                    hold = now + window
+                else:
+                    interval = window / remaining
+
+        retry_after = _retry_after(headers.get("Retry-After"))
+        if retry_after is not None:
+            hold = max(hold or now, now + retry_after)
+
+        with self.lock:
+            start, _ = self.hosts.get(host, (now, 0))
+            if hold is not None:
+                start = max(start, hold)
+            self.hosts[host] = (start, interval)
+
+    def retry_delay(self, method, status, attempt, headers={}):
+        '''
+        Decide whether a failed request may be retried. `status` is None when no
+        response was received. Returns the number of seconds to back off before
+        retrying, or None if the request must not be retried.
+        '''
+        if attempt >= self.max_retries:
+            return None
+        if status == 429:
+            # throttled requests were rejected without being processed
+            with self.lock:
+                self.throttles += 1
+        elif method not in self.idempotent_methods or (
+                status is not None and status not in self.retry_statuses):
+            return None
+
+        with self.lock:
+            self.retries += 1
+        if "Retry-After" in headers:
+            # update() already holds the host back for as long as requested
+            return 0
+        # exponential backoff with "equal jitter"
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)  # nosec
+
+    def stats(self):
+        return {"throttles": self.throttles, "retries": self.retries}
+
+
+def _retry_after(value):
+    '''
+    Parse a Retry-After header, given in seconds or as an HTTP date.
+    '''
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,280 @@
+'''
+Compact records of Bugzilla bugs, built from Bugzilla XML in a single streaming pass.
+
+A bug record is a dictionary of the bug's fields, keyed by their Bugzilla XML tag:
+- single-valued fields map to their text ("" when empty),
+- the fields in MULTI_VALUED map to lists of texts,
+- the users in USER_FIELDS map to their real name, falling back to their login,
+  with the login itself under "<field>_login",
+- "comments" is the list of comment records, oldest first,
+- "attachments" maps attachids to attachment records.
+Comment records hold the fields of a <long_desc> in the same way. Attachment records
+hold the fields of an <attachment>, with "isobsolete" as a boolean and "content"
+as a function returning the decoded data as a binary file, or None if no comment
+refers to the attachment.
+'''
+import base64
+import hashlib
+import io
+import tempfile
+# only assembles the elements parsed by defusedxml's DefusedXMLParser, see BugParser
+from xml.etree.ElementTree import TreeBuilder  # nosec B405
+
+from defusedxml import ElementTree
+
+MULTI_VALUED = ["alias", "blocked", "dependson", "see_also", "cc", "group"]
+USER_FIELDS = ["reporter", "assigned_to", "qa_contact", "who"]
+
+# The size of the reads from a source file
+READ_SIZE = 1 << 16
+
+
+def iterparse_bugs(source, memory_limit, on_element=None):
+    '''
+    Parse Bugzilla XML from `source`, a binary file or an iterable of chunks of bytes (the
+    output of show_bug.cgi?ctype=xml for any number of bugs, or a dump of a whole
+    Bugzilla), one bug at a time, yielding bug records. Attachment data is decoded while
+    it is parsed, see BugParser.
+    Each <bug> element, without its attachment data, is passed to `on_element` along with
+    the XML of the bug as read from `source`, as an iterable of chunks of bytes.
+    '''
+    chunks = source
+    if hasattr(source, "read"):
+        chunks = iter(lambda: source.read(READ_SIZE), b"")
+    parser = BugParser(memory_limit, on_element)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.finish()
+
+
+class BugParser(object):
+    '''
+    The target of an XML parser, building the elements of one <bug> at a time into a bug
+    record. The text of <data encoding="base64"> elements is never kept: it is decoded as
+    it is parsed into a temporary file, and the file is kept in memory as long as the
+    attachments decoded from the source fit in `memory_limit` bytes, and spooled to disk
+    otherwise. Attachments that no comment of the bug refers to ("Created attachment")
+    are not decoded, Bugzilla lists the comments of a bug before its attachments.
+    The source is passed to feed() in chunks of bytes, then finish() is called; both
+    return the records of the bugs parsed so far (see iterparse_bugs for a source that
+    can be iterated synchronously).
+    '''
+    def __init__(self, memory_limit, on_element):
+        self.parser = ElementTree.DefusedXMLParser(target=self)
+        self.memory_limit = memory_limit
+        self.budget = memory_limit
+        self.on_element = on_element
+        self.records = []
+        # the builder of the bug being parsed, the last attachid parsed, the attachments
+        # the comments of the bug refer to and the decoded data of its attachments
+        self.builder = None
+        self.attachid = None
+        self.referenced = set()
+        self.decoded = {}
+        self.in_data = False
+        self.decoder = None
+        # the source from byte `offset` on, while on_element may need it
+        self.raw = _spooled_file(memory_limit) if on_element else None
+        self.offset = 0
+        self.bug_start = 0
+
+    def feed(self, chunk):
+        if self.raw:
+            self.raw.seek(0, io.SEEK_END)
+            self.raw.write(chunk)
+        self.parser.feed(chunk)
+        records, self.records = self.records, []
+        return records
+
+    def finish(self):
+        self.parser.close()
+        if self.raw:
+            self.raw.close()
+        return self.records
+
+    def _index(self):
+        # the byte offset in the source of the event being parsed
+        return self.parser.parser.CurrentByteIndex
+
+    def start(self, tag, attrib):
+        if tag == "bug":
+            self.builder = TreeBuilder()
+            self.bug_start = self._index()
+        if self.builder is None:
+            return
+        self.builder.start(tag, attrib)
+        if tag == "data":
+            self.in_data = True
+            if attrib.get("encoding") == "base64" and self.attachid in self.referenced:
+                self.decoder = Base64Decoder(_spooled_file(self.budget))
+
+    def data(self, text):
+        if self.in_data:
+            if self.decoder:
+                self.decoder.write(text)
+        elif self.builder:
+            self.builder.data(text)
+
+    def end(self, tag):
+        if self.builder is None:
+            return
+        elem = self.builder.end(tag)
+        if tag == "attachid":
+            self.attachid = elem.text
+        elif tag == "long_desc":
+            if (elem.findtext("thetext") or "").startswith("Created attachment"):
+                self.referenced.add(elem.findtext("attachid"))
+        elif tag == "data":
+            self.in_data = False
+            if self.decoder:
+                size, sha256 = self.decoder.close()
+                if size <= self.budget:
+                    # kept in memory
+                    self.budget -= size
+                self.decoded[self.attachid] = (self.decoder.f, size, sha256)
+                self.decoder = None
+        elif tag == "bug":
+            self.builder.close()
+            if self.on_element:
+                self.on_element(elem, self._xml(self.bug_start, self._index()))
+                self._release(self._index())
+            self.records.append(bug_record(elem, self.decoded))
+            self.builder = None
+            self.referenced = set()
+            self.decoded = {}
+
+    def _xml(self, start, end):
+        # the XML of the bug from its start tag to its end tag at `end`
+        self.raw.seek(start - self.offset)
+        remaining = end - start
+        while remaining > 0:
+            chunk = self.raw.read(min(READ_SIZE, remaining))
+            remaining -= len(chunk)
+            yield chunk
+        yield b"</bug>"
+
+    def _release(self, offset):
+        # drop the source before `offset`
+        self.raw.seek(offset - self.offset)
+        raw = _spooled_file(self.memory_limit)
+        raw.write(self.raw.read())
+        self.raw.close()
+        self.raw = raw
+        self.offset = offset
+
+
+def bug_record(bug, decoded):
+    '''
+    Build the record of a <bug> element, whose attachment data was decoded into
+    `decoded` (attachid => (file, size, SHA-256)).
+    '''
+    record = {tag: [] for tag in MULTI_VALUED}
+    record["comments"] = []
+    record["attachments"] = {}
+    if bug.get("error"):
+        record["error"] = bug.get("error")
+
+    for field in bug:
+        if field.tag == "long_desc":
+            record["comments"].append(_fields(field))
+        elif field.tag == "attachment":
+            attachment = attachment_record(field, decoded)
+            record["attachments"][attachment["attachid"]] = attachment
+        elif field.tag in MULTI_VALUED:
+            record[field.tag].append(field.text or "")
+        else:
+            record.update(_field(field))
+    return record
+
+
+def attachment_record(attachment, decoded):
+    '''
+    Build the record of an <attachment> element. Its content is None if its data was not
+    decoded.
+    '''
+    record = _fields(attachment)
+    record["isobsolete"] = attachment.get("isobsolete") == "1"
+    data = attachment.find("data")
+    record["encoding"] = data.get("encoding") if data is not None else None
+    record["content"] = None
+    if record["attachid"] in decoded:
+        content, record["size"], record["sha256"] = decoded[record["attachid"]]
+        record["content"] = lambda: content
+    record.pop("data", None)
+    return record
+
+
+def _spooled_file(max_size):
+    f = tempfile.SpooledTemporaryFile(max_size=max_size)
+    if max_size <= 0:
+        # 0 would mean no limit
+        f.rollover()
+    return f
+
+
+def _fields(elem):
+    fields = {}
+    for field in elem:
+        fields.update(_field(field))
+    return fields
+
+
+def _field(field):
+    text = field.text or ""
+    if field.tag in USER_FIELDS:
+        return {field.tag: field.get("name") or text, field.tag + "_login": text}
+    return {field.tag: text}
+
+
+class Base64Decoder(object):
+    '''
+    Decodes base64 text, written in pieces of any length, into the binary file `f`, one
+    chunk of `chunk_size` characters at a time, so that neither the text nor the decoded
+    data is ever held in memory as a whole.
+    '''
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.pending = []
+        self.pending_size = 0
+        self.rest = ""
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= self.chunk_size:
+            self._decode()
+
+    def _decode(self):
+        chunk = self.rest + "".join("".join(self.pending).split())
+        self.pending = []
+        self.pending_size = 0
+        cut = len(chunk) - len(chunk) % 4
+        self.rest = chunk[cut:]
+        data = base64.standard_b64decode(chunk[:cut])
+        self.sha256.update(data)
+        self.f.write(data)
+        self.size += len(data)
+
+    def close(self):
+        '''
+        Returns the size and the SHA-256 hex digest of the decoded data, with `f` rewound.
+        '''
+        self._decode()
+        if self.rest:
+            raise ValueError("Invalid base64 data: length is not a multiple of 4")
+        self.f.seek(0)
+        return self.size, self.sha256.hexdigest()
+
+
+def decode_base64(text, f, chunk_size=1 << 20):
+    '''
+    Decode base64 `text` into the binary file `f`, see Base64Decoder.
+    Returns the size and the SHA-256 hex digest of the decoded data.
+    '''
+    decoder = Base64Decoder(f, chunk_size)
+    for start in range(0, len(text), chunk_size):
+        decoder.write(text[start:start + chunk_size])
+    return decoder.close()
@@ -0,0 +1,96 @@
+'''
+References between bugs (Blocks, Depends on, See also, links to show_bug.cgi and
+"bug 123" mentions) rewritten into references between the GitLab issues the bugs were
+migrated to. The issue of a referenced bug may not exist when the bug referring to it is
+migrated, so the references are rewritten once all of them exist, see
+Migrator.link_references.
+'''
+import re
+from urllib.parse import urlparse
+
+# The path of the project in the web URL of an issue, with or without the "/-/" scope
+_ISSUE_PATH = re.compile(r"^/(.+?)(?:/-)?/issues/\d+$")
+# Words that make a "bug 123" mention refer to the bug of another tracker
+QUALIFIERS = {"upstream", "downstream", "external", "other", "their"}
+
+
+def project_path(web_url):
+    '''
+    The path of the project of an issue, from the web URL of the issue, or None.
+    '''
+    match = _ISSUE_PATH.match(urlparse(web_url or "").path)
+    return match.group(1) if match else None
+
+
+class ReferenceIndex(object):
+    '''
+    The GitLab issue of every migrated bug, built from the (project_id, bug_id, iid,
+    web_url) rows of the journal (see Journal.issues), i.e. the data of map.csv, including
+    the maps imported into it (see Journal.import_map).
+    Links to show_bug.cgi of `bugzilla_url`, and "bug 123" mentions that are not about the
+    bug of another tracker (see _qualified), are rewritten if the bug is in the index.
+    '''
+    def __init__(self, rows, bugzilla_url):
+        self.issues = {}
+        for project_id, bug_id, iid, web_url in rows:
+            self.issues[str(bug_id)] = (str(project_id), iid, project_path(web_url))
+        # a link to a bug of this Bugzilla, or a mention such as "bug 123" or "Bug #123"
+        self.pattern = re.compile(r"{}/show_bug\.cgi\?id=(\d+)|\b([Bb]ug) #?(\d+)\b".format(
+            re.escape(bugzilla_url)))
+
+    def __len__(self):
+        return len(self.issues)
+
+    def reference(self, bug_id, project_id):
+        '''
+        The GitLab reference to the issue of a bug, from an issue of project `project_id`:
+        #iid within the same project, group/project#iid across projects.
+        Returns None if the bug was not migrated.
+        '''
+        issue = self.issues.get(str(bug_id))
+        if issue is None:
+            return None
+        target, iid, path = issue
+        if target == str(project_id):
+            return "#{}".format(iid)
+        if path is None:
+            return None
+        return "{}#{}".format(path, iid)
+
+    def rewrite(self, text, project_id):
+        '''
+        Replace the references to migrated bugs in `text`, written in project `project_id`.
+        '''
+        def replace(match):
+            if match.group(1):
+                return self.reference(match.group(1), project_id) or match.group(0)
+            if _qualified(text, match.start()):
+                return match.group(0)
+            reference = self.reference(match.group(3), project_id)
+            if reference is None:
+                return match.group(0)
+            return "{} {}".format(match.group(2), reference)
+
+        return self.pattern.sub(replace, text)
+
+
+def _qualified(text, start):
+    '''
+    Whether the "bug 123" mention at `start` in `text` is about the bug of another tracker,
+    e.g. "GCC bug 123", "KDE bug 4" or "upstream bug 123": the word right before it is a
+    name (with capitals or digits, other than a capital starting a sentence) or one of
+    QUALIFIERS.
+    '''
+    before = text[max(0, start - 100):start]
+    words = before.split()
+    if not words or not before[-1:].isspace() or not words[-1][-1].isalnum():
+        return False
+    word = words[-1]
+    if word.lower() in QUALIFIERS:
+        return True
+    if any(c.isdigit() for c in word) or any(c.isupper() for c in word[1:]):
+        return True
+    # the text before the word, up to the end of the previous line or sentence, if any
+    head = before.rstrip()[:-len(word)].rstrip(" \t")
+    sentence_start = head[-1:] in ("\n", ".", "!", "?", ":") or not head and start <= 100
+    return word[0].isupper() and not sentence_start
@@ -0,0 +1,124 @@
+'''
+Rendering of bug records into the markdown of issue descriptions and comments.
+The format of both is part of the configuration (description_table, description_heading
+and comment_header), and is compiled once per migration into a BodyFormat.
+'''
+import string
+
+# The rows of the table at the top of every issue description, as [label, template]
+# pairs. A template is a str.format() string over the fields of a bug record (see
+# records.py); rows whose fields are all empty are left out.
+DESCRIPTION_TABLE = [
+    ["Bugzilla ID", "{bug_id}"],
+    ["Alias(es)", "{alias}"],
+    ["Reporter", "{reporter}"],
+    ["Assignee", "{assigned_to}"],
+    ["Reported", "{creation_ts}"],
+    ["Modified", "{delta_ts}"],
+    ["Status", "{bug_status} {resolution}"],
+    ["Version", "{version}"],
+    ["Hardware", "{op_sys} / {rep_platform}"],
+    ["Importance", "{priority} / {bug_severity}"],
+    ["Package(s)", "{cf_package}"],
+    ["URL", "{bug_file_loc}"],
+    ["Blocks", "{blocked}"],
+    ["Depends on", "{dependson}"],
+    ["See also", "{see_also}"],
+]
+# Between the table and the first comment, when the first comment is the description
+DESCRIPTION_HEADING = "\n## Description\n\n"
+# Above the text of every comment; the fields are num, who and bug_when
+COMMENT_HEADER = "**Comment {num} by \"{who}\" on {bug_when}**\n\n"
+
+# Fields listing other bugs, rendered as links to them (see Migrator.link_references)
+BUG_LINK_FIELDS = ("blocked", "dependson")
+# The separators of the values of multi-valued fields, "<br>" by default
+SEPARATORS = {"alias": ", "}
+# Markdown line break
+LINE_BREAK = "  \n"
+
+_TABLE_HEADER = "|  |  |\n| --- | --- |\n"
+
+
+class BodyFormat(object):
+    '''
+    A compiled body format: every table row is split into its constant prefix and its
+    template once, and a template made of a single field is rendered without formatting.
+    '''
+    __slots__ = ("rows", "heading", "comment_header", "bug_url")
+
+    def __init__(self, table, heading, comment_header, bugzilla_url):
+        formatter = string.Formatter()
+        self.rows = []
+        for label, template in table:
+            parsed = list(formatter.parse(template))
+            fields = tuple(field for _, field, _, _ in parsed if field is not None)
+            if len(parsed) == 1 and not parsed[0][0] and not parsed[0][2] and fields:
+                # "{field}", no formatting needed
+                template = None
+            self.rows.append(("| {} | ".format(label), template, fields))
+        self.heading = heading
+        self.comment_header = comment_header
+        self.bug_url = bugzilla_url + "/show_bug.cgi?id={}"
+
+    def table(self, bug):
+        '''
+        The description table of a bug record, assembled with a single join.
+        '''
+        values = _Values(bug, self.bug_url)
+        parts = [_TABLE_HEADER]
+        for prefix, template, fields in self.rows:
+            if fields and not any([values[field] for field in fields]):
+                continue
+            parts.append(prefix)
+            parts.append(values[fields[0]] if template is None else template.format_map(values))
+            parts.append(" |\n")
+        return "".join(parts)
+
+    def description(self, table, text, link=None):
+        '''
+        The description of an issue: its table, followed by the first comment of the bug
+        (`text`), if any, whose first line is replaced with the markdown of `link`.
+        '''
+        if not text:
+            return table
+        return "".join([table, self.heading, markdown_text(text, link)])
+
+    def comment(self, header, text, link=None):
+        return header + markdown_text(text, link)
+
+
+class _Values(dict):
+    '''
+    The fields of a bug record as strings, converted once, when a template needs them.
+    '''
+    __slots__ = ("bug", "bug_url")
+
+    def __init__(self, bug, bug_url):
+        super().__init__()
+        self.bug = bug
+        self.bug_url = bug_url
+
+    def __missing__(self, field):
+        value = self.bug.get(field)
+        if value is None:
+            value = ""
+        elif isinstance(value, list):
+            if field in BUG_LINK_FIELDS:
+                value = [self.bug_url.format(bug_id) for bug_id in value]
+            value = SEPARATORS.get(field, "<br>").join(value)
+        else:
+            value = str(value)
+        self[field] = value
+        return value
+
+
+def markdown_text(text, link=None):
+    '''
+    The text of a comment with its lines kept apart in markdown, and its first line
+    ("Created attachment ...") replaced with `link`, if any.
+    '''
+    if link is not None:
+        _, newline, rest = text.partition("\n")
+        text = link + newline + rest
+    return text.replace("\n", LINE_BREAK)
@@ -0,0 +1,296 @@
+'''
+Bugzilla REST API backend (Bugzilla 5.0 and later).
+Builds the same bug records as records.py does from show_bug.cgi XML, from a few bulk
+requests per batch of bugs. Attachment data is not part of them: it is downloaded by
+the "content" function of an attachment record, i.e. only for the attachments that
+are actually migrated.
+'''
+import itertools
+import re
+import tempfile
+import threading
+
+from .records import Base64Decoder, MULTI_VALUED
+from .utils import _perform_request, stream_content
+
+# REST API bug fields => record fields (the tags of show_bug.cgi XML)
+BUG_FIELDS = {
+    "id": "bug_id",
+    "alias": "alias",
+    "summary": "short_desc",
+    "creation_time": "creation_ts",
+    "last_change_time": "delta_ts",
+    "status": "bug_status",
+    "resolution": "resolution",
+    "version": "version",
+    "op_sys": "op_sys",
+    "platform": "rep_platform",
+    "priority": "priority",
+    "severity": "bug_severity",
+    "target_milestone": "target_milestone",
+    "keywords": "keywords",
+    "url": "bug_file_loc",
+    "blocks": "blocked",
+    "depends_on": "dependson",
+    "see_also": "see_also",
+    "cc": "cc",
+    "groups": "group",
+    "product": "product",
+    "component": "component",
+    "creator": "reporter",
+    "assigned_to": "assigned_to",
+    "qa_contact": "qa_contact",
+}
+USER_FIELDS = {"creator": "reporter", "assigned_to": "assigned_to", "qa_contact": "qa_contact"}
+
+# The start of the base64 data of an attachment in the JSON of /rest/bug/attachment/<id>
+_DATA_START = re.compile(rb'"data"\s*:\s*"')
+# The escapes JSON encoders may put in base64 text: "\/", and line breaks
+_ESCAPE = re.compile(rb"\\(.)")
+
+# login => real name, of all users seen so far
+_real_names = {}
+_real_names_lock = threading.Lock()
+
+
+def get_bugzilla_bugs(bugzilla_url, bug_ids, memory_limit, api_key=None):
+    '''
+    Fetch several bugs, with their comments and attachment metadata, with three requests.
+    Returns a dictionary of bug id (as a string) => bug record, see records.py.
+    Bugs that Bugzilla could not return have an "error" field.
+    '''
+    headers = _headers(api_key)
+    fields = list(BUG_FIELDS) + ["_custom"] + [f + "_detail" for f in USER_FIELDS]
+    response = _perform_request("{}/rest/bug".format(bugzilla_url), "get", headers=headers,
+                                params={"id": list(bug_ids), "include_fields": fields,
+                                        "permissive": 1})
+    bugs = {}
+    for fault in response.get("faults", []):
+        bugs[str(fault["id"])] = {"bug_id": str(fault["id"]),
+                                  "error": fault.get("faultString") or "NotFound"}
+    for bug in response["bugs"]:
+        record = bug_record(bug)
+        bugs[record["bug_id"]] = record
+
+    found = [bug_id for bug_id, bug in bugs.items() if "error" not in bug]
+    if not found:
+        return bugs
+    comments = _get_bulk(bugzilla_url, "comment", found, headers, {})
+    attachments = _get_bulk(bugzilla_url, "attachment", found, headers,
+                            {"exclude_fields": "data"})
+    _resolve_real_names(bugzilla_url, headers, [c["creator"] for bug_comments in
+                                                comments.values()
+                                                for c in bug_comments["comments"]])
+    for bug_id in found:
+        bugs[bug_id]["comments"] = [comment_record(c) for c in
+                                    comments.get(bug_id, {}).get("comments", [])]
+        for attachment in attachments.get(bug_id, []):
+            record = attachment_record(bugzilla_url, attachment, memory_limit, headers)
+            bugs[bug_id]["attachments"][record["attachid"]] = record
+    return bugs
+
+
+def get_bugzilla_fields(bugzilla_url, bug_ids, fields, api_key=None):
+    '''
+    Fetch only `fields` (record names, e.g. "target_milestone") of several bugs with
+    a single request. Returns a dictionary of bug id (as a string) => bug record.
+    '''
+    names = {record: name for name, record in BUG_FIELDS.items()}
+    response = _perform_request("{}/rest/bug".format(bugzilla_url), "get",
+                                headers=_headers(api_key),
+                                params={"id": list(bug_ids), "permissive": 1,
+                                        "include_fields": ["id"] + [names[f] for f in fields]})
+    return {str(bug["id"]): bug_record(bug) for bug in response["bugs"]}
+
+
+def get_changed_bug_ids(bugzilla_url, since, api_key=None, page_size=500):
+    '''
+    Search for the bugs changed since `since` (a UTC time as returned by
+    utils.format_utc), one page of `page_size` bugs at a time, see search_bug_ids():
+    Bugzilla caps the bugs a search returns at once (max_search_results).
+    '''
+    return list(search_bug_ids(bugzilla_url, {"last_change_time": since}, api_key,
+                               page_size))
+
+
+def search_bug_ids(bugzilla_url, query, api_key=None, page_size=500):
+    '''
+    Yield the ids of the bugs matching a search (e.g. {"product": "Packages"}), in order
+    of id, one page of `page_size` bugs at a time: migrating the first bugs need not
+    wait for the whole search.
+    '''
+    offset = 0
+    while True:
+        response = _perform_request("{}/rest/bug".format(bugzilla_url), "get",
+                                    headers=_headers(api_key),
+                                    params=dict(query, include_fields="id", order="bug_id",
+                                                limit=page_size, offset=offset))
+        for bug in response["bugs"]:
+            yield bug["id"]
+        if len(response["bugs"]) < page_size:
+            return
+        offset += page_size
+
+
+def bug_record(bug):
+    record = {field: [] for field in MULTI_VALUED}
+    record["comments"] = []
+    record["attachments"] = {}
+    for name, value in bug.items():
+        field = BUG_FIELDS.get(name, name if name.startswith("cf_") else None)
+        if field is None:
+            continue
+        if field in MULTI_VALUED:
+            # alias is a single value before Bugzilla 5.0
+            values = value if isinstance(value, list) else [value] if value else []
+            record[field] = [str(v) for v in values]
+        elif field in ["creation_ts", "delta_ts"]:
+            record[field] = normalize_time(value)
+        elif field == "keywords":
+            record[field] = ", ".join(value)
+        elif name in USER_FIELDS:
+            detail = bug.get(name + "_detail") or {}
+            record[field] = detail.get("real_name") or value or ""
+            record[field + "_login"] = value or ""
+            if value and detail.get("real_name"):
+                with _real_names_lock:
+                    _real_names[value] = detail["real_name"]
+        elif isinstance(value, list):
+            record[field] = ", ".join(str(v) for v in value)
+        else:
+            record[field] = "" if value is None else str(value)
+    return record
+
+
+def comment_record(comment):
+    login = comment.get("creator", "")
+    record = {
+        "commentid": str(comment["id"]),
+        "comment_count": str(comment.get("count", "")),
+        "who": _real_names.get(login) or login,
+        "who_login": login,
+        "bug_when": normalize_time(comment["creation_time"]),
+        "thetext": comment.get("text") or "",
+    }
+    if comment.get("attachment_id"):
+        record["attachid"] = str(comment["attachment_id"])
+    return record
+
+
+def attachment_record(bugzilla_url, attachment, memory_limit, headers):
+    '''
+    Build the record of an attachment from its metadata. Its "content" function
+    downloads and decodes the data on the first call, and sets "size" and "sha256".
+    '''
+    record = {
+        "attachid": str(attachment["id"]),
+        "filename": attachment.get("file_name", ""),
+        "type": attachment.get("content_type", ""),
+        "desc": attachment.get("summary", ""),
+        "isobsolete": bool(attachment.get("is_obsolete")),
+        "encoding": "base64",
+        "size": attachment.get("size"),
+        "sha256": None,
+    }
+    content = []
+
+    def get_content():
+        if not content:
+            url = "{}/rest/bug/attachment/{}".format(bugzilla_url, record["attachid"])
+            response = _perform_request(url, "get", headers=headers,
+                                        params={"include_fields": "data"}, json=False,
+                                        stream=True)
+            f = tempfile.SpooledTemporaryFile(max_size=memory_limit)
+            record["size"], record["sha256"] = decode_data(stream_content(response), f)
+            content.append(f)
+        return content[0]
+
+    record["content"] = get_content
+    return record
+
+
+def decode_data(chunks, f):
+    '''
+    Decode the base64 "data" of the JSON of an attachment, received in `chunks` of bytes,
+    into the binary file `f` as it is received, like attachments of show_bug.cgi XML
+    (see records.Base64Decoder): the data is never held in memory as a whole.
+    Returns the size and the SHA-256 hex digest of the decoded data.
+    '''
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        match = _DATA_START.search(head)
+        if match:
+            break
+        # enough to find the start of the data across chunks
+        head = head[-64:]
+    else:
+        raise Exception("The response has no attachment data")
+
+    decoder = Base64Decoder(f)
+    # an escape cut in two by the end of a chunk
+    carry = b""
+    for chunk in itertools.chain([head[match.end():]], chunks):
+        text = carry + chunk
+        carry = b""
+        # base64 has no quotes, so the first one ends the data
+        end = text.find(b'"')
+        if end >= 0:
+            text = text[:end]
+        elif text.endswith(b"\\"):
+            text, carry = text[:-1], b"\\"
+        text = _ESCAPE.sub(lambda m: b"/" if m.group(1) == b"/" else b" ", text)
+        decoder.write(text.decode("ascii"))
+        if end >= 0:
+            return decoder.close()
+    raise Exception("The attachment data of the response is truncated")
+
+
+def normalize_time(value):
+    '''
+    Convert a REST API time ("2019-05-01T17:00:00Z", always UTC) to the format of
+    show_bug.cgi XML ("2019-05-01 17:00:00 +0000").
+    '''
+    if not value:
+        return ""
+    return value.replace("T", " ").replace("Z", " +0000")
+
+
+def _get_bulk(bugzilla_url, resource, bug_ids, headers, params):
+    '''
+    Get the comments or attachments of several bugs with one request. The REST API
+    only has a path for those of a single bug, which takes further bugs as `ids`.
+    '''
+    url = "{}/rest/bug/{}/{}".format(bugzilla_url, bug_ids[0], resource)
+    response = _perform_request(url, "get", headers=headers,
+                                params=dict(params, ids=list(bug_ids[1:])))
+    return response["bugs"]
+
+
+def _resolve_real_names(bugzilla_url, headers, logins):
+    '''
+    Look up the real names of the users in `logins` that were not seen yet, so that
+    comments show the same author names as with the XML backend.
+    '''
+    with _real_names_lock:
+        unknown = sorted(set(login for login in logins if login not in _real_names))
+    if not unknown:
+        return
+    try:
+        response = _perform_request("{}/rest/user".format(bugzilla_url), "get",
+                                    headers=headers,
+                                    params={"names": unknown,
+                                            "include_fields": ["name", "real_name"]})
+    except Exception:
+        # user lookups may be restricted, logins are shown instead then
+        response = {"users": []}
+    with _real_names_lock:
+        for login in unknown:
+            _real_names[login] = ""
+        for user in response.get("users", []):
+            _real_names[user["name"]] = user.get("real_name") or ""
+
+
+def _headers(api_key):
+    return {"X-BUGZILLA-API-KEY": api_key} if api_key else {}
@@ -0,0 +1,89 @@
+'''
+The HTTP connections of the requests backend: a pool of keep-alive connections per host
+(Bugzilla, GitLab), shared by the sessions of all threads, and the timeouts and headers
+of every request.
+'''
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import make_headers
+
+# The compressions urllib3 decodes: gzip and deflate, and br if brotli is installed.
+# Bugzilla XML compresses to a fraction of its size.
+ACCEPT_ENCODING = make_headers(accept_encoding=True)["accept-encoding"]
+# The number of hosts whose pools are kept
+MAX_HOSTS = 10
+
+
+class Transport(object):
+    '''
+    Connection pools shared by all threads, one per host, each keeping up to `pool_size`
+    connections alive between requests (see configure()). requests.Session is not
+    thread-safe, so every thread gets its own session on top of the shared pools; the
+    cookie jar is shared as well, so that a Bugzilla login applies to all of them.
+    '''
+    def __init__(self, pool_size=1, connect_timeout=10, read_timeout=300):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.adapter = None
+        self.pool_size = None
+        # connections and requests of the pools that were closed, per host
+        self.closed = {}
+        self.configure(pool_size, connect_timeout, read_timeout)
+
+    def configure(self, pool_size, connect_timeout, read_timeout):
+        '''
+        Size the pools for `pool_size` concurrent requests per host, e.g. the number of
+        workers, and set the (connect, read) timeout of requests, in seconds.
+        '''
+        self.timeout = (connect_timeout, read_timeout)
+        with self.lock:
+            if pool_size == self.pool_size:
+                return
+            if self.adapter:
+                self._add_stats(self.closed, self.adapter)
+                self.adapter.close()
+            self.pool_size = pool_size
+            # retries are up to _perform_request, see ratelimit.RateGovernor
+            self.adapter = HTTPAdapter(pool_connections=MAX_HOSTS, pool_maxsize=pool_size,
+                                       max_retries=0)
+
+    def session(self):
+        '''
+        The session of the calling thread.
+        '''
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = requests.Session()
+            session.cookies = self.cookies
+            session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+            self.local.session = session
+        if session.adapters.get("https://") is not self.adapter:
+            session.mount("https://", self.adapter)
+            session.mount("http://", self.adapter)
+        return session
+
+    def stats(self):
+        '''
+        The connections opened and the requests sent, per host. Requests beyond the
+        connections opened were sent over a connection kept alive, without a new TCP
+        (and TLS) handshake.
+        '''
+        with self.lock:
+            stats = {host: dict(counts) for host, counts in self.closed.items()}
+            self._add_stats(stats, self.adapter)
+        return stats
+
+    @staticmethod
+    def _add_stats(stats, adapter):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            host = "{}:{}".format(pool.host, pool.port)
+            counts = stats.setdefault(host, {"connections": 0, "requests": 0})
+            counts["connections"] += pool.num_connections
+            counts["requests"] += pool.num_requests
@@ -1,42 +1,166 @@
-import sys
+from collections.abc import Iterable
+import csv
+import datetime
 from getpass import getpass
+import io
+import itertools
+import queue
+import re
+import sys
+import threading
+import time
+import uuid
 
 import dateutil.parser
-from defusedxml import ElementTree
 import pytz
 import requests
 
-session = None
+from .metrics import metrics
+from .ratelimit import RateGovernor
+from .records import iterparse_bugs
+from .transport import Transport
+
+# The connection pools and sessions of all threads, see Migrator for their configuration
+transport = Transport()
+# Shared by the sessions of all threads, so that a Bugzilla login applies to all of them
+cookies = transport.cookies
+# Paces and retries the requests of all threads
+governor = RateGovernor()
+
+
+def _get_session():
+    return transport.session()
 
 
 def _perform_request(url, method, data={}, params={}, headers={}, files={}, json=True,
-                     dry_run=False):
+                     dry_run=False, stream=False):
     '''
     Utility method to perform an HTTP request.
+    Requests are paced by `governor`, and retried with backoff when they are
+    throttled, time out or fail in a way that makes repeating them safe. Every attempt
+    is recorded in `metrics`.
+    With `stream` (and not `json`), the body of the response is left to be read, see
+    stream_content().
     '''
     if dry_run and method != "get":
         msg = "{} {} dry_run".format(url, method)
         print(msg, file=sys.stderr)
         return 0
 
-    global session
-    if not session:
-        session = requests.Session()
+    session = _get_session()
 
-    func = getattr(session, method)
+    attempt = 0
+    while True:
+        time.sleep(governor.delay(url))
+        start = time.monotonic()
+        try:
+            if files:
+                body = MultipartStream(files)
+                result = session.request(
+                    method=method, url=url, data=body, timeout=transport.timeout,
+                    headers=dict(headers, **{"Content-Type": body.content_type}))
+            else:
+                result = session.request(method=method, url=url, params=params, data=data,
+                                         headers=headers, timeout=transport.timeout,
+                                         stream=stream)
+        except (requests.ConnectionError, requests.Timeout):
+            metrics.record_request(method, url, None, time.monotonic() - start)
+            delay = governor.retry_delay(method, None, attempt)
+            if delay is None:
+                raise
+        else:
+            received = (int(result.headers.get("Content-Length") or 0) if stream
+                        else len(result.content))
+            metrics.record_request(method, url, result.status_code, time.monotonic() - start,
+                                   int(result.request.headers.get("Content-Length") or 0),
+                                   received)
+            governor.update(url, result.headers)
+            if result.status_code in [200, 201]:
+                if json:
+                    return result.json()
+                else:
+                    return result
+            if stream:
+                result.close()
+            delay = governor.retry_delay(method, result.status_code, attempt, result.headers)
+            if delay is None:
+                raise Exception("{} failed requests: {}".format(result.status_code,
+                                                                result.reason))
+        print("Retrying {} {} in {:.1f}s".format(method, url, delay), file=sys.stderr)
+        time.sleep(delay)
+        attempt += 1
 
-    if files:
-        result = func(url, files=files, headers=headers)
-    else:
-        result = func(url, params=params, data=data, headers=headers)
 
-    if result.status_code in [200, 201]:
-        if json:
-            return result.json()
-        else:
-            return result
+def get_all_pages(url, headers, params={}):
+    '''
+    GET all items of a paginated GitLab API list, 100 per request, following the
+    `Link: <...>; rel="next"` header of each page (offset or keyset pagination).
+    '''
+    items = []
+    params = dict(params, per_page=100)
+    while url:
+        response = _perform_request(url, "get", params=params, headers=headers, json=False)
+        items.extend(response.json())
+        url = response.links.get("next", {}).get("url")
+        # the next link carries all query parameters
+        params = {}
+    return items
+
 
-    raise Exception("{} failed requests: {}".format(result.status_code, result.reason))
+class MultipartStream(object):
+    '''
+    A multipart/form-data request body that reads the files it contains while it is
+    sent, instead of building the whole body in memory like requests does.
+    `files` maps field names to (file name, bytes or binary file object) tuples.
+    '''
+    def __init__(self, files):
+        boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(boundary)
+        self.parts = []
+        self.length = 0
+        for name, (filename, content) in files.items():
+            f = io.BytesIO(content) if isinstance(content, bytes) else content
+            f.seek(0, io.SEEK_END)
+            size = f.tell()
+            f.seek(0)
+            header = ("--{}\r\nContent-Disposition: form-data; name=\"{}\"; filename=\"{}\"\r\n"
+                      "Content-Type: application/octet-stream\r\n\r\n").format(
+                          boundary, _quote(name), _quote(filename)).encode("utf-8")
+            self.parts.extend([io.BytesIO(header), f, io.BytesIO(b"\r\n")])
+            self.length += len(header) + size + 2
+        trailer = "--{}--\r\n".format(boundary).encode("utf-8")
+        self.parts.append(io.BytesIO(trailer))
+        self.length += len(trailer)
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        chunk = self.read(65536)
+        while chunk:
+            yield chunk
+            chunk = self.read(65536)
+
+    def read(self, size=-1):
+        chunks = []
+        while self.parts and size != 0:
+            chunk = self.parts[0].read(size)
+            if not chunk:
+                self.parts.pop(0)
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b"".join(chunks)
+
+
+def _quote(value):
+    '''
+    Escape a multipart header parameter the way browsers (and urllib3) do.
+    '''
+    for char, escaped in (("\\", "\\\\"), ("\"", "%22"), ("\r", "%0D"), ("\n", "%0A")):
+        value = value.replace(char, escaped)
+    return value
 
 
 def markdown_table_row(key, value):
@@ -46,27 +170,153 @@ def markdown_table_row(key, value):
     return u"| {} | {} |\n".format(key, value)
 
 
+def map_row(bugzilla_url, bug_id, issue_url):
+    '''
+    Create a row of the bug => issue map (map.csv).
+    '''
+    return "{}/show_bug.cgi?id={},{}".format(bugzilla_url, bug_id, issue_url)
+
+
+def parse_map_row(bugzilla_url, row):
+    '''
+    Parse a row of the bug => issue map (map.csv), see map_row().
+    Returns the (bug id, issue iid, issue URL) of the row.
+    '''
+    match = re.match(r"{}/show_bug\.cgi\?id=(\d+),(.*/issues/(\d+))$".format(
+        re.escape(bugzilla_url)), row.strip())
+    if not match:
+        raise Exception("Not a row of the map of {}: {}".format(bugzilla_url, row.strip()))
+    return int(match.group(1)), int(match.group(3)), match.group(2)
+
+
 def format_utc(datestr):
     '''
     Convert dateime string to UTC format recognized by gitlab.
+    Times in the format of Bugzilla ("2014-06-01 07:57:32 -0700") are parsed directly,
+    anything else by dateutil (see parse_utc).
+    '''
+    match = _BUGZILLA_TIME.match(datestr)
+    if not match:
+        return parse_utc(datestr)
+    year, month, day, hour, minute, second, offset = match.groups()
+    utc_dt = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute),
+                               int(second)) - _utc_offset(offset)
+    return "{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}Z".format(
+        utc_dt.year, utc_dt.month, utc_dt.day, utc_dt.hour, utc_dt.minute, utc_dt.second)
+
+
+def parse_utc(datestr):
+    '''
+    format_utc() for any time dateutil can parse.
     '''
     parsed_dt = dateutil.parser.parse(datestr)
     utc_dt = parsed_dt.astimezone(pytz.utc)
     return utc_dt.strftime("%Y-%m-%dT%H:%M:%SZ")
 
 
-def get_bugzilla_bug(bugzilla_url, bug_id):
-    bug_xml = _fetch_bug_content(bugzilla_url, bug_id)
-    tree = ElementTree.fromstring(bug_xml)
-    return tree.find("bug")
+_BUGZILLA_TIME = re.compile(r"(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d) ([+-]\d{4})$")
+# "-0700" => its timedelta, of all UTC offsets seen so far
+_utc_offsets = {}
+
+
+def _utc_offset(offset):
+    delta = _utc_offsets.get(offset)
+    if delta is None:
+        delta = datetime.timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5]))
+        if offset[0] == "-":
+            delta = -delta
+        _utc_offsets[offset] = delta
+    return delta
+
+
+def get_bugzilla_bug(bugzilla_url, bug_id, memory_limit):
+    response = _fetch_bug_content(bugzilla_url, bug_id)
+    return next(iterparse_bugs(stream_content(response), memory_limit))
 
 
 def _fetch_bug_content(url, bug_id):
     url = "{}/show_bug.cgi?ctype=xml&id={}".format(url, bug_id)
-    response = _perform_request(url, "get", json=False)
+    return _perform_request(url, "get", json=False, stream=True)
+
+
+def get_bugzilla_bugs(bugzilla_url, bug_ids, memory_limit, on_element=None):
+    '''
+    Fetch several bugs with a single request.
+    Returns a dictionary of bug id (as a string) => bug record, see records.py.
+    Bugs that Bugzilla could not return (e.g. unknown or inaccessible ids) have an
+    "error" field. Each <bug> element is passed to `on_element` while parsing.
+    The response is parsed as it is received, see records.iterparse_bugs.
+    '''
+    with metrics.phase("bugzilla.fetch"):
+        response = _fetch_bugs_content(bugzilla_url, bug_ids)
+    with metrics.phase("bugzilla.parse"):
+        bugs = iterparse_bugs(stream_content(response), memory_limit, on_element)
+        return {bug["bug_id"]: bug for bug in bugs}
+
+
+def get_bugzilla_fields(bugzilla_url, bug_ids, fields):
+    '''
+    Fetch only `fields` (and bug_id) of several bugs with a single request.
+    Returns a dictionary of bug id (as a string) => bug record, see records.py.
+    '''
+    bugs_xml = _fetch_bug_fields_content(bugzilla_url, bug_ids, ["bug_id"] + fields)
+    bugs = iterparse_bugs(io.BytesIO(_as_bytes(bugs_xml)), 0)
+    return {bug["bug_id"]: bug for bug in bugs if "bug_id" in bug}
+
+
+def _fetch_bug_fields_content(url, bug_ids, fields):
+    url = "{}/show_bug.cgi".format(url)
+    params = [("ctype", "xml")] + [("id", bug_id) for bug_id in bug_ids]
+    params += [("field", field) for field in fields]
+    response = _perform_request(url, "get", params=params, json=False)
     return response.content
 
 
+def get_changed_bug_ids(bugzilla_url, since):
+    '''
+    Search for the bugs changed since `since` (a UTC time as returned by format_utc).
+    buglist.cgi takes dates in the time zone of the server, so the search starts a day
+    early; bugs that did not actually change are told apart later by their delta_ts.
+    '''
+    day = dateutil.parser.parse(since) - datetime.timedelta(days=1)
+    rows = csv.reader(io.StringIO(_fetch_changed_bugs_content(bugzilla_url,
+                                                              day.strftime("%Y-%m-%d"))))
+    # skip the header
+    next(rows, None)
+    return [int(row[0]) for row in rows if row]
+
+
+def _fetch_changed_bugs_content(url, since_date):
+    url = "{}/buglist.cgi".format(url)
+    params = {"chfieldfrom": since_date, "chfieldto": "Now", "ctype": "csv",
+              "columnlist": "bug_id", "limit": 0}
+    response = _perform_request(url, "get", params=params, json=False)
+    return response.text
+
+
+def _as_bytes(content):
+    return content.encode("utf-8") if isinstance(content, str) else content
+
+
+def stream_content(response, chunk_size=1 << 16):
+    '''
+    Yield the body of a response to a request made with `stream`, decompressed, in chunks
+    of bytes as it is received, then release its connection. A body already read (bytes
+    or str) is yielded whole.
+    '''
+    if isinstance(response, (bytes, str)):
+        yield _as_bytes(response)
+        return
+    with response:
+        yield from response.iter_content(chunk_size)
+
+
+def _fetch_bugs_content(url, bug_ids):
+    url = "{}/show_bug.cgi".format(url)
+    params = [("ctype", "xml")] + [("id", bug_id) for bug_id in bug_ids]
+    return _perform_request(url, "get", params=params, json=False, stream=True)
+
+
 def bugzilla_login(url, user):
     '''
     Log in to Bugzilla as user, asking for password for a few times / untill success.
@@ -92,21 +342,111 @@ def bugzilla_login(url, user):
         raise Exception("Failed to log in after {} attempts".format(max_login_attempts))
 
 
+def chunks(items, size, wait=None):
+    '''
+    Split a list, or any other iterable, into consecutive lists of at most `size` items.
+    Iterables are consumed one chunk at a time. With `wait`, an iterable is consumed by a
+    thread of its own, and the items read so far are yielded as soon as the next one takes
+    more than `wait` seconds to come, e.g. bug ids typed on standard input, instead of
+    waiting for a whole chunk.
+    '''
+    if wait is not None and not isinstance(items, list):
+        yield from _timed_chunks(items, size, wait)
+        return
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _timed_chunks(items, size, wait):
+    # (item, None) for every item, then (end, error), error being raised by the iterable
+    items_queue = queue.Queue(maxsize=size)
+    end = object()
+
+    def read():
+        try:
+            for item in items:
+                items_queue.put((item, None))
+        except Exception as e:
+            items_queue.put((end, e))
+        else:
+            items_queue.put((end, None))
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        item, error = items_queue.get()
+        chunk = []
+        while item is not end:
+            chunk.append(item)
+            if len(chunk) == size:
+                break
+            try:
+                item, error = items_queue.get(timeout=wait)
+            except queue.Empty:
+                break
+        if chunk:
+            yield chunk
+        if item is end:
+            if error:
+                raise error
+            return
+
+
+def unique(items):
+    '''
+    The items of an iterable, without repetitions.
+    '''
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
+def interleave(*iterables):
+    '''
+    Take one item of each iterable in turn, until all of them are exhausted.
+    '''
+    iterators = [iter(iterable) for iterable in iterables]
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+
 def validate_list(integer_list):
     '''
     Ensure that the user-supplied input is a list of integers, or a list of strings
-    that can be parsed as integers.
+    that can be parsed as integers. Any other iterable of them (e.g. a generator) is
+    accepted as well, and checked while it is consumed.
+    Returns the list, or an iterator over the items of the iterable.
     '''
-    if not integer_list:
-        raise Exception("No bugs to migrate! Call `migrate` with a list of bug ids.")
-
-    if not isinstance(integer_list, list):
+    if isinstance(integer_list, (str, bytes)) or not isinstance(integer_list, Iterable):
         raise Exception("Expected a list of integers. Instead recieved "
                         "a(n) {}".format(type(integer_list)))
-
+    if isinstance(integer_list, list):
+        if not integer_list:
+            raise Exception("No bugs to migrate! Call `migrate` with a list of bug ids.")
         for i in integer_list:
-            try:
-                int(i)
-            except ValueError:
-                raise Exception("{} is not able to be parsed as an integer, "
-                                "and is therefore an invalid bug id.".format(i))
+            _validate_id(i)
+        return integer_list
+
+    iterator = iter(integer_list)
+    first = next(iterator, None)
+    if first is None:
+        raise Exception("No bugs to migrate! Call `migrate` with a list of bug ids.")
+    return (_validate_id(i) for i in itertools.chain([first], iterator))
+
+
+def _validate_id(i):
+    try:
+        int(i)
+    except ValueError:
+        raise Exception("{} is not able to be parsed as an integer, "
+                        "and is therefore an invalid bug id.".format(i))
+    return i
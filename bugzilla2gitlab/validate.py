@@ -0,0 +1,110 @@
+'''
+Pre-flight validation of bugs: every bug is rendered into an issue and its comments, as
+in a migration, but nothing is sent to GitLab. Bugs are read from the bug cache by a
+pool of processes, one per core by default.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import csv
+
+from .cache import BugCache
+from .models import IssueThread
+
+# The configuration and bug cache of a validation process, and whether the migration
+# is journaled
+_conf = None
+_cache = None
+_journaled = False
+
+
+def validate_bugs(conf, cache_path, bug_ids, processes=None):
+    '''
+    Validate cached bugs with a pool of `processes` processes.
+    Returns a list with the result of each bug, see validate_bug().
+    '''
+    # that of a real run, see Migrator
+    journaled = bool(conf.journal_file) and not conf.export_file
+    # the journal and export cannot be shared with other processes, and are not needed
+    conf = conf._replace(dry_run=True, journal=None, export=None)
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init,
+                             initargs=(conf, cache_path, journaled)) as executor:
+        return list(executor.map(validate_bug, bug_ids, chunksize=16))
+
+
+def _init(conf, cache_path, journaled):
+    global _conf, _cache, _journaled
+    _conf = conf
+    _cache = BugCache(cache_path)
+    _journaled = journaled
+
+
+def validate_bug(bug_id):
+    '''
+    Render a bug as its migration would, and count the requests it would make.
+    Returns a dictionary with the bug id, the number of "requests", the attachment
+    "uploads" ((SHA-256, file name, size) tuples), the GitLab "milestones" that would
+    be created, and the "error" that would stop the migration of the bug, if any.
+    '''
+    result = {"bug_id": str(bug_id), "requests": 0, "uploads": [], "milestones": [],
+              "error": None}
+    try:
+        fields = _cache.get(bug_id, _conf.attachment_memory_limit)
+        if fields is None:
+            raise Exception("Bug {} is not in the bug cache".format(bug_id))
+        if fields.get("error"):
+            raise Exception("Bug {} could not be fetched: {}".format(bug_id, fields["error"]))
+        milestone = fields.get("target_milestone")
+        if (_conf.map_milestones and milestone not in _conf.milestones_to_skip
+                and milestone not in _conf.gitlab_milestones):
+            # counted once for all bugs, by the caller
+            result["milestones"].append(milestone)
+            _conf.gitlab_milestones[milestone] = None
+        issue_thread = IssueThread(_conf, fields)
+        result["requests"] += _count_requests(issue_thread, result["uploads"], _journaled)
+    except Exception as e:
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+    return result
+
+
+def _count_requests(issue_thread, uploads, journaled=False):
+    '''
+    Build every request IssueThread.save() would make, without sending them.
+    With a journal, the issue is looked up before it is created, see Issue.find_request.
+    '''
+    requests = 0
+    uploaded = set()
+    for model in [issue_thread.issue] + issue_thread.comments:
+        attachment = model.attachment
+        if attachment:
+            attachment.load()
+            key = (attachment.sha256, attachment.filename)
+            # identical files are uploaded once, see Attachment.resume
+            if key not in uploaded:
+                uploaded.add(key)
+                attachment.save_request()
+                uploads.append(key + (attachment.size,))
+                requests += 1
+            attachment.close()
+    issue_thread.issue.save_request()
+    requests += 2 if journaled else 1
+    for comment in issue_thread.comments:
+        comment.issue_id = issue_thread.issue.iid
+        comment.save_request()
+        requests += 1
+    if issue_thread.is_resolved():
+        issue_thread.issue.id = issue_thread.issue.iid
+        issue_thread.issue.close_request()
+        requests += 1
+    return requests
+
+
+def write_report(results, path):
+    '''
+    Write the result of each bug to `path`, as CSV.
+    '''
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["bug_id", "requests", "upload_bytes", "error"])
+        for result in results:
+            writer.writerow([result["bug_id"], result["requests"],
+                             sum(size for _, _, size in result["uploads"]),
+                             result["error"] or ""])
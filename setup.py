@@ -25,6 +25,7 @@ kwargs = {
     "maintainer_email": "hi@xmunoz.com",
     "license": "MIT",
     "install_requires": required,
+    "extras_require": {"async": ["aiohttp>=3.7"]},
     "url": "https://github.com/xmunoz/bugzilla2gitlab",
     "download_url": "https://github.com/xmunoz/bugzilla2gitlab/archive/master.tar.gz",
     "keywords": "bugzilla gitlab bugtracking workflow",
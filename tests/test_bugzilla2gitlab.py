@@ -1,13 +1,172 @@
+import asyncio
+import base64
+import contextvars
+import gzip
+import hashlib
+import http.server
+import io
+import itertools
+import json
 import os.path
 import random
+import re
+import sqlite3
+import tarfile
+import threading
+import time
+import tracemalloc
+
+import pytest
+import requests
 
 from bugzilla2gitlab import Migrator
+import bugzilla2gitlab.aio
+from bugzilla2gitlab.cache import BugCache
 import bugzilla2gitlab.config
+from bugzilla2gitlab.journal import Journal
+import bugzilla2gitlab.metrics
+import bugzilla2gitlab.ratelimit
+import bugzilla2gitlab.records
+from bugzilla2gitlab.references import ReferenceIndex
+import bugzilla2gitlab.rest
+import bugzilla2gitlab.transport
 import bugzilla2gitlab.utils
 
 TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), "test_data")
 
 
+def read_bugs_content(bug_ids):
+    '''
+    Combine the sample bug files into a single multi-bug Bugzilla XML document.
+    '''
+    bugs = []
+    for bug_id in bug_ids:
+        bug_file = "bug-{}.xml".format(bug_id)
+        with open(os.path.join(TEST_DATA_PATH, bug_file), "r") as f:
+            bugs.extend(re.findall(r"<bug>.*?</bug>", f.read(), re.DOTALL))
+    return "<bugzilla>{}</bugzilla>".format("".join(bugs))
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmp_path):
+    '''
+    Keep the bug cache, and the user cache, out of the test data directory.
+    '''
+    path = str(tmp_path / "cache")
+    monkeypatch.setitem(bugzilla2gitlab.config.OPTIONAL_DEFAULTS, "cache_dir", path)
+    monkeypatch.setitem(bugzilla2gitlab.config.OPTIONAL_DEFAULTS, "user_cache_file",
+                        str(tmp_path / "users.json"))
+    return path
+
+
+class FakeGitLab(object):
+    '''
+    Stands in for models._perform_request (and aio.AsyncClient.perform_request, see
+    perform_async), recording the requests made to GitLab and the bug each was made for
+    (see track_bugs). Each request takes `delay` seconds, and max_in_flight is the number
+    of requests that were in flight at the same time, at most.
+    Raises once, after `fail_after` requests, to simulate an interrupted migration.
+    The issues created are kept in `issues` (iid => issue), and found by their iids.
+    '''
+    def __init__(self, fail_after=None, delay=0):
+        self.requests = []
+        self.issues = {}
+        self.bugs = []
+        self.fail_after = fail_after
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    def __call__(self, url, method, data={}, params={}, headers={}, files={}, json=True,
+                 dry_run=False):
+        response = self.begin(url, method, data, params, files)
+        time.sleep(self.delay)
+        self.end()
+        return response
+
+    async def perform_async(self, url, method, data={}, params={}, headers={}, files={},
+                            json=True, dry_run=False):
+        response = self.begin(url, method, data, params, files)
+        await asyncio.sleep(self.delay)
+        self.end()
+        return response
+
+    def begin(self, url, method, data, params, files):
+        with self.lock:
+            if self.fail_after is not None and len(self.requests) >= self.fail_after:
+                self.fail_after = None
+                raise Exception("502 failed requests: Bad Gateway")
+            self.requests.append((method, url))
+            self.bugs.append(CURRENT_BUG.get())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            request_id = len(self.requests)
+        if url.endswith("/uploads"):
+            return {"url": "/uploads/{}/{}".format(request_id, files["file"][0])}
+        if url.endswith("/issues") and method == "get":
+            return [self.issues[int(iid)] for iid in params["iids[]"]
+                    if int(iid) in self.issues]
+        if url.endswith("/issues"):
+            issue = dict(data, iid=int(data["iid"]), id=request_id,
+                         web_url="https://git.example.com/p/-/issues/{}".format(data["iid"]))
+            self.issues[issue["iid"]] = issue
+            return issue
+        return {"id": request_id}
+
+    def end(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def requests_of(self, bug):
+        '''
+        The requests made for a bug, in order.
+        '''
+        return [request for request, b in zip(self.requests, self.bugs) if b == bug]
+
+
+# The bug being migrated, see track_bugs
+CURRENT_BUG = contextvars.ContextVar("CURRENT_BUG", default=None)
+
+
+def track_bugs(monkeypatch):
+    '''
+    Set CURRENT_BUG while each bug is migrated, in its thread or its task.
+    '''
+    migrate_fields = Migrator.migrate_fields
+    migrate_fields_async = Migrator.migrate_fields_async
+
+    def mock_migratefields(self, bug, fields):
+        CURRENT_BUG.set(bug)
+        return migrate_fields(self, bug, fields)
+
+    async def mock_migratefieldsasync(self, client, bug, fields):
+        CURRENT_BUG.set(bug)
+        return await migrate_fields_async(self, client, bug, fields)
+
+    monkeypatch.setattr(Migrator, 'migrate_fields', mock_migratefields)
+    monkeypatch.setattr(Migrator, 'migrate_fields_async', mock_migratefieldsasync)
+
+
+def mock_getuserid(username, gitlab_url, headers):
+    return {"bcantrill": 7, "chris.yeh": 8}[username]
+
+
+def mock_gitlab_config(monkeypatch):
+    def mock_loadmilestoneidcache(project_id, gitlab_url, headers):
+        return {"gitlab_milestones": {"Foo": 1}}
+
+    def mock_fetchbugscontent(url, bug_ids, fields=None):
+        return read_bugs_content(bug_ids)
+
+    monkeypatch.setattr(bugzilla2gitlab.config, '_load_milestone_id_cache',
+                        mock_loadmilestoneidcache)
+    monkeypatch.setattr(bugzilla2gitlab.config, '_get_user_id', mock_getuserid)
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bugs_content', mock_fetchbugscontent)
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bug_fields_content',
+                        mock_fetchbugscontent)
+
+
 def test_config(monkeypatch):
 
     def mockreturn(username, gitlab_url, headers):
@@ -80,6 +239,1063 @@ def test_Migrator(monkeypatch):
                         mock_loadmilestoneidcache)
     monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bug_content', mock_fetchbugcontent)
 
+    def mock_fetchbugscontent(url, bug_ids, fields=None):
+        return read_bugs_content(bug_ids)
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bugs_content', mock_fetchbugscontent)
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bug_fields_content',
+                        mock_fetchbugscontent)
+
     # just test that it works without throwing any exceptions
     client = Migrator(os.path.join(TEST_DATA_PATH, "config"))
     client.migrate([bug_id])
+    client.migrate_one(bug_id)
+
+
+def test_get_bugzilla_bugs(monkeypatch):
+    requested = []
+
+    def mock_fetchbugscontent(url, bug_ids):
+        requested.append(list(bug_ids))
+        return read_bugs_content(bug_ids)
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bugs_content', mock_fetchbugscontent)
+
+    bugs = bugzilla2gitlab.utils.get_bugzilla_bugs("https://bugzilla.example.com", [103, 5933],
+                                                   1024)
+    assert requested == [[103, 5933]]
+    assert sorted(bugs.keys()) == ["103", "5933"]
+    bug = bugs["5933"]
+    assert bug["bug_id"] == "5933"
+    assert isinstance(bug["cc"], list)
+    assert len(bug["attachments"]) == 2
+    for attachment in bug["attachments"].values():
+        assert "data" not in attachment
+        assert len(attachment["content"]().read()) == attachment["size"]
+
+    assert list(bugzilla2gitlab.utils.chunks([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+
+
+def test_body_format(monkeypatch):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    bug = bugzilla2gitlab.utils.get_bugzilla_bugs("https://bugzilla.example.com", [103],
+                                                  1024)["103"]
+    conf = bugzilla2gitlab.config.get_config(
+        config_path, description_table=[["Bug", "{bug_id} ({bug_status})"],
+                                        ["Blocks", "{blocked}"], ["Package", "{cf_package}"]],
+        description_heading="\n---\n", comment_header="{who} wrote:\n")
+    issue_thread = bugzilla2gitlab.models.IssueThread(conf, bug)
+    description = issue_thread.issue.payload()["description"]
+    # rows whose fields are all empty are left out
+    assert description.startswith(
+        "|  |  |\n| --- | --- |\n| Bug | 103 (RESOLVED) |\n"
+        "| Blocks | https://landfill.bugzilla.org/bugzilla-5.0-branch/show_bug.cgi?id=23 |\n"
+        "\n---\nUpon openning the spice dispenser in order to add the required raw "
+        "materials,  \nI found")
+    comment = issue_thread.comments[0]
+    comment.issue_id = 103
+    assert comment.save_request()[2]["data"] == {
+        "created_at": comment.created_at,
+        "body": "Christy wrote:\n  \n  \n*** This bug has been marked as a duplicate of bug 20 ***"}
+
+
+def test_Migrator_workers(monkeypatch):
+    mock_gitlab_config(monkeypatch)
+    track_bugs(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    serial = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', serial)
+    Migrator(config_path, dry_run=False, journal_file="").migrate([103, 5933])
+
+    parallel = FakeGitLab(delay=0.02)
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', parallel)
+    client = Migrator(config_path, dry_run=False, journal_file="", workers=2)
+    assert client.conf.workers == 2
+    client.migrate([103, 5933, 103, 5933])
+    # every bug is migrated once, with the same requests in the same order
+    for bug in [103, 5933]:
+        assert parallel.requests_of(bug) == serial.requests_of(bug)
+    assert sorted(parallel.requests) == sorted(serial.requests)
+    # ... by both workers at the same time
+    assert parallel.max_in_flight == 2
+
+    # a failing worker stops the migration
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', FakeGitLab(fail_after=1))
+    with pytest.raises(Exception, match="Bad Gateway"):
+        Migrator(config_path, dry_run=False, journal_file="", workers=2).migrate([103, 5933])
+
+
+def test_Migrator_pipeline(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    serial = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', serial)
+    Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "serial.sqlite3"),
+             bugzilla_batch_size=1).migrate([103, 5933])
+
+    pipelined = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', pipelined)
+    Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "pipeline.sqlite3"),
+             bugzilla_batch_size=1, pipeline=True, pipeline_queue_size=1,
+             pipeline_workers={"upload": 2, "notes": 2}).migrate([103, 5933])
+    # the requests of each bug are made in the same order
+    for bug in ["103", "5933"]:
+        assert ([r for r in pipelined.requests if "/issues/" + bug in r[1]]
+                == [r for r in serial.requests if "/issues/" + bug in r[1]])
+    assert sorted(pipelined.requests) == sorted(serial.requests)
+
+    # a failing stage stops the pipeline
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', FakeGitLab(fail_after=1))
+    with pytest.raises(Exception, match="Bad Gateway"):
+        Migrator(config_path, dry_run=False, journal_file="", pipeline=True).migrate(
+            [103, 5933])
+
+
+def test_Migrator_asyncio(monkeypatch):
+    pytest.importorskip("aiohttp")
+    mock_gitlab_config(monkeypatch)
+    track_bugs(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+
+    async def mock_getbugzillabugs(client, url, bug_ids, memory_limit, on_element=None):
+        return bugzilla2gitlab.utils.get_bugzilla_bugs(url, bug_ids, memory_limit, on_element)
+
+    monkeypatch.setattr(bugzilla2gitlab.aio, 'get_bugzilla_bugs', mock_getbugzillabugs)
+    serial = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', serial)
+    Migrator(config_path, dry_run=False, journal_file="").migrate([103, 5933])
+
+    concurrent = FakeGitLab(delay=0.02)
+    monkeypatch.setattr(bugzilla2gitlab.aio.AsyncClient, 'perform_request',
+                        concurrent.perform_async)
+    Migrator(config_path, dry_run=False, journal_file="", http_backend="asyncio",
+             async_concurrency=2).migrate([103, 5933, 103])
+    for bug in [103, 5933]:
+        assert concurrent.requests_of(bug) == serial.requests_of(bug)
+    assert sorted(concurrent.requests) == sorted(serial.requests)
+    assert concurrent.max_in_flight == 2
+
+    # bugs are migrated while the stream of bug ids stalls
+    monkeypatch.setattr(bugzilla2gitlab.migrator, 'STREAM_BATCH_WAIT', 0.05)
+    streamed = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.aio.AsyncClient, 'perform_request',
+                        streamed.perform_async)
+
+    def stalling_bug_ids():
+        yield 103
+        for _ in range(100):
+            if streamed.requests_of(103) == serial.requests_of(103):
+                break
+            time.sleep(0.05)
+        yield 5933
+
+    Migrator(config_path, dry_run=False, journal_file="", http_backend="asyncio",
+             async_concurrency=2).migrate(stalling_bug_ids())
+    assert streamed.bugs.index(5933) == len(serial.requests_of(103))
+
+    # a failing coroutine stops the migration
+    monkeypatch.setattr(bugzilla2gitlab.aio.AsyncClient, 'perform_request',
+                        FakeGitLab(fail_after=1).perform_async)
+    with pytest.raises(Exception, match="Bad Gateway"):
+        Migrator(config_path, dry_run=False, journal_file="", http_backend="asyncio",
+                 async_concurrency=2).migrate([103, 5933])
+
+    assert bugzilla2gitlab.aio._form_items({"a": [1, 2], "b": None, "c": "x"}) == \
+        [("a", "1"), ("a", "2"), ("c", "x")]
+
+
+def test_Migrator_resume(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    journal_file = str(tmp_path / "journal.sqlite3")
+
+    complete = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', complete)
+    Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "other.sqlite3")).migrate(
+        [103, 5933])
+
+    # interrupt the migration in the middle of bug 5933, after its issue was created
+    interrupted = FakeGitLab(fail_after=8)
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', interrupted)
+    with pytest.raises(Exception):
+        Migrator(config_path, dry_run=False, journal_file=journal_file).migrate([103, 5933])
+
+    resumed = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', resumed)
+    client = Migrator(config_path, dry_run=False, journal_file=journal_file)
+    client.migrate([103, 5933])
+    assert interrupted.requests + resumed.requests == complete.requests
+
+    # nothing is left to do
+    client.migrate([103, 5933])
+    assert interrupted.requests + resumed.requests == complete.requests
+
+    map_file = str(tmp_path / "map.csv")
+    client.export_map(map_file)
+    with open(map_file) as f:
+        assert f.read().splitlines() == [
+            "https://landfill.bugzilla.org/bugzilla-5.0-branch/show_bug.cgi?id=103,"
+            "https://git.example.com/p/-/issues/103",
+            "https://landfill.bugzilla.org/bugzilla-5.0-branch/show_bug.cgi?id=5933,"
+            "https://git.example.com/p/-/issues/5933",
+        ]
+
+    # an issue created by a request whose response was lost is picked up from GitLab
+    lost = FakeGitLab()
+
+    def mock_lostresponse(url, method, **kwargs):
+        response = lost(url, method, **kwargs)
+        if method == "post" and url.endswith("/issues"):
+            raise requests.Timeout("Read timed out")
+        return response
+
+    journal_file = str(tmp_path / "lost.sqlite3")
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', mock_lostresponse)
+    with pytest.raises(requests.Timeout):
+        Migrator(config_path, dry_run=False, journal_file=journal_file).migrate([103])
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', lost)
+    Migrator(config_path, dry_run=False, journal_file=journal_file).migrate([103])
+    assert lost.requests == complete.requests[:2] + complete.requests[:1] + \
+        complete.requests[2:4]
+
+    # but not an issue of the same iid that was not migrated from the bug
+    lost.issues[5933] = dict(lost.issues.pop(103), iid=5933, title="Another issue")
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', lost)
+    with pytest.raises(Exception, match="was not migrated from bug 5933"):
+        Migrator(config_path, dry_run=False, journal_file=journal_file).migrate([5933])
+
+    # issues and notes are committed right away, so that a hard kill cannot lose them
+    journal = Journal(str(tmp_path / "kill.sqlite3"))
+    journal.record_issue(5, 1, 1, "https://git.example.com/p/-/issues/1")
+    journal.record_note(5, 1, 1, 10)
+    journal.record_state(5, 1, "2016-06-01T17:00:00Z", "", "")
+    db = sqlite3.connect(str(tmp_path / "kill.sqlite3"))
+    assert db.execute("SELECT COUNT(*) FROM issues").fetchone() == (1,)
+    assert db.execute("SELECT COUNT(*) FROM notes").fetchone() == (1,)
+    assert db.execute("SELECT COUNT(*) FROM bugs").fetchone() == (0,)
+
+
+def test_Migrator_sync(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    journal_file = str(tmp_path / "journal.sqlite3")
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', FakeGitLab())
+    client = Migrator(config_path, dry_run=False, journal_file=journal_file)
+    client.migrate([103, 5933])
+
+    # bug 5933 was reopened, tagged and commented on since
+    def mock_fetchbugscontent(url, bug_ids, fields=None):
+        content = read_bugs_content(bug_ids)
+        return content.replace(
+            "<delta_ts>2016-05-15 11:31:10 -0700</delta_ts>",
+            "<delta_ts>2016-06-01 10:00:00 -0700</delta_ts>").replace(
+            "<bug_status>RESOLVED</bug_status>\n          <resolution>FIXED</resolution>",
+            "<bug_status>REOPENED</bug_status>\n          <resolution></resolution>").replace(
+            "<keywords></keywords>", "<keywords>SECURITY</keywords>").replace(
+            "Attaching the GPL, but as a big file!</thetext>\n  </long_desc>",
+            "Attaching the GPL, but as a big file!</thetext>\n  </long_desc>"
+            "<long_desc isprivate=\"0\"><commentid>10627</commentid><who name=\"\">bmc</who>"
+            "<bug_when>2016-06-01 10:00:00 -0700</bug_when><thetext>Still broken</thetext>"
+            "</long_desc>")
+
+    searched = []
+
+    def mock_fetchchangedbugscontent(url, since_date):
+        searched.append(since_date)
+        # days are those of the server, both bugs are in range
+        return "bug_id\n103\n5933\n"
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bugs_content', mock_fetchbugscontent)
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_changed_bugs_content',
+                        mock_fetchchangedbugscontent)
+    synced = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', synced)
+    client.sync()
+    assert searched == ["2016-05-14"]
+    assert synced.requests == [
+        ("post", "https://git.example.com/api/v4/projects/5/issues/5933/notes"),
+        ("put", "https://git.example.com/api/v4/projects/5/issues/5933"),
+    ]
+    journal = client.conf.journal
+    assert not journal.is_closed(5, 5933)
+    assert journal.last_change(5) == "2016-06-01T17:00:00Z"
+
+    # nothing changed since the last sync
+    synced.requests = []
+    client.sync()
+    assert searched[-1] == "2016-05-31"
+    assert synced.requests == []
+
+    # bugs of the list that were not migrated yet are migrated, changed or not
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_changed_bugs_content',
+                        lambda url, since_date: "bug_id\n103\n")
+    client = Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "other.sqlite3"))
+    client.migrate([103])
+    synced.requests = []
+    client.sync([103, 5933])
+    assert ("post", "https://git.example.com/api/v4/projects/5/issues") in synced.requests
+    assert all("/issues/103" not in url for _, url in synced.requests)
+    assert client.conf.journal.is_done(5, 5933)
+
+
+def test_Migrator_projects(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    (tmp_path / "bugs_a.txt").write_text("103\n")
+    (tmp_path / "bugs_b.txt").write_text("5933\n\n")
+    (tmp_path / "projects.yml").write_text("bugs_a.txt: 5\nbugs_b.txt: group/b\n")
+    projects = bugzilla2gitlab.config.load_manifest(str(tmp_path / "projects.yml"))
+    assert projects == {5: ["103"], "group%2Fb": ["5933"]}
+
+    gitlab = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', gitlab)
+    client = Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "j.sqlite3"))
+    client.migrate_projects(projects)
+    # one bug of each project in turn
+    assert [url for method, url in gitlab.requests
+            if method == "post" and url.endswith("/issues")] == [
+        "https://git.example.com/api/v4/projects/5/issues",
+        "https://git.example.com/api/v4/projects/group%2Fb/issues",
+    ]
+    assert client.conf.journal.is_done("group%2Fb", 5933)
+
+    # nothing is left to do
+    gitlab.requests = []
+    client.migrate_projects(projects)
+    assert gitlab.requests == []
+
+
+def test_import_map(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    bugzilla_url = "https://landfill.bugzilla.org/bugzilla-5.0-branch"
+    map_file = tmp_path / "map.csv"
+    map_file.write_text("\n".join([
+        bugzilla2gitlab.utils.map_row(bugzilla_url, 103, "https://git.example.com/p/-/issues/3"),
+        bugzilla2gitlab.utils.map_row(bugzilla_url, 5933,
+                                      "https://git.example.com/group/b/-/issues/5933"),
+        bugzilla2gitlab.utils.map_row(bugzilla_url, 7, "https://git.example.com/c/-/issues/7"),
+    ]) + "\n")
+    projects = {5: ["103"], "group%2Fb": ["5933"]}
+
+    gitlab = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', gitlab)
+    client = Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "j.sqlite3"))
+    assert client.import_map(str(map_file), projects) == 3
+    assert client.conf.journal.issues() == [
+        ("5", 103, 3, "https://git.example.com/p/-/issues/3"),
+        ("c", 7, 7, "https://git.example.com/c/-/issues/7"),
+        ("group%2Fb", 5933, 5933, "https://git.example.com/group/b/-/issues/5933"),
+    ]
+    # imported bugs are migrated already, and imported once
+    client.migrate_projects(projects)
+    assert gitlab.requests == []
+    assert client.import_map(str(map_file), projects) == 0
+
+    # without projects, the bugs are of the configured project
+    client = Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "k.sqlite3"))
+    client.import_map(str(map_file))
+    assert [row[:2] for row in client.conf.journal.issues()] == [
+        ("5", 7), ("5", 103), ("5", 5933)]
+
+    map_file.write_text("https://bugzilla.example.com/show_bug.cgi?id=1,"
+                        "https://git.example.com/p/-/issues/1\n")
+    with pytest.raises(Exception):
+        client.import_map(str(map_file))
+
+
+def test_link_references(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', FakeGitLab())
+    client = Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "j.sqlite3"))
+    client.migrate([103, 5933])
+    # bug 103 blocks bug 23, migrated to another project, and duplicates bug 20
+    journal = client.conf.journal
+    journal.record_issue("group%2Fb", 23, 4, "https://git.example.com/group/b/-/issues/4")
+    journal.record_issue(5, 20, 20, "https://git.example.com/p/-/issues/20")
+
+    linked = []
+
+    def mock_performrequest(url, method, data={}, **kwargs):
+        linked.append((method, url, data))
+
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', mock_performrequest)
+    client.link_references()
+    # only the texts that refer to migrated bugs are updated
+    assert [(method, url) for method, url, _ in linked] == [
+        ("put", "https://git.example.com/api/v4/projects/5/issues/103"),
+        ("put", "https://git.example.com/api/v4/projects/5/issues/103/notes/3"),
+    ]
+    description = linked[0][2]["description"]
+    assert "| Blocks | group/b#4 |" in description
+    assert "| Depends on | https://landfill.bugzilla.org/bugzilla-5.0-branch/show_bug.cgi" \
+        "?id=22803 |" in description
+    assert "duplicate of bug #20" in linked[1][2]["body"]
+
+    # texts are only updated again if their references change
+    linked.clear()
+    client.link_references()
+    assert linked == []
+    journal.record_issue(5, 22803, 22803, "https://git.example.com/p/-/issues/22803")
+    client.link_references([103])
+    assert [url for _, url, _ in linked] == [
+        "https://git.example.com/api/v4/projects/5/issues/103"]
+    assert "| Depends on | #22803 |" in linked[0][2]["description"]
+
+    # the text of a comment whose upload is not in the journal is left as it is
+    def mock_fetchbugscontent(url, bug_ids):
+        return read_bugs_content(bug_ids).replace("Attaching the GPL, but", "See bug 20, but")
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bugs_content', mock_fetchbugscontent)
+    journal.db.execute("DELETE FROM attachments WHERE attachid = 895")
+    journal.db.execute("DELETE FROM uploads")
+    linked.clear()
+    client.link_references([5933])
+    assert linked == []
+
+    # mentions of the bugs of other trackers are left alone
+    index = ReferenceIndex(journal.issues(), "https://landfill.bugzilla.org/bugzilla-5.0-branch")
+    assert index.rewrite("See bug 20, not GCC bug 20 or upstream bug 20. Bug 20 (bug 7)", 5) \
+        == "See bug #20, not GCC bug 20 or upstream bug 20. Bug #20 (bug 7)"
+
+
+def test_Migrator_stream(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    pages = []
+
+    def mock_performrequest(url, method, params={}, headers={}, **kwargs):
+        assert params["product"] == ["Packages"]
+        pages.append(params["offset"])
+        bug_ids = [103, 5933, 103][params["offset"]:params["offset"] + params["limit"]]
+        return {"bugs": [{"id": bug_id} for bug_id in bug_ids]}
+
+    monkeypatch.setattr(bugzilla2gitlab.rest, '_perform_request', mock_performrequest)
+    bug_ids = bugzilla2gitlab.rest.search_bug_ids("https://bugzilla.example.com",
+                                                  {"product": ["Packages"]}, page_size=2)
+    assert list(bugzilla2gitlab.utils.chunks(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    with pytest.raises(Exception):
+        list(bugzilla2gitlab.utils.validate_list(iter(["103", "x"])))
+    with pytest.raises(Exception):
+        bugzilla2gitlab.utils.validate_list(iter([]))
+
+    # a stream that stalls is fetched up to where it stalls, rather than in whole batches
+    handed_over = threading.Event()
+
+    def stalling_bug_ids():
+        yield 1
+        yield 2
+        assert handed_over.wait(5)
+        yield 3
+        raise ValueError("Broken pipe")
+
+    batches = []
+    with pytest.raises(ValueError, match="Broken pipe"):
+        for batch in bugzilla2gitlab.utils.chunks(stalling_bug_ids(), 10, wait=0.05):
+            batches.append(batch)
+            handed_over.set()
+    assert batches == [[1, 2], [3]]
+    assert list(bugzilla2gitlab.utils.chunks(iter(range(5)), 2, wait=1)) == [
+        [0, 1], [2, 3], [4]]
+
+    gitlab = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', gitlab)
+    client = Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "j.sqlite3"))
+    # Bugzilla is logged in to before the stream is consumed
+    events = []
+    monkeypatch.setattr(client, "login", lambda: events.append("login"))
+
+    def read(bug_ids):
+        for bug in bug_ids:
+            events.append(bug)
+            yield bug
+
+    client.migrate(read(bug_ids))
+    assert events[0] == "login"
+    # the search is paged through as bugs are migrated, and duplicates are skipped
+    assert pages == [0, 2]
+    assert [url for method, url in gitlab.requests
+            if method == "post" and url.endswith("/issues")] == [
+        "https://git.example.com/api/v4/projects/5/issues"] * 2
+    assert client.conf.journal.is_done(5, 5933)
+
+    # so are the bugs changed since a sync
+    def mock_changed(url, method, params={}, headers={}, **kwargs):
+        assert params["last_change_time"] == "2016-05-15T18:31:10Z"
+        assert params["order"] == "bug_id"
+        pages.append(params["offset"])
+        return {"bugs": [{"id": bug_id} for bug_id in range(1, 6)][
+            params["offset"]:params["offset"] + params["limit"]]}
+
+    monkeypatch.setattr(bugzilla2gitlab.rest, '_perform_request', mock_changed)
+    pages.clear()
+    assert bugzilla2gitlab.rest.get_changed_bug_ids(
+        "https://bugzilla.example.com", "2016-05-15T18:31:10Z", page_size=2) == [1, 2, 3, 4, 5]
+    assert pages == [0, 2, 4]
+
+
+def test_users(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+    looked_up = []
+    barrier = None
+
+    def mock_getuserid(username, gitlab_url, headers):
+        looked_up.append(username)
+        if barrier:
+            barrier.wait()
+        return {"bcantrill": 7, "chris.yeh": 8}[username]
+
+    monkeypatch.setattr(bugzilla2gitlab.config, '_get_user_id', mock_getuserid)
+    conf = bugzilla2gitlab.config.get_config(config_path)
+    assert conf.gitlab_users == {"bcantrill": 7, "chris.yeh": 8}
+    assert looked_up == ["bcantrill", "chris.yeh"]
+
+    # the ids are cached
+    bugzilla2gitlab.config.get_config(config_path)
+    assert looked_up == ["bcantrill", "chris.yeh"]
+
+    # expired ids are looked up again, by as many threads as workers at the same time
+    looked_up = []
+    barrier = threading.Barrier(2, timeout=5)
+    conf = bugzilla2gitlab.config.get_config(config_path, user_cache_ttl=0, workers=2)
+    assert conf.gitlab_users == {"bcantrill": 7, "chris.yeh": 8}
+    assert sorted(looked_up) == ["bcantrill", "chris.yeh"]
+    barrier = None
+
+    gitlab = FakeGitLab()
+    requests = []
+
+    def mock_performrequest(url, method, data={}, **kwargs):
+        requests.append(dict(data))
+        return gitlab(url, method, data=data, **kwargs)
+
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', mock_performrequest)
+    Migrator(config_path, dry_run=False, journal_file="").migrate([103, 5933])
+    assert [r.get("assignee_ids") for r in requests if "iid" in r] == [[8], [7]]
+
+
+def test_format_utc():
+    format_utc = bugzilla2gitlab.utils.format_utc
+    parse_utc = bugzilla2gitlab.utils.parse_utc
+    rng = random.Random(0)
+    times = ["{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d} {}{:02d}{:02d}".format(
+        rng.randint(1998, 2030), rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+        rng.randint(0, 59), rng.randint(0, 59), rng.choice("+-"), rng.randint(0, 14),
+        rng.choice([0, 30, 45])) for _ in range(2000)]
+    # across days, months, years and a leap day
+    times += ["2014-06-01 07:57:32 -0700", "2016-12-31 23:30:00 -0100",
+              "2017-01-01 00:15:00 +0100", "2016-02-29 22:00:00 -0300",
+              "2016-03-01 01:00:00 +0200"]
+    for t in times:
+        assert format_utc(t) == parse_utc(t), t
+    assert format_utc("2016-12-31 23:30:00 -0100") == "2017-01-01T00:30:00Z"
+
+    # other formats are parsed by dateutil
+    for t in ["2019-05-01T17:00:00Z", "2019-05-01 17:00 +0200", "2019-05-01 17:00:00 UTC"]:
+        assert format_utc(t) == parse_utc(t)
+
+
+def test_milestones(monkeypatch):
+
+    class Page(object):
+        def __init__(self, items, next_url=None):
+            self.items = items
+            self.links = {"next": {"url": next_url}} if next_url else {}
+
+        def json(self):
+            return self.items
+
+    url = "https://git.example.com/api/v4/projects/5/milestones"
+    pages = {url: Page([{"title": "1.0", "id": 1}], url + "?page=2"),
+             url + "?page=2": Page([{"title": "2.0", "id": 2}])}
+    requested = []
+
+    def mock_performrequest(url, method, params={}, **kwargs):
+        requested.append(dict(params))
+        return pages[url]
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_perform_request', mock_performrequest)
+    milestones = bugzilla2gitlab.config._load_milestone_id_cache(
+        5, "https://git.example.com/api/v4", {})
+    assert milestones == {"gitlab_milestones": {"1.0": 1, "2.0": 2}}
+    assert requested == [{"per_page": 100}, {}]
+
+    mock_gitlab_config(monkeypatch)
+
+    def mock_fetchbugfieldscontent(url, bug_ids, fields):
+        assert fields == ["bug_id", "target_milestone"]
+        return "<bugzilla>{}</bugzilla>".format("".join(
+            "<bug><bug_id>{}</bug_id><target_milestone>{}</target_milestone></bug>".format(
+                bug_id, milestone)
+            for bug_id, milestone in zip(bug_ids, ["2.0", "---", "Foo", "3.0"])))
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bug_fields_content',
+                        mock_fetchbugfieldscontent)
+    gitlab = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', gitlab)
+    client = Migrator(os.path.join(TEST_DATA_PATH, "config"), dry_run=False, journal_file="")
+    client.create_milestones([1, 2, 3, 4])
+    # "---" is skipped and "Foo" exists already
+    assert gitlab.requests == [("post", url)] * 2
+    assert sorted(client.conf.gitlab_milestones) == ["2.0", "3.0", "Foo"]
+
+    # issues only look up the milestones that were created upfront
+    bugzilla2gitlab.models.create_milestones(client.conf, ["3.0", "2.0"])
+    assert len(gitlab.requests) == 2
+
+
+def test_perform_request_retries(monkeypatch):
+
+    class Response(object):
+        def __init__(self, status_code, headers={}):
+            self.status_code = status_code
+            self.reason = "reason"
+            self.headers = headers
+            self.content = b"{}"
+            self.request = Request()
+
+        def json(self):
+            return {"status": self.status_code}
+
+    class Request(object):
+        headers = {"Content-Length": "10"}
+
+    class Session(object):
+        def __init__(self, statuses):
+            self.responses = [Response(*s) for s in statuses]
+
+        def request(self, url, **kwargs):
+            return self.responses.pop(0)
+
+        get = put = post = request
+
+    governor = bugzilla2gitlab.ratelimit.RateGovernor(max_retries=2, backoff=0)
+    monkeypatch.setattr(bugzilla2gitlab.utils, 'governor', governor)
+    perform_request = bugzilla2gitlab.utils._perform_request
+    url = "https://git.example.com/api/v4/projects/5/issues"
+
+    session = Session([(429, {"Retry-After": "0"}), (502,), (201,)])
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_get_session', lambda: session)
+    assert perform_request(url, "put") == {"status": 201}
+    assert governor.stats() == {"throttles": 1, "retries": 2}
+
+    # a POST that failed on the server may have been processed, so it is not repeated
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_get_session', lambda: Session([(502,)]))
+    with pytest.raises(Exception):
+        perform_request(url, "post")
+
+    # ... but a throttled one was not
+    session = Session([(429,), (201,)])
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_get_session', lambda: session)
+    assert perform_request(url, "post") == {"status": 201}
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_get_session',
+                        lambda: Session([(503,), (503,), (503,)]))
+    with pytest.raises(Exception):
+        perform_request(url, "get")
+    assert governor.stats() == {"throttles": 2, "retries": 5}
+
+
+def test_transport(monkeypatch):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            if self.path == "/slow":
+                time.sleep(0.5)
+            content = b"<bugzilla>" + b"<bug/>" * 1000 + b"</bugzilla>"
+            compressed = "gzip" in self.headers.get("Accept-Encoding", "")
+            if compressed:
+                content = gzip.compress(content)
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(content)))
+            if compressed:
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            self.wfile.write(content)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+    transport = bugzilla2gitlab.transport.Transport(pool_size=2, read_timeout=0.1)
+    monkeypatch.setattr(bugzilla2gitlab.utils, 'transport', transport)
+    governor = bugzilla2gitlab.ratelimit.RateGovernor(max_retries=1, backoff=0)
+    monkeypatch.setattr(bugzilla2gitlab.utils, 'governor', governor)
+    try:
+        for _ in range(3):
+            response = bugzilla2gitlab.utils._perform_request(url + "/xml", "get", json=False)
+            assert response.headers["Content-Encoding"] == "gzip"
+            assert response.content.count(b"<bug/>") == 1000
+        # the connection is kept alive
+        host = "127.0.0.1:{}".format(server.server_address[1])
+        assert transport.stats() == {host: {"connections": 1, "requests": 3}}
+
+        # a request that times out is retried, and given up on
+        with pytest.raises(requests.Timeout):
+            bugzilla2gitlab.utils._perform_request(url + "/slow", "get")
+        assert governor.stats()["retries"] == 1
+        # pools of another size replace the previous ones, counted all the same
+        transport.configure(4, 10, 300)
+        bugzilla2gitlab.utils._perform_request(url + "/xml", "get", json=False)
+        assert transport.stats()[host]["requests"] == 6
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_export(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+
+    def mock_performrequest(*args, **kwargs):
+        raise Exception("an export makes no requests to GitLab")
+
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', mock_performrequest)
+    export_file = str(tmp_path / "export.tar.gz")
+    Migrator(os.path.join(TEST_DATA_PATH, "config"), dry_run=False,
+             export_file=export_file).migrate([103, 5933])
+
+    with tarfile.open(export_file) as tar:
+        names = tar.getnames()
+        issues = [json.loads(line) for line in tar.extractfile("tree/project/issues.ndjson")]
+    assert "VERSION" in names and "tree/project.json" in names
+    # both attachments of bug 5933 are the same file
+    uploads = [name for name in names if name.startswith("uploads/")]
+    assert len(uploads) == 1
+
+    assert [issue["iid"] for issue in issues] == [103, 5933]
+    issue = issues[1]
+    assert issue["state"] == "closed"
+    assert [link["label"]["title"] for link in issue["label_links"]] == ["bugzilla", "legacy"]
+    assert "## Description" in issue["description"]
+    assert len(issue["notes"]) == 2
+    link = "/" + uploads[0]
+    assert issue["notes"][0]["note"].startswith("**Comment 1 by")
+    assert "[attachment 894]({})".format(link) in issue["notes"][0]["note"]
+    assert "[attachment 895]({})".format(link) in issue["notes"][1]["note"]
+
+
+def test_rest_backend(monkeypatch):
+    url = "https://bugzilla.example.com"
+    xml = bugzilla2gitlab.utils.get_bugzilla_bugs
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bugs_content',
+                        lambda url, bug_ids: read_bugs_content(bug_ids))
+    expected = xml(url, [5933], 1024)["5933"]
+    attachments = expected["attachments"]
+    requested = []
+
+    def mock_performrequest(url, method, params={}, headers={}, **kwargs):
+        path = url.replace("https://bugzilla.example.com/rest", "")
+        requested.append(path)
+        if path == "/bug":
+            return {"bugs": [{
+                "id": 5933, "summary": "this is my summary", "status": "RESOLVED",
+                "creation_time": "2007-10-18T12:56:11Z",
+                "last_change_time": "2016-05-15T18:31:10Z", "alias": [], "cc": ["cm449922"],
+                "keywords": [], "blocks": [], "depends_on": [], "see_also": [],
+                "creator": "bmc", "creator_detail": {"name": "bmc", "real_name": ""},
+            }], "faults": [{"id": 1, "faultString": "Bug #1 does not exist."}]}
+        if path == "/bug/5933/comment":
+            return {"bugs": {"5933": {"comments": [
+                {"id": 10624 + i, "count": i, "creator": "bmc", "attachment_id": attachid,
+                 "creation_time": "2007-10-18T12:56:11Z", "text": comment["thetext"]}
+                for i, (comment, attachid) in enumerate(zip(expected["comments"],
+                                                            [None, 894, 895]))]}}}
+        if path == "/bug/5933/attachment":
+            assert params["exclude_fields"] == "data"
+            return {"bugs": {"5933": [
+                {"id": int(attachid), "file_name": "GPL", "is_obsolete": attachid == "894"}
+                for attachid in attachments]}}
+        if path == "/user":
+            raise Exception("401 failed requests: Unauthorized")
+        # streamed, with slashes escaped as some JSON encoders do
+        assert kwargs["stream"]
+        attachid = path.split("/")[-1]
+        data = base64.b64encode(attachments[attachid]["content"]().read()).decode("ascii")
+        return json.dumps({"bugs": {}, "attachments": {attachid: {"data": data}}}).replace(
+            "/", "\\/")
+
+    monkeypatch.setattr(bugzilla2gitlab.rest, '_perform_request', mock_performrequest)
+    bugs = bugzilla2gitlab.rest.get_bugzilla_bugs(url, [1, 5933], 1024)
+    assert bugs["1"]["error"] == "Bug #1 does not exist."
+    bug = bugs["5933"]
+    assert bug["creation_ts"] == "2007-10-18 12:56:11 +0000"
+    format_utc = bugzilla2gitlab.utils.format_utc
+    assert format_utc(bug["delta_ts"]) == format_utc(expected["delta_ts"])
+    for field in ["short_desc", "reporter", "bug_status", "cc", "alias"]:
+        assert bug[field] == expected[field]
+    for comment, expected_comment in zip(bug["comments"], expected["comments"]):
+        for field in ["who", "thetext", "attachid"]:
+            assert comment.get(field) == expected_comment.get(field)
+
+    # attachment data is only downloaded when it is needed
+    assert requested == ["/bug", "/bug/5933/comment", "/bug/5933/attachment", "/user"]
+    attachment = bug["attachments"]["894"]
+    assert attachment["isobsolete"]
+    attachment["content"]()
+    assert attachment["sha256"] == attachments["894"]["sha256"]
+    assert requested[4:] == ["/bug/attachment/894"]
+
+    # the data is decoded as it is received, whatever the chunks it is received in
+    content = bytes(range(256)) * 100
+    body = json.dumps({"attachments": {"894": {"data": base64.encodebytes(content).decode(
+        "ascii"), "file_name": "a\"b"}}}).replace("/", "\\/").encode("ascii")
+    for size in [1, 7, 1 << 16]:
+        f = io.BytesIO()
+        chunks = [body[i:i + size] for i in range(0, len(body), size)]
+        assert bugzilla2gitlab.rest.decode_data(chunks, f) == (
+            len(content), hashlib.sha256(content).hexdigest())
+        assert f.read() == content
+    with pytest.raises(Exception, match="truncated"):
+        bugzilla2gitlab.rest.decode_data([body[:100]], io.BytesIO())
+
+
+def test_metrics(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    metrics = bugzilla2gitlab.metrics.Metrics()
+
+    metrics.record_request("post", "https://git.example.com/api/v4/projects/5/issues/7/notes",
+                           201, 0.02, 100, 20)
+    metrics.record_request("post", "https://git.example.com/api/v4/projects/5/issues/8/notes",
+                           None, 3)
+    timed = metrics.timed("sleep")(time.sleep)
+    timed(0)
+    data = metrics.to_dict()
+    assert data["requests"] == [{
+        "endpoint": "/api/v4/projects/:id/issues/:id/notes", "method": "POST", "count": 2,
+        "seconds": 3.02, "bytes_sent": 100, "bytes_received": 20,
+        "statuses": {"201": 1, "error": 1},
+        "histogram": {"0.005": 0, "0.01": 0, "0.025": 1, "0.05": 1, "0.1": 1, "0.25": 1,
+                      "0.5": 1, "1.0": 1, "2.5": 1, "5.0": 2, "10.0": 2, "+Inf": 2},
+    }]
+    assert [p["phase"] for p in data["phases"]] == ["sleep"]
+
+    prometheus = metrics.to_prometheus()
+    assert ('bugzilla2gitlab_requests_total{endpoint="/api/v4/projects/:id/issues/:id/notes",'
+            'method="POST",status="201"} 1') in prometheus
+    assert 'bugzilla2gitlab_phase_duration_seconds_count{phase="sleep"} 1' in prometheus
+
+    metrics_file = str(tmp_path / "metrics.json")
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', FakeGitLab())
+    Migrator(os.path.join(TEST_DATA_PATH, "config"), dry_run=False, journal_file="",
+             metrics_file=metrics_file).migrate([5933])
+    with open(metrics_file) as f:
+        phases = [p["phase"] for p in json.load(f)["phases"]]
+    for phase in ["attachment.save", "bugzilla.fetch", "bugzilla.parse", "comment.save",
+                  "issue.close", "issue.load_fields"]:
+        assert phase in phases
+
+
+def test_RateGovernor_pacing():
+    governor = bugzilla2gitlab.ratelimit.RateGovernor()
+    url = "https://git.example.com/api/v4/projects"
+    assert governor.delay(url) == 0
+
+    # 10 requests left for the next 10 seconds: one request per second
+    governor.update(url, {"RateLimit-Remaining": "10", "RateLimit-Reset": str(time.time() + 10)})
+    governor.delay(url)
+    assert 0.5 < governor.delay(url) <= 1
+
+    governor.update(url, {"Retry-After": "30"})
+    assert 25 < governor.delay(url) <= 30
+    # other hosts are not held back
+    assert governor.delay("https://bugzilla.example.com/show_bug.cgi") == 0
+
+
+def test_Migrator_offline(monkeypatch, cache_dir):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+
+    Migrator(config_path).prefetch([103, 5933])
+    assert sorted(os.listdir(cache_dir)) == ["103-20140601145732.xml.gz",
+                                             "5933-20160515183110.xml.gz"]
+
+    def mock_fetchbugscontent(url, bug_ids, fields=None):
+        raise Exception("no network in offline mode")
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bugs_content', mock_fetchbugscontent)
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bug_fields_content',
+                        mock_fetchbugscontent)
+    offline = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', offline)
+    Migrator(config_path, dry_run=False, journal_file="", offline=True).migrate([103, 5933])
+
+    mock_gitlab_config(monkeypatch)
+    online = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', online)
+    Migrator(config_path, dry_run=False, journal_file="").migrate([103, 5933])
+    assert offline.requests == online.requests
+
+    with pytest.raises(Exception):
+        Migrator(config_path, offline=True).migrate([104])
+
+
+def test_Migrator_validate(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    config_path = os.path.join(TEST_DATA_PATH, "config")
+
+    def mock_fetchbugscontent(url, bug_ids, fields=None):
+        bug_ids = [str(bug) for bug in bug_ids]
+        content = read_bugs_content([bug for bug in bug_ids if bug != "6000"])
+        if "6000" in bug_ids:
+            # bug 6000 has an attachment in an unsupported encoding
+            broken = read_bugs_content([5933]).replace(
+                "<bug_id>5933</bug_id>", "<bug_id>6000</bug_id>").replace(
+                'encoding="base64"', 'encoding="uuencode"')
+            content = content.replace("</bugzilla>", broken[len("<bugzilla>"):])
+        return content
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_fetch_bugs_content', mock_fetchbugscontent)
+    report = str(tmp_path / "report.csv")
+    results = Migrator(config_path).validate([103, 5933, 6000], report_file=report,
+                                             processes=2)
+    assert [result["bug_id"] for result in results] == ["103", "5933", "6000"]
+    assert results[2]["error"] == "ValueError: uuencode encoding is not supported"
+
+    # the requests counted are those of the migration
+    gitlab = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', gitlab)
+    Migrator(config_path, dry_run=False, journal_file=str(tmp_path / "j.sqlite3")).migrate(
+        [103, 5933])
+    assert results[0]["requests"] + results[1]["requests"] == len(gitlab.requests)
+    assert len(results[1]["uploads"]) == len([r for r in gitlab.requests
+                                              if r[1].endswith("/uploads")])
+
+    with open(report) as f:
+        rows = f.read().splitlines()
+    assert rows[0] == "bug_id,requests,upload_bytes,error"
+    assert rows[3] == "6000,0,0,ValueError: uuencode encoding is not supported"
+
+
+def test_Attachment_deduplication(monkeypatch, tmp_path):
+    mock_gitlab_config(monkeypatch)
+    gitlab = FakeGitLab()
+    monkeypatch.setattr(bugzilla2gitlab.models, '_perform_request', gitlab)
+
+    # both attachments of bug 5933 are the same file
+    client = Migrator(os.path.join(TEST_DATA_PATH, "config"), dry_run=False,
+                      journal_file=str(tmp_path / "journal.sqlite3"))
+    client.migrate([5933])
+    uploads = [url for method, url in gitlab.requests if url.endswith("/uploads")]
+    assert len(uploads) == 1
+    assert client.conf.journal.uploads_reused == 1
+    assert client.conf.journal.bytes_saved == 18007
+
+
+def test_bounded_memory(monkeypatch, tmp_path):
+    '''
+    A bug with a large attachment is parsed, and stored in the bug cache, as the response
+    is received, in memory that does not grow with the size of the attachment.
+    '''
+    xml = read_bugs_content([5933]).encode("utf-8")
+    start = xml.index(b'<data encoding="base64">') + len(b'<data encoding="base64">')
+    end = xml.index(b"</data>", start)
+    block = bytes(range(256)) * 768
+    blocks = 128
+    sha256 = hashlib.sha256()
+    for _ in range(blocks):
+        sha256.update(block)
+
+    class Body(io.RawIOBase):
+        def __init__(self):
+            self.parts = itertools.chain(
+                [xml[:start]], (base64.encodebytes(block) for _ in range(blocks)), [xml[end:]])
+            self.rest = b""
+
+        def readable(self):
+            return True
+
+        def readinto(self, buffer):
+            while not self.rest:
+                self.rest = next(self.parts, None)
+                if self.rest is None:
+                    return 0
+            size = min(len(buffer), len(self.rest))
+            buffer[:size] = self.rest[:size]
+            self.rest = self.rest[size:]
+            return size
+
+    class Session(object):
+        def request(self, url, stream=False, **kwargs):
+            assert stream
+            response = requests.Response()
+            response.status_code = 200
+            response.raw = Body()
+            response.request = requests.Request("GET", url).prepare()
+            return response
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, '_get_session', lambda: Session())
+    cache = BugCache(str(tmp_path / "cache"))
+    tracemalloc.start()
+    try:
+        bugs = bugzilla2gitlab.utils.get_bugzilla_bugs("https://bugzilla.example.com", [5933],
+                                                       1 << 20, cache.put)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    attachment = bugs["5933"]["attachments"]["894"]
+    assert attachment["size"] == len(block) * blocks
+    assert attachment["sha256"] == sha256.hexdigest()
+    # 24 MiB of attachment, 32 MiB of base64
+    assert peak < 8 << 20
+    cached = cache.get(5933, 1 << 20)["attachments"]["894"]
+    assert cached["sha256"] == attachment["sha256"]
+
+    # so is the response of the asyncio backend
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            body = Body()
+            self.send_response(200)
+            self.send_header("Content-Length", str(start + len(xml) - end + blocks * len(
+                base64.encodebytes(block))))
+            self.end_headers()
+            for part in body.parts:
+                self.wfile.write(part)
+
+    async def fetch(url):
+        async with bugzilla2gitlab.aio.AsyncClient() as client:
+            return await bugzilla2gitlab.aio.get_bugzilla_bugs(client, url, [5933], 1 << 20,
+                                                               cache.put)
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tracemalloc.start()
+    try:
+        bugs = asyncio.run(fetch("http://127.0.0.1:{}".format(server.server_address[1])))
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        server.shutdown()
+
+    assert bugs["5933"]["attachments"]["894"]["sha256"] == sha256.hexdigest()
+    assert peak < 8 << 20
+
+
+def test_streaming_attachments():
+    content = bytes(range(256)) * 1000
+    text = base64.encodebytes(content).decode("ascii")
+
+    f = io.BytesIO()
+    size, sha256 = bugzilla2gitlab.records.decode_base64(text, f, chunk_size=1001)
+    assert size == len(content)
+    assert sha256 == hashlib.sha256(content).hexdigest()
+    assert f.read() == content
+
+    body = bugzilla2gitlab.utils.MultipartStream({"file": ('a "patch".diff', f)})
+    data = b"".join(body)
+    assert len(body) == len(data)
+    assert b'filename="a %22patch%22.diff"' in data
+    assert content in data